@@ -17,8 +17,8 @@ import data_output as do
 # timings
 start = time.time()
 
-# get current working directory
-CWD = os.getcwd()
+# get the project root, as in data_ingest
+CWD = di.PATHS.root
 
 # Load config
 with open(os.path.join(CWD, "config.yaml")) as yamlfile:
@@ -28,12 +28,12 @@ with open(os.path.join(CWD, "config.yaml")) as yamlfile:
 
 # Constants
 pop_year = str(config["calculation_year"])
-DATA_DIR = config["data_dir"]
+DATA_DIR = di.PATHS.data_dir
 boundary_year = "2021"
 DEFAULT_CRS = config["default_crs"]
 
 # grabs northern ireland bus stops path
-ni_bus_stops_path = os.path.join(CWD, "data", "stops", "NI", "bus_stops_ni.csv")
+ni_bus_stops_path = di.PATHS.data("stops", "NI", "bus_stops_ni.csv")
 
 # reads in NI bus stop data as pandas df
 ni_bus_stops = pd.read_csv(ni_bus_stops_path, index_col=0)
@@ -42,8 +42,8 @@ ni_bus_stops = pd.read_csv(ni_bus_stops_path, index_col=0)
 ni_bus_stops['capacity_type'] = 'low'
 
 # gets the northern ireland train stops data path
-ni_train_stops_path = os.path.join(
-    CWD, "data", "stops", "NI", "train_stops_ni.csv")
+ni_train_stops_path = di.PATHS.data(
+    "stops", "NI", "train_stops_ni.csv")
 
 # reads in the NI train stop data as pandas df
 ni_train_stops = pd.read_csv(ni_train_stops_path, index_col=0)
@@ -65,7 +65,7 @@ stops_geo_df = di.geo_df_from_pd_df(pd_df=stops_df,
 stops_geo_df = dt.convert_east_north(stops_geo_df, 'Longitude', 'Latitude')
 
 # Get usual population for Northern Ireland (Census 2011 data)
-census_ni_df = pd.read_csv(os.path.join(CWD, "data", "KS101NI.csv"))
+census_ni_df = pd.read_csv(di.PATHS.data("KS101NI.csv"))
 
 # Remove any commas if they are there
 census_ni_df = census_ni_df.replace(',','', regex=True)
@@ -74,9 +74,8 @@ cols = ['All usual residents', 'Males', 'Females']
 census_ni_df[cols] = census_ni_df[cols].apply(pd.to_numeric, errors='coerce', axis=1)
 
 # Read in mid-year population estimates for Northern Ireland
-pop_files = pd.read_csv(os.path.join(CWD,
-                                     "data", "population_estimates",
-                                     "SAPE20-SA-Totals.csv"),
+pop_files = pd.read_csv(di.PATHS.data("population_estimates",
+                                      "SAPE20-SA-Totals.csv"),
                                     header=7)
 
 # Read in mid-year population estimates for Northern Ireland
@@ -93,25 +92,19 @@ estimate_cols = ["Area_Code", pop_year]
 estimate_pop_NI = pop_files[estimate_cols]
 #estimate_pop_NI = ni_mid_year_estimates[['Area_Code', pop_year]]
 
-# getting path for .shp file for LA's
-uk_la_path = di.get_shp_abs_path(dir=os.path.join(os.getcwd(),
-                                                  "data",
-                                                  "LA_shp",
-                                                  boundary_year))
-
 # Need OA to SA lookup so we can map to SA for pop weighted centroids
-oa_to_sa_lookup_path = os.path.join(CWD, "data", "oa_la_mapping",
-                                    "NI",
-                                    "OA_to_SA.csv")
+oa_to_sa_lookup_path = di.PATHS.data("oa_la_mapping",
+                                     "NI",
+                                     "OA_to_SA.csv")
 
 
 # reads in the OA to SA lookupfile
 sa_to_la = pd.read_csv(oa_to_sa_lookup_path,
                        usecols=["COA2001_1", "SA2011"])
 
-# getting the coordinates for all LA's
-uk_la_file = di.geo_df_from_geospatialfile(path_to_file=uk_la_path)
-ni_la_file = uk_la_file[uk_la_file["LAD21CD"].str[0].isin(['N'])]
+# getting the dissolved polygons for all LA's, built once per boundary year
+la_store, la_lookup = di.get_la_polygon_store(boundary_year)
+ni_la_file = la_store[la_store.index.str.startswith('N')]
 
 # Get population weighted centroids into a dataframe
 ni_pop_wtd_centr_df = (di.geo_df_from_geospatialfile
@@ -139,9 +132,9 @@ pwc_with_pop = pd.merge(left=census_ni_df,
 pwc_with_pop.drop(["SA Code", "OA_CODE", "COA2001_1"], axis=1, inplace=True)
 
 # SA to LA lookup
-sa_to_la_lookup_path = os.path.join(CWD, "data", "oa_la_mapping",
-                                    "NI",
-                                    "11DC_Lookup_1_0.csv")
+sa_to_la_lookup_path = di.PATHS.data("oa_la_mapping",
+                                     "NI",
+                                     "11DC_Lookup_1_0.csv")
 
 # reads in the OA to LA lookupfile
 sa_to_la = pd.read_csv(sa_to_la_lookup_path)
@@ -161,9 +154,8 @@ pwc_with_pop_with_la.rename(
     inplace=True)
 
 # Read disability data for disaggregations later
-disability_df = pd.read_csv(os.path.join(CWD,
-                                         "data", "disability_status",
-                                         "qs303_ni.csv"), skiprows=5)
+disability_df = pd.read_csv(di.PATHS.data("disability_status",
+                                          "qs303_ni.csv"), skiprows=5)
 
 # Remove the first column because it's a repeat of SA code
 disability_df.drop(['SA'], axis=1, inplace=True)
@@ -179,7 +171,7 @@ replacements = {
 disability_df.rename(columns=replacements, inplace=True)
 
 # defining age data path
-age_path = os.path.join(CWD, "data", "census-2011-qs103ni.xlsx")
+age_path = di.PATHS.data("census-2011-qs103ni.xlsx")
 
 # reading in age data
 age_df = di.read_ni_age_df(age_path)
@@ -222,10 +214,7 @@ for local_auth in ni_auth:
     print(f"Processing: {local_auth}")
 
     # Get a polygon of la based on the Location Code
-    la_poly = (gs.get_polygons_of_loccode(
-        geo_df=ni_la_file,
-        dissolveby="LAD21NM",
-        search=local_auth))
+    la_poly = gs.get_la_polygon(la_store, la_lookup, local_auth)
 
     # Creating a Geo Dataframe of only stops in la
     la_stops_geo_df = (gs.find_points_in_poly
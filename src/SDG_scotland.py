@@ -19,9 +19,8 @@ from main import stops_geo_df
 
 # timings
 start = time.time()
-# get current working directory
-CWD = os.getcwd()
-# TODO: find out best practice on CWD
+# get the project root, as in data_ingest
+CWD = di.PATHS.root
 
 # Load config
 with open(os.path.join(CWD, "config.yaml")) as yamlfile:
@@ -31,9 +30,9 @@ with open(os.path.join(CWD, "config.yaml")) as yamlfile:
 
 # Constants
 DEFAULT_CRS = config["default_crs"]
-DATA_DIR = config["data_dir"]
+DATA_DIR = di.PATHS.data_dir
 OUTFILE = config['outfile_sc']
-OUTPUT_DIR = config["data_output"]
+OUTPUT_DIR = di.PATHS.resolve(config["data_output"])
 
 pop_year = "2011"
 boundary_year = "2021"
@@ -46,18 +45,12 @@ boundary_year = "2021"
 # stops_geo_df = dt.add_stop_capacity_type(stops_df=stops_geo_df)
 
 # get usual population for scotland
-usual_pop_path = os.path.join(CWD, "data", "KS101SC.csv")
+usual_pop_path = di.PATHS.data("KS101SC.csv")
 sc_usual_pop = di.read_usual_pop_scotland(usual_pop_path)
 
-# getting path for .shp file for LA's
-uk_la_path = di.get_shp_abs_path(dir=os.path.join(os.getcwd(),
-                                                  "data",
-                                                  "LA_shp",
-                                                  boundary_year))
-
-# getting the coordinates for all LA's
-uk_la_file = di.geo_df_from_geospatialfile(path_to_file=uk_la_path)
-sc_la_file = uk_la_file[uk_la_file["LAD21CD"].str[0].isin(['S'])]
+# getting the dissolved polygons for all LA's, built once per boundary year
+la_store, la_lookup = di.get_la_polygon_store(boundary_year)
+sc_la_file = la_store[la_store.index.str.startswith('S')]
 
 # Get population weighted centroids into a dataframe
 sc_pop_wtd_centr_df = (di.geo_df_from_geospatialfile
@@ -76,13 +69,15 @@ pwc_with_pop = pd.merge(left=sc_usual_pop,
                         how="left")
 
 # OA to LA lookup
-oa_to_la_lookup_path = os.path.join(CWD, "data", "oa_la_mapping",
-                                    "scotland", boundary_year,
-                                    "PCD_OA_LSOA_MSOA_LAD_NOV21_UK_LU.csv")
+oa_to_la_lookup_path = di.PATHS.data("oa_la_mapping",
+                                     "scotland", boundary_year,
+                                     "PCD_OA_LSOA_MSOA_LAD_NOV21_UK_LU.csv")
 
 # reads in the OA to LA lookupfile
-oa_to_la = pd.read_csv(oa_to_la_lookup_path, encoding="ISO-8859-1",
-                       usecols=["oa11cd", "ladnm"])
+oa_to_la = di._read_csv(oa_to_la_lookup_path,
+                        "PCD_OA_LSOA_MSOA_LAD_NOV21_UK_LU",
+                        usecols=["oa11cd", "ladnm"],
+                        encoding="ISO-8859-1")
 
 # dedeup OA to LA as original data includes postcodes etc..
 oa_to_la_deduped = oa_to_la.drop_duplicates(subset="oa11cd")
@@ -95,8 +90,8 @@ pwc_with_pop_with_la = pd.merge(left=pwc_with_pop,
                                 how="left")
 
 # read in urban/rural classification
-urb_rur_path = os.path.join(CWD, "data", "urban_rural", "scotland",
-                            "oa2011_urban_rural_2013_2014.csv")
+urb_rur_path = di.PATHS.data("urban_rural", "scotland",
+                             "oa2011_urban_rural_2013_2014.csv")
 
 urb_rur = di.read_urb_rur_class_scotland(urb_rur_path)
 
@@ -114,9 +109,8 @@ pwc_with_pop_with_la.rename(
     inplace=True)
 
 # Read disability data for disaggregations later
-disability_df = pd.read_csv(os.path.join(CWD,
-                                         "data", "disability_status",
-                                         "QS303_scotland.csv"))
+disability_df = pd.read_csv(di.PATHS.data("disability_status",
+                                          "QS303_scotland.csv"))
 # drop the column "geography code" as it seems to be a duplicate of "geography"
 # also "All categories: Long-term health problem or disability" is not needed,
 # nor is "date" as we know estimates are for 2011.
@@ -135,7 +129,7 @@ replacements = {
 disability_df.rename(columns=replacements, inplace=True)
 
 # age variable
-age_scotland_path = os.path.join(CWD, "data", "QS103_scotland_age.csv")
+age_scotland_path = di.PATHS.data("QS103_scotland_age.csv")
 
 age_scotland_df = di.read_scottish_age(age_scotland_path)
 
@@ -177,10 +171,7 @@ for local_auth in sc_auth:
     print(f"Processing: {local_auth}")
 
     # Get a polygon of la based on the Location Code
-    la_poly = (gs.get_polygons_of_loccode(
-        geo_df=sc_la_file,
-        dissolveby="LAD21NM",
-        search=local_auth))
+    la_poly = gs.get_la_polygon(la_store, la_lookup, local_auth)
 
     # Creating a Geo Dataframe of only stops in la
     la_stops_geo_df = (gs.find_points_in_poly
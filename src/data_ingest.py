@@ -2,38 +2,147 @@
 import os
 import re
 import json
+import hashlib
+import logging
+import importlib.util
+import operator
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
 from functools import lru_cache, reduce
-from time import perf_counter
+from time import perf_counter, sleep
 import yaml
 from datetime import datetime
+from urllib.parse import quote, urlparse
 
 # Third party imports for this module
 import geopandas as gpd
 import pandas as pd
 import requests
-from shapely.geometry import Point
+from pyproj import CRS, Transformer
 from zipfile import ZipFile
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
 import pyarrow.feather as feather
-from typing import List, Dict, Optional, Union
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple, Union
 import numpy as np
 
+# Create logger
+logger = logging.getLogger(__name__)
+
 # Defining Custom Types
 PathLike = Union[str, bytes, os.PathLike]
 
 # Config
-CWD = os.getcwd()
+# The project root is taken once, from SDG_PROJECT_ROOT if set, otherwise
+# the working directory on import. Paths are resolved against it rather
+# than the working directory, which is never changed.
+CWD = os.path.abspath(os.environ.get("SDG_PROJECT_ROOT", os.getcwd()))
 with open(os.path.join(CWD, "config.yaml")) as yamlfile:
     config = yaml.load(yamlfile, Loader=yaml.FullLoader)
     module = os.path.basename(__file__)
     print(f"Config loaded in {module}")
-DATA_DIR = config["data_dir"]
+DEFAULT_CRS = config["default_crs"]
+EXPORT_GEOJSON = config["export_geojson"]
+DOWNLOAD_TIMEOUT = config["download_timeout"]
+DOWNLOAD_RETRIES = config["download_retries"]
+CSV_ENGINE = config["csv_engine"]
+NAPTAN_REFRESH_DAYS = config["naptan_refresh_days"]
+
+# The bus timetable zip, the files used from it and the days before it is
+# downloaded again
+BUS_TIMETABLE_ZIP = "itm_all_gtfs"
+BUS_TIMETABLE_FILES = ["stop_times", "trips", "calendar"]
+BUS_TIMETABLE_MAX_AGE_DAYS = 7
+
+# Metadata of files keyed by absolute path, see _file_meta
+_FILE_META_CACHE: Dict[str, Dict] = {}
+_FILE_META_LOCK = threading.Lock()
+
+
+class ProjectPaths:
+    """Resolves absolute paths in the project and its data directory.
+
+    The data loaders build every path through the PATHS instance of this
+    class, so they never depend on, or change, the working directory of
+    the process. Use configure_paths to point them at another project.
+
+    Args:
+        root (PathLike): path/to/the/project/root.
+        data_dir (PathLike): the data directory, relative to root or
+            absolute.
+    """
+
+    def __init__(self, root: PathLike, data_dir: PathLike):
+        self.root = os.path.abspath(root)
+        self.data_dir = self.resolve(data_dir)
+
+    def resolve(self, path: PathLike) -> str:
+        """Makes a path absolute, treating relative paths as relative to
+        the project root.
+
+        Args:
+            path (PathLike): the path to resolve.
+
+        Returns:
+            str: the absolute path.
+        """
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def data(self, *parts: str) -> str:
+        """Makes an absolute path inside the data directory.
+
+        Args:
+            parts (str): folder name(s) and file name within data_dir.
+
+        Returns:
+            str: the absolute path.
+        """
+        return os.path.join(self.data_dir, *parts)
+
+
+PATHS = ProjectPaths(CWD, config["data_dir"])
+
+
+def configure_paths(root: PathLike,
+                    data_dir: Optional[PathLike] = None) -> ProjectPaths:
+    """Sets the project root (and optionally the data directory) used to
+    resolve all paths in this module.
+
+    Args:
+        root (PathLike): path/to/the/project/root.
+        data_dir (PathLike, optional): the data directory, relative to root
+            or absolute. Defaults to data_dir in the config.
+
+    Returns:
+        ProjectPaths: the new resolver.
+    """
+    global PATHS
+    PATHS = ProjectPaths(root, data_dir or config["data_dir"])
+    return PATHS
+
+
+# Arrow types for the pandas dtypes used in the config dtype maps
+ARROW_TYPES = {"str": pa.string(),
+               "object": pa.string(),
+               "category": pa.dictionary(pa.int32(), pa.string()),
+               "bool": pa.bool_(),
+               "int8": pa.int8(),
+               "int16": pa.int16(),
+               "int32": pa.int32(),
+               "int64": pa.int64(),
+               "float32": pa.float32(),
+               "float64": pa.float64()}
 
 
 def any_to_pd(file_nm: str,
               zip_link: str,
               ext_order: List,
               dtypes: Optional[Dict],
-              data_dir=DATA_DIR) -> pd.DataFrame:
+              data_dir: Optional[PathLike] = None) -> pd.DataFrame:
     """A function which ties together many other data ingest related functions
     to import data.
 
@@ -44,7 +153,10 @@ def any_to_pd(file_nm: str,
     files and get that data into a dataframe for further processing.
 
     Each time the function checks for download/extracted data so it
-    doesn't have to go through the process again.
+    doesn't have to go through the process again. It is safe to call from
+    several threads or processes at once: persistent files are written to
+    a temporary file and renamed into place, and each call downloads to a
+    zip of its own.
 
     Firstly the function checks for a feather file and loads that if
     available.
@@ -57,8 +169,8 @@ def any_to_pd(file_nm: str,
 
     If a zip file is not available locally it falls back to downloading
     the zip file (which could contains other un-needed datasets)
-    then extracts the specified/needed data set (csv) and deletes the
-    now un-needed zip file.
+    then reads the specified/needed data set (csv) straight from the zip,
+    writes it to feather and deletes the now un-needed zip file.
 
     This function should be used in place of pd.read_csv for example.
 
@@ -67,13 +179,14 @@ def any_to_pd(file_nm: str,
         zip_link (str): URL containing zipped data.
         ext_order (list): The order in which to try extraction methods.
         dtypes (Optional[Dict]): Datatypes of columns in the csv.
+        data_dir (PathLike, optional): directory of the persistent files,
+            relative to the project root or absolute. Defaults to the data
+            directory.
 
     Returns:
         pd.DataFrame: A dataframe of the data that has been imported.
     """
-    # Change directory into project root
-    os.chdir(CWD)
-
+    data_dir = PATHS.resolve(data_dir) if data_dir else PATHS.data_dir
     # Make the load order (lists are ordered) to prioritise
     load_order = [f"{file_nm}.{ext}" for ext in ext_order]
     # make a list of functions that apply to these files
@@ -91,35 +204,56 @@ def any_to_pd(file_nm: str,
         if _persistent_exists(data_file_path):
             # Check if each persistent file exists
             # load the persistent file by dispatching the correct function
-            if dtypes and ext_order[i] == "csv":
-                pd_df = load_funcs[ext_order[i]](file_nm,
-                                                 data_file_path,
-                                                 dtypes=dtypes)
-            else:
-                pd_df = load_funcs[ext_order[i]](file_nm,
-                                                 data_file_path)
+            try:
+                if dtypes and ext_order[i] in ("csv", "zip"):
+                    pd_df = load_funcs[ext_order[i]](file_nm,
+                                                     data_file_path,
+                                                     dtypes=dtypes)
+                else:
+                    pd_df = load_funcs[ext_order[i]](file_nm,
+                                                     data_file_path)
+            except FileNotFoundError:
+                if _persistent_exists(data_file_path):
+                    raise
+                # Another call has read and deleted it (e.g. a zip, once
+                # its feather is written), so start from the top again
+                return any_to_pd(file_nm, zip_link, ext_order, dtypes,
+                                 data_dir)
             return pd_df
         continue  # None of the persistent files has been found.
     # Continue onto the next file type
-    # A zip must be downloaded, extracted, and turned into pd_df
-    pd_df = load_funcs[ext_order[i]](file_nm,
-                                     data_file_path,
-                                     persistent_exists=False,
-                                     zip_url=zip_link,
-                                     dtypes=dtypes)
+    # A zip must be downloaded and its csv read into pd_df
+    zip_path = _make_data_path(data_dir, f"{file_nm}.zip")
+    pd_df = load_funcs["zip"](file_nm,
+                              zip_path,
+                              persistent_exists=False,
+                              zip_url=zip_link,
+                              dtypes=dtypes)
     return pd_df
 
 
-def _feath_to_df(file_nm: str, feather_path: PathLike) -> pd.DataFrame:
+def _feath_to_df(file_nm: str,
+                 feather_path: PathLike,
+                 columns: Optional[List[str]] = None,
+                 memory_map: bool = False) -> pd.DataFrame:
     """Feather reading function used by the any_to_pd function.
 
+    With memory_map the file is mapped rather than read into memory, so
+    uncompressed numeric columns are handed to pandas without a copy and
+    only take up resident memory when they are accessed. Compressed feather
+    files can still be mapped but have to be decompressed on reading.
+
     Args:
         file_nm (str): the name of the file without extension.
-        feather_path (PathLike): the path/to/the/featherfile.
+        feather_path (PathLike): the path/to/the/featherfile, or its
+            directory, relative to the project root or absolute.
+        columns (list, optional): Columns to read. Defaults to all columns.
+        memory_map (bool, optional): Memory map the file. Defaults to False.
 
     Returns:
         pd.DataFrame: Pandas dataframe read from the persistent feather file.
     """
+    feather_path = PATHS.resolve(feather_path)
     print(f"Reading {file_nm}.feather from {feather_path}.")
     # check if supplied path is a directory or a file
     if os.path.isdir(feather_path):
@@ -127,7 +261,12 @@ def _feath_to_df(file_nm: str, feather_path: PathLike) -> pd.DataFrame:
         feather_path = os.path.join(feather_path, f"{file_nm}.feather")
     # Time the read
     tic = perf_counter()
-    pd_df = pd.read_feather(feather_path)
+    table = feather.read_table(feather_path,
+                               columns=columns,
+                               memory_map=memory_map,
+                               use_threads=True)
+    # split_blocks stops pandas consolidating (and so copying) the columns
+    pd_df = table.to_pandas(split_blocks=memory_map)
     toc = perf_counter()
     print(f"""Time taken for {file_nm}.feather
           reading is {toc - tic:.2f} seconds""")
@@ -160,15 +299,7 @@ def _csv_to_df(
         pd.DataFrame
     """
     print(f"Reading {file_nm}.csv from {csv_path}.")
-    if dtypes:
-        cols = list(dtypes.keys())
-        tic = perf_counter()
-        pd_df = pd.read_csv(csv_path, usecols=cols,
-                            dtype=dtypes, encoding_errors="ignore")
-        toc = perf_counter()
-        print(f"Time taken for csv reading is {toc - tic:.2f} seconds")
-    else:
-        pd_df = pd.read_csv(csv_path)
+    pd_df = _read_csv(csv_path, file_nm, dtypes)
     # Calling the pd_to_feather function to make a persistent feather file
     # for faster retrieval
     _pd_to_feather(pd_df, csv_path)
@@ -178,9 +309,14 @@ def _csv_to_df(
 def _import_extract_delete_zip(file_nm: str, zip_path: PathLike,
                                persistent_exists=True,
                                zip_url=None,
-                               *cols,
-                               **dtypes) -> pd.DataFrame:
-    """Downloads and opens zip file, extracts contents, deletes zip.
+                               dtypes: Optional[Dict] = None
+                               ) -> pd.DataFrame:
+    """Downloads and opens zip file, reads the csv straight out of it,
+    deletes zip.
+
+    The csv is not extracted to disk. It is streamed from the zip into the
+    csv parser and the dataframe is written to feather next to the zip, so
+    the next call of any_to_pd can load the feather instead.
 
     Subfunc of any_to_pd.
 
@@ -191,22 +327,275 @@ def _import_extract_delete_zip(file_nm: str, zip_path: PathLike,
             _persistent_exists function. Defaults to True.
         zip_url (str, optional): URL for the zip resource if it is to be
             downloaded. Defaults to None.
+        dtypes (Optional[Dict]): Datatypes of columns in the csv.
+            Defaults to None.
 
     Returns:
         pd.DataFrame: dataframe of the data from the CSV
     """
     if not persistent_exists:
-        # checking if a persistent zip exists to save downloading
+        # Download to a zip of this call's own, so concurrent calls never
+        # write to, or delete, each other's download
+        zip_path = _tmp_path(zip_path)
         _grab_zip(file_nm, zip_url, zip_path)
 
     csv_nm = file_nm + ".csv"
-    csv_path = _make_data_path("data", csv_nm)
-    _extract_zip(file_nm, csv_nm, zip_path, csv_path)
+    with ZipFile(zip_path, 'r') as zip:
+        _check_zip_member(zip, csv_nm, zip_path)
+        print(f"Reading {csv_nm} from {zip_path}")
+        with zip.open(csv_nm) as csv_file:
+            pd_df = _read_csv(csv_file, file_nm, dtypes)
+    _pd_to_feather(pd_df, os.path.join(os.path.dirname(zip_path), file_nm))
     _delete_junk(file_nm, zip_path)
-    pd_df = _csv_to_df(file_nm, csv_path, dtypes)
     return pd_df
 
 
+def _arrow_column_types(dtypes: Dict) -> Dict[str, pa.DataType]:
+    """Translates a pandas dtype map, like naptan_types in the config, into
+    column types for the pyarrow csv reader.
+
+    Categories become dictionary encoded strings, which pyarrow converts
+    to pandas categoricals. Columns with a dtype that has no entry in
+    ARROW_TYPES are read as strings and cast by pandas afterwards.
+
+    Args:
+        dtypes (Dict): Datatypes of columns in the csv.
+
+    Returns:
+        Dict[str, pa.DataType]: Arrow type of each column in dtypes.
+    """
+    return {col: ARROW_TYPES.get(str(dtype), pa.string())
+            for col, dtype in dtypes.items()}
+
+
+def _read_csv(csv_source,
+              file_nm: str,
+              dtypes: Optional[Dict] = None,
+              usecols: Optional[List[str]] = None,
+              encoding: str = "utf8",
+              engine: str = None) -> pd.DataFrame:
+    """Reads a csv with the engine set by csv_engine in the config.
+
+    The pyarrow engine parses the file on all cores, reading only the
+    columns in dtypes (or usecols) with the types from dtypes. If pyarrow
+    cannot parse the file, e.g. it has a value that does not fit its type,
+    the csv is read again with pandas.
+
+    Sub func of _csv_to_df and _import_extract_delete_zip.
+
+    Args:
+        csv_source (PathLike or file-like): path/to/csv_file, or a seekable
+            binary file object such as one from ZipFile.open.
+        file_nm (str): The name of the csv, used in messages.
+        dtypes (Optional[Dict]): Datatypes of columns in the csv.
+            Defaults to None, which reads all columns.
+        usecols (list, optional): Columns to read if dtypes is not given.
+            Defaults to None.
+        encoding (str, optional): Encoding of the csv. Defaults to "utf8".
+        engine (str, optional): "pyarrow" or "pandas". Defaults to the
+            csv_engine in the config.
+
+    Returns:
+        pd.DataFrame
+    """
+    engine = engine or CSV_ENGINE
+    cols = list(dtypes.keys()) if dtypes else usecols
+    tic = perf_counter()
+    if engine == "pyarrow":
+        try:
+            pd_df = _read_csv_pyarrow(csv_source, dtypes, cols, encoding)
+        except pa.ArrowInvalid as err:
+            print(f"pyarrow could not parse {file_nm} ({err}), "
+                  "using pandas")
+            if hasattr(csv_source, "seek"):
+                csv_source.seek(0)
+            engine = "pandas"
+    if engine == "pandas":
+        pd_df = pd.read_csv(csv_source, usecols=cols, dtype=dtypes,
+                            encoding=encoding, encoding_errors="ignore")
+    toc = perf_counter()
+    print(f"Time taken for {file_nm} csv reading with {engine} is "
+          f"{toc - tic:.2f} seconds")
+    return pd_df
+
+
+def _read_csv_pyarrow(csv_source,
+                      dtypes: Optional[Dict],
+                      cols: Optional[List[str]],
+                      encoding: str) -> pd.DataFrame:
+    """Reads a csv with the multithreaded pyarrow csv reader.
+
+    Sub func of _read_csv.
+
+    Args:
+        csv_source (PathLike or file-like): path/to/csv_file or an open
+            binary file object.
+        dtypes (Optional[Dict]): Datatypes of columns in the csv.
+        cols (Optional[List[str]]): Columns to read, None for all.
+        encoding (str): Encoding of the csv.
+
+    Returns:
+        pd.DataFrame
+    """
+    column_types = _arrow_column_types(dtypes) if dtypes else None
+    convert_options = pa_csv.ConvertOptions(include_columns=cols,
+                                            column_types=column_types)
+    read_options = pa_csv.ReadOptions(use_threads=True, encoding=encoding)
+    table = pa_csv.read_csv(csv_source,
+                            read_options=read_options,
+                            convert_options=convert_options)
+    pd_df = table.to_pandas()
+    if dtypes:
+        # Cast any columns that were read as strings for want of an
+        # arrow type
+        to_cast = {col: dtype for col, dtype in dtypes.items()
+                   if str(dtype) not in ARROW_TYPES}
+        pd_df = pd_df.astype(to_cast)
+    return pd_df
+
+
+def read_in_batches(file_path: PathLike,
+                    dtypes: Dict,
+                    block_size: int = 64 * 2**20,
+                    encoding: str = "utf8") -> Iterator[pd.DataFrame]:
+    """Reads the columns in dtypes from a csv or feather file a batch of
+    rows at a time, so the whole file never has to be in memory.
+
+    Csv files are parsed by pyarrow in blocks of block_size bytes, with
+    the types from dtypes. Feather files are memory mapped and read one
+    record batch at a time, in the types they were saved with. Columns
+    that were not saved in a feather file are left out.
+
+    Args:
+        file_path (PathLike): path/to/the/file.csv (or .txt) or .feather.
+        dtypes (Dict): Datatypes of the columns to read.
+        block_size (int, optional): Bytes of csv parsed per batch.
+            Defaults to 64MB.
+        encoding (str, optional): Encoding of the csv. Defaults to "utf8".
+
+    Yields:
+        pd.DataFrame: the next batch of rows, in file order.
+    """
+    cols = list(dtypes.keys())
+    print(f"Reading {file_path} in batches")
+    if os.path.splitext(file_path)[1] == ".feather":
+        with pa.memory_map(str(file_path)) as source:
+            reader = pa.ipc.open_file(source)
+            cols = [col for col in cols if col in reader.schema.names]
+            for batch_no in range(reader.num_record_batches):
+                yield reader.get_batch(batch_no).select(cols).to_pandas()
+        return
+    read_options = pa_csv.ReadOptions(use_threads=True,
+                                      block_size=block_size,
+                                      encoding=encoding)
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=cols,
+        column_types=_arrow_column_types(dtypes))
+    with pa_csv.open_csv(file_path,
+                         read_options=read_options,
+                         convert_options=convert_options) as reader:
+        for batch in reader:
+            yield batch.to_pandas()
+
+
+def _feather_columns(feather_path: PathLike) -> List[str]:
+    """Gets the names of the columns saved in a feather file, without
+    reading them.
+
+    Args:
+        feather_path (PathLike): path/to/the/file.feather.
+
+    Returns:
+        List[str]: the column names.
+    """
+    with pa.memory_map(str(feather_path)) as source:
+        return pa.ipc.open_file(source).schema.names
+
+
+def write_batches_to_feather(batches: Iterable[pd.DataFrame],
+                             feather_path: PathLike
+                             ) -> Iterator[pd.DataFrame]:
+    """Writes batches of rows to a feather file as they are passed on, so a
+    file read a batch at a time (see read_in_batches) can be saved with
+    extra columns in the same pass.
+
+    Categorical columns are written as one dictionary for the whole file,
+    which grows as new categories are seen, so the feather reads back
+    with the same categories as one written from the whole dataframe.
+    The feather is written to a temporary file and only replaces
+    feather_path once every batch has been written.
+
+    Args:
+        batches (Iterable[pd.DataFrame]): batches of rows, all with the
+            same columns and dtypes.
+        feather_path (PathLike): path/to/the/file.feather.
+
+    Yields:
+        pd.DataFrame: each batch, once it has been written.
+    """
+    tmp_path = _tmp_path(feather_path)
+    categories = {}
+    schema = writer = None
+    try:
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            for batch in batches:
+                arrays = []
+                for col in batch.columns:
+                    values = batch[col]
+                    if isinstance(values.dtype, pd.CategoricalDtype):
+                        # Add any new categories to the end of the file's
+                        # dictionary, so each batch only writes a delta
+                        known = categories.get(col, pd.Index([]))
+                        known = known.append(values.cat.categories
+                                             .difference(known, sort=False))
+                        categories[col] = known
+                        codes = known.get_indexer(values.cat.categories)
+                        codes = np.append(codes, -1)[values.cat.codes]
+                        arrays.append(pa.DictionaryArray.from_arrays(
+                            pa.array(codes, pa.int32(), mask=codes < 0),
+                            pa.array(known)))
+                    else:
+                        # Typed like the first batch, in case of a batch
+                        # of nulls
+                        arrays.append(pa.Array.from_pandas(
+                            values,
+                            type=None if schema is None
+                            else schema.field(col).type))
+                record_batch = pa.RecordBatch.from_arrays(
+                    arrays, names=list(batch.columns))
+                if writer is None:
+                    schema = record_batch.schema
+                    options = pa.ipc.IpcWriteOptions(
+                        emit_dictionary_deltas=True)
+                    writer = pa.ipc.new_file(sink, schema, options=options)
+                writer.write_batch(record_batch)
+                yield batch
+            if writer is not None:
+                writer.close()
+        if writer is not None:
+            print(f"Saved batches to feather at {feather_path}")
+            os.replace(tmp_path, feather_path)
+            _invalidate_file_meta(feather_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _check_zip_member(zip: ZipFile, csv_nm: str, zip_path: PathLike):
+    """Checks that a file is in an open zip file.
+
+    Args:
+        zip (ZipFile): the open zip file.
+        csv_nm (str): the name of the file expected inside the zip file.
+        zip_path (PathLike): path/to/local/zip/file.zip, for the message.
+
+    Raises:
+        FileNotFoundError: If csv_nm is not in the zip file.
+    """
+    if csv_nm not in zip.namelist():
+        raise FileNotFoundError(f"{csv_nm} not found in {zip_path}")
+
+
 def _grab_zip(file_nm: str, zip_link, zip_path: PathLike):
     """Used by _import_extract_delete_zip function to download
     a zip file from the URI specified in the the zip_link
@@ -219,10 +608,302 @@ def _grab_zip(file_nm: str, zip_link, zip_path: PathLike):
     """
     # Grab the zipfile from URI
     print(f"Downloading {file_nm} from {zip_link}")
-    r = requests.get(zip_link)
-    with open(zip_path, 'wb') as output_file:
-        print(f"Saving {file_nm} to {zip_path}")
-        output_file.write(r.content)
+    print(f"Saving {file_nm} to {zip_path}")
+    _download_file(zip_link, zip_path)
+
+
+@lru_cache
+def _get_session() -> requests.Session:
+    """Makes the requests session shared by all downloads, so connections
+    to the same host are pooled and reused.
+
+    Returns:
+        requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=8,
+                                            pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _resume_validator(response_headers) -> Optional[str]:
+    """Gets the value to send as If-Range when resuming a download: the
+    ETag of the file, or its Last-Modified date if it has no strong ETag.
+
+    Sub function of _download_file.
+
+    Args:
+        response_headers: headers of the response with the whole file.
+
+    Returns:
+        Optional[str]: the validator, or None if the server gave neither.
+    """
+    etag = response_headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response_headers.get("Last-Modified")
+
+
+def _download_file(url: str,
+                   file_path: PathLike,
+                   expected_size: Optional[int] = None,
+                   sha256: Optional[str] = None,
+                   session: Optional[requests.Session] = None,
+                   chunk_size: int = 2**20,
+                   headers: Optional[Dict] = None) -> Optional[Dict]:
+    """Downloads a file by streaming it in chunks to a temporary .part file,
+    which is renamed to file_path once the download is complete.
+
+    If the connection drops, the download is resumed from the end of the
+    .part file with an HTTP Range request, and a .part file left by an
+    earlier run is resumed in the same way. The ETag (or Last-Modified) of
+    the file is kept in a .part.etag file next to it and sent as If-Range,
+    so if the file has changed on the server since the .part file was
+    started, the server sends the whole new file instead. If the server
+    answers with the whole file, rather than 206 Partial Content, the
+    download restarts from the beginning. A .part file without a saved
+    ETag can't be checked, so it is started again. The size of the file
+    is checked against expected_size, or the size reported by the server,
+    and its sha256 against the sha256 argument if given.
+
+    Conditional request headers, such as If-None-Match, can be passed in
+    headers. If the server answers 304 Not Modified nothing is written.
+
+    Args:
+        url (str): URL of the file to download.
+        file_path (PathLike): path/to/the/downloaded/file.
+        expected_size (int, optional): Size of the file in bytes.
+            Defaults to the size reported by the server.
+        sha256 (str, optional): Expected sha256 hex digest of the file.
+            Defaults to None, which skips the check.
+        session (requests.Session, optional): Session to download with.
+            Defaults to the shared session from _get_session.
+        chunk_size (int, optional): Bytes written per chunk.
+            Defaults to 1 MiB.
+        headers (Dict, optional): Extra request headers. Defaults to None.
+
+    Raises:
+        ValueError: If the size or checksum of the download is wrong.
+
+    Returns:
+        Optional[Dict]: the headers of the (last) response, or None if the
+            server answered 304 Not Modified.
+    """
+    session = session or _get_session()
+    part_path = f"{file_path}.part"
+    etag_path = f"{part_path}.etag"
+    validator = None
+    if os.path.exists(etag_path):
+        with open(etag_path) as etag_file:
+            validator = etag_file.read() or None
+    response_headers = {}
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        pos = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request_headers = dict(headers or {})
+        if pos and validator:
+            request_headers["Range"] = f"bytes={pos}-"
+            request_headers["If-Range"] = validator
+        try:
+            with session.get(url, headers=request_headers, stream=True,
+                             timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status_code == 304:
+                    return None
+                response_headers = dict(r.headers)
+                if r.status_code == 416:
+                    # Nothing left to fetch, the .part file is complete
+                    break
+                r.raise_for_status()
+                if r.status_code == 206:
+                    # Content-Range is "bytes start-end/total"
+                    total = r.headers.get("Content-Range", "").split("/")[-1]
+                    mode = "ab"
+                else:
+                    # A full response, so start the file again and keep
+                    # what identifies this version of it for resuming
+                    total = r.headers.get("Content-Length")
+                    mode = "wb"
+                    validator = _resume_validator(r.headers)
+                    with open(etag_path, 'w') as etag_file:
+                        etag_file.write(validator or "")
+                if expected_size is None and total and total.isdigit():
+                    expected_size = int(total)
+                with open(part_path, mode) as part_file:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        part_file.write(chunk)
+            break
+        except (requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as err:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            print(f"Download of {url} interrupted ({err}), resuming "
+                  f"(attempt {attempt + 1} of {DOWNLOAD_RETRIES})")
+            sleep(2 ** attempt)
+
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        os.remove(part_path)
+        raise ValueError(f"Downloaded {size} bytes from {url}, "
+                         f"expected {expected_size}")
+    if sha256 is not None and _file_sha256(part_path) != sha256.lower():
+        os.remove(part_path)
+        raise ValueError(f"Checksum of the download from {url} does not "
+                         "match")
+    os.replace(part_path, file_path)
+    _invalidate_file_meta(file_path)
+    return response_headers
+
+
+def _config_downloads() -> List[Dict]:
+    """Lists the remote datasets in the config with the local paths the
+    pipelines expect to find them at.
+
+    Each dataset is only listed if the pipeline that uses it would
+    download it too: the RUC and NI stop files if they are not on disk
+    yet, and the bus timetable zip if bus_timetable_is_due and there is
+    not a fresh zip already. The NaPTAN stops are left to get_stops_file,
+    which checks the API for changes itself.
+
+    Returns:
+        List[Dict]: the "name", "url" and "path" of each download.
+    """
+    bus_dir = PATHS.data("england_bus_timetable")
+    bus_zip_path = os.path.join(bus_dir, BUS_TIMETABLE_ZIP)
+    downloads = [
+        {"name": "urb_rur",
+         "url": config["urb_rur_zip_link"],
+         "path": PATHS.data("RUC11_OA11_EW.zip"),
+         "due": not any(_file_meta(path) is not None
+                        for path in [PATHS.data("RUC11_OA11_EW.zip"),
+                                     PATHS.data("RUC11_OA11_EW.feather"),
+                                     PATHS.data("RUC11_OA11_EW.csv")])},
+        {"name": "eng_bus_timetable",
+         "url": config["eng_bus_timetable_data"],
+         "path": bus_zip_path,
+         "due": (bus_timetable_is_due(bus_dir)
+                 and (_file_meta(bus_zip_path) is None
+                      or best_before(bus_zip_path,
+                                     BUS_TIMETABLE_MAX_AGE_DAYS)))},
+        {"name": "NI_bus_stops",
+         "url": config["NI_bus_stops_data"],
+         "path": PATHS.data("stops", "NI", "bus_stops_ni.csv")},
+        {"name": "NI_train_stops",
+         "url": config["NI_train_stops_data"],
+         "path": PATHS.data("stops", "NI", "train_stops_ni.csv")},
+    ]
+    return [{key: value for key, value in download.items() if key != "due"}
+            for download in downloads
+            if download.get("due", _file_meta(download["path"]) is None)]
+
+
+def _scheduled_download(download: Dict,
+                        host_limits: Dict[str, threading.Semaphore]
+                        ) -> Dict:
+    """Downloads one entry of the download manifest, retrying with
+    exponential backoff on server errors or a bad download.
+
+    Dropped connections are already resumed by _download_file. At most
+    download_per_host downloads run against the same host at once.
+
+    Sub function of download_all, run in a worker thread.
+
+    Args:
+        download (Dict): the "name", "url" and "path" of the download.
+        host_limits (Dict): a semaphore for each host in the manifest.
+
+    Returns:
+        Dict: the manifest entry, with the size, sha256 and time of the
+            download, or the error if it failed.
+    """
+    entry = {"url": download["url"], "path": download["path"]}
+    host = urlparse(download["url"]).netloc
+    os.makedirs(os.path.dirname(download["path"]), exist_ok=True)
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            with host_limits[host]:
+                print(f"Downloading {download['name']} from "
+                      f"{download['url']}")
+                _download_file(download["url"], download["path"])
+            break
+        except (requests.RequestException, ValueError) as err:
+            status = getattr(getattr(err, "response", None),
+                             "status_code", None)
+            # Client errors will not go away by retrying
+            retry = status is None or status >= 500
+            if not retry or attempt == DOWNLOAD_RETRIES:
+                print(f"Download of {download['name']} failed: {err}")
+                entry["error"] = str(err)
+                return entry
+            sleep(2 ** attempt)
+    entry["size"] = _file_meta(download["path"])["size"]
+    entry["sha256"] = _file_sha256(download["path"])
+    entry["downloaded_at"] = datetime.now().isoformat(timespec="seconds")
+    return entry
+
+
+def download_all(downloads: List[Dict],
+                 manifest_path: Optional[PathLike] = None,
+                 max_workers: Optional[int] = None,
+                 per_host: Optional[int] = None) -> Dict[str, Dict]:
+    """Downloads a list of datasets concurrently.
+
+    The downloads run in a bounded thread pool, with at most per_host of
+    them fetching from the same host at once. A download that fails does
+    not stop the others; its error is recorded in the manifest instead.
+
+    The manifest, with the url, path, size, sha256 and download time of
+    each dataset, is merged into the JSON file at manifest_path.
+
+    Args:
+        downloads (List[Dict]): the "name", "url" and "path" of each
+            download, e.g. from _config_downloads.
+        manifest_path (PathLike, optional): path/to/the/manifest.json.
+            Defaults to data/downloads_manifest.json.
+        max_workers (int, optional): Number of download threads. Defaults
+            to download_workers in the config.
+        per_host (int, optional): Number of downloads at once from one
+            host. Defaults to download_per_host in the config.
+
+    Returns:
+        Dict[str, Dict]: manifest entry of each download, keyed by name.
+    """
+    manifest_path = manifest_path or PATHS.data("downloads_manifest.json")
+    max_workers = max_workers or config["download_workers"]
+    per_host = per_host or config["download_per_host"]
+    host_limits = {urlparse(download["url"]).netloc:
+                   threading.Semaphore(per_host)
+                   for download in downloads}
+    manifest = {}
+    if downloads:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            entries = pool.map(_scheduled_download,
+                               downloads,
+                               repeat(host_limits))
+            for download, entry in zip(downloads, entries):
+                manifest[download["name"]] = entry
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            saved_manifest = json.load(manifest_file)
+    else:
+        saved_manifest = {}
+    saved_manifest.update(manifest)
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(saved_manifest, manifest_file, indent=2)
+    return manifest
+
+
+def prefetch_downloads() -> Dict[str, Dict]:
+    """Downloads every remote dataset in the config that is not on disk
+    yet, concurrently, so the pipelines start with their inputs in place.
+
+    Returns:
+        Dict[str, Dict]: manifest entry of each download, keyed by name.
+    """
+    return download_all(_config_downloads())
 
 
 def _extract_zip(
@@ -240,14 +921,26 @@ def _extract_zip(
         zip_path (PathLike): path/to/local/zip/file.zip.
         csv_path (PathLike): The path where the csv should be
             written to, e.g. /data/.
+
+    Raises:
+        FileNotFoundError: If csv_nm is not in the zip file.
     """
-    # Open the zip file and extract
+    # Open the zip file and extract, via a temporary file so that a half
+    # extracted csv is never read
+    target_path = os.path.join(csv_path, csv_nm)
+    tmp_path = _tmp_path(target_path)
     with ZipFile(zip_path, 'r') as zip:
+        _check_zip_member(zip, csv_nm, zip_path)
         print(f"Extracting {csv_nm} from {zip_path}")
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
         try:
-            _ = zip.extract(csv_nm, csv_path)
-        except BaseException:
-            csv_nm
+            with zip.open(csv_nm) as member, open(tmp_path, 'wb') as out:
+                shutil.copyfileobj(member, out, 2**20)
+            os.replace(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    _invalidate_file_meta(target_path)
 
 
 def _delete_junk(file_nm: str, zip_path: PathLike):
@@ -261,12 +954,19 @@ def _delete_junk(file_nm: str, zip_path: PathLike):
     """
     # Delete the zipfile as it's uneeded now
     print(f"Deleting {file_nm} from {zip_path}")
-    os.remove(zip_path)
+    try:
+        os.remove(zip_path)
+    except FileNotFoundError:
+        # Already deleted by another reader
+        pass
+    except PermissionError:
+        # Still open elsewhere (on Windows), so leave it for next time
+        print(f"{zip_path} is in use, not deleted")
+    _invalidate_file_meta(zip_path)
 
 
-@lru_cache
 def _make_data_path(*data_dir_files: str) -> PathLike:
-    """Makes a relative path pointing to the data directory.
+    """Makes an absolute path pointing into the project.
 
     This was created to avoid repeated using
     os.path.join(somepath, somefile) all over the script.
@@ -280,11 +980,56 @@ def _make_data_path(*data_dir_files: str) -> PathLike:
             filename, suitable for the operating system. Note: PathLike
             has been defined as a custom data type in this script.
     """
-    data_path = os.path.join(*data_dir_files)
+    data_path = PATHS.resolve(os.path.join(*data_dir_files))
     return data_path
 
 
-@lru_cache
+def _file_meta(file_path: PathLike) -> Optional[Dict]:
+    """Gets the cached metadata of a file or directory.
+
+    The file is stat'ed on every call and the cached entry is replaced if
+    its size or modified time has changed, so anything stored in the entry
+    (e.g. the sha256 of the file) always describes the current file.
+    Missing files are never cached, so a file created later in the run is
+    seen straight away. Safe to call from multiple threads.
+
+    Args:
+        file_path (PathLike): path/to/the/file.
+
+    Returns:
+        Optional[Dict]: the "size" and "mtime" (in ns) of the file, plus
+            any cached values, or None if the file does not exist.
+    """
+    # Keyed on the path from the project root, not the working directory
+    key = PATHS.resolve(file_path)
+    try:
+        file_stat = os.stat(key)
+    except FileNotFoundError:
+        _invalidate_file_meta(key)
+        return None
+    stamp = (file_stat.st_size, file_stat.st_mtime_ns)
+    with _FILE_META_LOCK:
+        entry = _FILE_META_CACHE.get(key)
+        if entry is None or (entry["size"], entry["mtime"]) != stamp:
+            entry = {"size": stamp[0], "mtime": stamp[1]}
+            _FILE_META_CACHE[key] = entry
+        return entry
+
+
+def _invalidate_file_meta(file_path: Optional[PathLike] = None):
+    """Drops the cached metadata of a file, e.g. after writing it, or of
+    all files if no path is given.
+
+    Args:
+        file_path (PathLike, optional): path/to/the/file. Defaults to None.
+    """
+    with _FILE_META_LOCK:
+        if file_path is None:
+            _FILE_META_CACHE.clear()
+        else:
+            _FILE_META_CACHE.pop(PATHS.resolve(file_path), None)
+
+
 def _persistent_exists(persistent_path):
     """Checks if a persistent file or directory already exists or not.
 
@@ -294,18 +1039,29 @@ def _persistent_exists(persistent_path):
     Returns:
         bool: True if a persistent file or directory already exists.
     """
-    # Change directory into project root
-    os.chdir(CWD)
-
-    if os.path.exists(persistent_path):
-        print(f"{persistent_path} already exists")
+    if _file_meta(persistent_path) is not None:
+        logger.debug(f"{persistent_path} already exists")
         return True
     else:
-        print(f"{persistent_path} does not exist")
+        logger.debug(f"{persistent_path} does not exist")
         return False
 
 
-def _pd_to_feather(pd_df: pd.DataFrame, current_file_path: PathLike):
+def _tmp_path(file_path: PathLike) -> str:
+    """Makes a temporary path next to a file, unique to the process and
+    thread, to write to before renaming it to file_path with os.replace.
+
+    Args:
+        file_path (PathLike): path/to/the/file.
+
+    Returns:
+        str: path/to/the/temporary/file.
+    """
+    return f"{file_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def _pd_to_feather(pd_df: pd.DataFrame, current_file_path: PathLike,
+                   overwrite: bool = False):
     """Used by the any_to_pd function to writes a Pandas dataframe
     to feather for quick reading and retrieval later.
 
@@ -315,19 +1071,45 @@ def _pd_to_feather(pd_df: pd.DataFrame, current_file_path: PathLike):
         pd_df (pd.DataFrame): a pandas dataframe to be converted
         current_file_path (PathLike): The path/to/current_file
             on local machine.
+        overwrite (bool, optional): Replace an existing feather, e.g. one
+            missing a column that has since been added. Defaults to False.
     """
     feather_path = os.path.splitext(current_file_path)[0] + '.feather'
 
-    # TODO: this function should make use of _persistent_existsD
-    if not os.path.isfile(feather_path):
-        print(f"Writing Pandas dataframe to feather at {feather_path}")
-        feather.write_feather(pd_df, feather_path)
-    print("Feather already exists")
+    if not overwrite and _persistent_exists(feather_path):
+        print("Feather already exists")
+        return
+    print(f"Writing Pandas dataframe to feather at {feather_path}")
+    # Uncompressed so that the file can be memory mapped by _feath_to_df
+    _write_feather(pd_df, feather_path, compression="uncompressed")
+
+
+def _write_feather(pd_df: pd.DataFrame, feather_path: PathLike, **kwargs):
+    """Writes a dataframe to feather through a temporary file that is
+    then renamed, so that concurrent readers only ever see a complete
+    feather and a failed write leaves any existing file as it was.
+
+    Args:
+        pd_df (pd.DataFrame): the dataframe to write.
+        feather_path (PathLike): path/to/the/file.feather.
+        kwargs: passed on to feather.write_feather, e.g. compression.
+    """
+    tmp_path = _tmp_path(feather_path)
+    try:
+        feather.write_feather(pd_df, tmp_path, **kwargs)
+        os.replace(tmp_path, feather_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _invalidate_file_meta(feather_path)
 
 
 def geo_df_from_pd_df(pd_df, geom_x, geom_y, crs):
     """Function to create a Geo-dataframe from a Pandas DataFrame.
 
+    The points are returned in the default crs (EPSG:27700), reprojecting
+    them if the supplied crs is different.
+
     Arguments:
         pd_df (pd.DataFrame): a pandas dataframe object to be converted.
         geom_x (str):name of the column that contains the longitude data.
@@ -337,13 +1119,32 @@ def geo_df_from_pd_df(pd_df, geom_x, geom_y, crs):
     Returns:
         Geopandas Dataframe
     """
-    geometry = [Point(xy) for xy in zip(pd_df[geom_x], pd_df[geom_y])]
-    geo_df = gpd.GeoDataFrame(pd_df, geometry=geometry)
-    geo_df.crs = crs
-    geo_df.to_crs('EPSG:27700', inplace=True)
+    # Take the coordinates as arrays so the points are built in bulk
+    x = pd_df[geom_x].to_numpy(dtype=float, na_value=np.nan)
+    y = pd_df[geom_y].to_numpy(dtype=float, na_value=np.nan)
+    # Only reproject if the coordinates are not already in the default crs
+    if not CRS.from_user_input(crs).equals(DEFAULT_CRS):
+        x, y = _get_transformer(crs, DEFAULT_CRS).transform(x, y)
+    geometry = gpd.points_from_xy(x, y, crs=DEFAULT_CRS)
+    geo_df = gpd.GeoDataFrame(pd_df, geometry=geometry, crs=DEFAULT_CRS)
     return geo_df
 
 
+@lru_cache
+def _get_transformer(from_crs: str, to_crs: str) -> Transformer:
+    """Gets a coordinate transformer, which is cached as creating one is
+    slow compared to transforming the points.
+
+    Args:
+        from_crs (str): the coordinate reference system of the input.
+        to_crs (str): the coordinate reference system of the output.
+
+    Returns:
+        Transformer: transformer taking x (longitude/easting) first.
+    """
+    return Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+
 def get_and_save_geo_dataset(url, localpath, filename):
     """Fetches a geodataset in json format from a web resource and
     saves it to the local data/ directory and returns the json
@@ -383,6 +1184,63 @@ def geo_df_from_geospatialfile(path_to_file, crs='epsg:27700'):
     return geo_df
 
 
+def save_geo_df(geo_df: gpd.GeoDataFrame, out_dir: PathLike, file_nm: str):
+    """Saves a geo-dataframe as GeoParquet, which is much quicker to write
+    and read than GeoJSON and keeps the column datatypes.
+
+    A GeoJSON copy is also written if export_geojson is set in the config.
+
+    Args:
+        geo_df (gpd.GeoDataFrame): the geo-dataframe to save.
+        out_dir (PathLike): path/to/the/output/directory, relative to the
+            project root or absolute.
+        file_nm (str): the name of the file without extension.
+    """
+    out_dir = PATHS.resolve(out_dir)
+    parquet_path = os.path.join(out_dir, f"{file_nm}.parquet")
+    print(f"Writing {file_nm} to {parquet_path}")
+    geo_df.to_parquet(parquet_path, index=False)
+    _invalidate_file_meta(parquet_path)
+    if EXPORT_GEOJSON:
+        geojson_path = os.path.join(out_dir, f"{file_nm}.geojson")
+        print(f"Writing {file_nm} to {geojson_path}")
+        geo_df.to_file(geojson_path, driver='GeoJSON', index=False)
+        _invalidate_file_meta(geojson_path)
+
+
+def read_geo_df(out_dir: PathLike,
+                file_nm: str,
+                columns: Optional[List[str]] = None
+                ) -> Optional[gpd.GeoDataFrame]:
+    """Reads a geo-dataframe saved by save_geo_df.
+
+    The GeoParquet file is read with only the columns asked for. If there
+    is no GeoParquet file, an older GeoJSON output is read instead.
+
+    Args:
+        out_dir (PathLike): path/to/the/output/directory, relative to the
+            project root or absolute.
+        file_nm (str): the name of the file without extension.
+        columns (List[str], optional): the columns to read, including the
+            geometry column. Defaults to None, which reads all columns.
+
+    Returns:
+        gpd.GeoDataFrame: the saved data, or None if it does not exist.
+    """
+    out_dir = PATHS.resolve(out_dir)
+    parquet_path = os.path.join(out_dir, f"{file_nm}.parquet")
+    geojson_path = os.path.join(out_dir, f"{file_nm}.geojson")
+    if _persistent_exists(parquet_path):
+        geo_df = gpd.read_parquet(parquet_path, columns=columns)
+    elif _persistent_exists(geojson_path):
+        geo_df = gpd.read_file(geojson_path)
+        if columns is not None:
+            geo_df = geo_df[columns]
+    else:
+        return None
+    return geo_df
+
+
 def capture_region(file_nm: str):
     """Extracts the region name from the ONS population estimate excel files.
 
@@ -398,83 +1256,216 @@ def capture_region(file_nm: str):
     return region
 
 
-def get_whole_nation_pop_df(pop_files, pop_year):
+def _excel_engine() -> Optional[str]:
+    """Picks the engine for reading Excel files.
+
+    The calamine engine is much faster than openpyxl, so it is used when
+    python-calamine is installed and pandas is new enough to support it
+    (2.2 or later).
+
+    Returns:
+        Optional[str]: "calamine", or None to let pandas choose.
+    """
+    pandas_version = tuple(int(v) for v in pd.__version__.split(".")[:2])
+    if (pandas_version >= (2, 2)
+            and importlib.util.find_spec("python_calamine") is not None):
+        return "calamine"
+    return None
+
+
+def _read_region_pop_xls(xls_path: PathLike,
+                         pop_year: str,
+                         engine: Optional[str] = None) -> pd.DataFrame:
+    """Reads the population of one region from its ONS Excel file.
+
+    The workbook is opened once and the Persons, Males and Females sheets
+    are read in the same pass. The male and female totals are then joined
+    onto the persons data by OA11CD.
+
+    Sub function of get_whole_nation_pop_df, can be run in a worker
+    process.
+
+    Args:
+        xls_path (PathLike): path/to/the/regional/population/file.xls.
+        pop_year (str): The year of population estimation data to process.
+        engine (str, optional): engine for pd.read_excel. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Dataframe of population data for the region.
+    """
+    print(f"Reading {xls_path}")
+    persons = f"Mid-{pop_year} Persons"
+    males = f"Mid-{pop_year} Males"
+    females = f"Mid-{pop_year} Females"
+    sheet_dfs = pd.read_excel(xls_path,
+                              sheet_name=[persons, males, females],
+                              header=4,
+                              engine=engine)
+    # Rename the "All Ages" columns appropriately before joining
+    total_pop = sheet_dfs[persons].rename(columns={"All Ages": "pop_count"})
+    males_pop = (sheet_dfs[males].set_index("OA11CD")["All Ages"]
+                 .rename("males_pop"))
+    fem_pop = (sheet_dfs[females].set_index("OA11CD")["All Ages"]
+               .rename("fem_pop"))
+    region_df = (total_pop
+                 .join(males_pop, on="OA11CD", how="inner")
+                 .join(fem_pop, on="OA11CD", how="inner"))
+    return region_df
+
+
+def _pop_store_region_path(pop_year: str, region: str) -> str:
+    """Makes the path of the parquet file for one region of one year in the
+    partitioned population store.
+
+    The store is laid out in hive style, e.g.
+    population_store/pop_year=2019/region=London/part-0.parquet, so the
+    partition values can be read back from the directory names.
+
+    Args:
+        pop_year (str): The year of population estimation data.
+        region (str): The region name, as captured from the Excel filename.
+
+    Returns:
+        str: path/to/the/region/partition/part-0.parquet
+    """
+    return PATHS.data("population_store",
+                      f"pop_year={pop_year}",
+                      f"region={quote(region)}",
+                      "part-0.parquet")
+
+
+def build_pop_store(pop_files: List[str],
+                    pop_year: str,
+                    workers: int = 1) -> List[str]:
+    """Adds the regions of a population year that are not yet in the
+    partitioned population store.
+
+    Only the missing region partitions are built, so a new year, or a
+    region that was added later, is written without touching the rest of
+    the store. With more than one worker the regional Excel files are read
+    in parallel, one worker process per file. Where processes are spawned
+    rather than forked (Windows and macOS), each one imports the calling
+    script again, so the call must then be under
+    `if __name__ == "__main__":`.
+
+    Args:
+        pop_files (list): Regional population Excel file names.
+        pop_year (str): The year of population estimation data to process.
+        workers (int, optional): Number of processes to read the Excel
+            files with, at most one per CPU. Defaults to 1.
+
+    Returns:
+        List[str]: The regions that were added to the store.
+    """
+    pop_year = str(pop_year)
+    # Remove gitkeep file from list of pop files
+    pop_files = [f for f in pop_files if f != '.gitkeep']
+    # Dict of region:file_name. Capture the region name from the filename
+    region_dict = {capture_region(file): file for file in pop_files}
+    missing = [region for region in region_dict
+               if not os.path.exists(_pop_store_region_path(pop_year, region))]
+    if not missing:
+        return []
+    print(f"Adding {len(missing)} regions for {pop_year} to population store")
+    xls_paths = [PATHS.data("population_estimates",
+                            pop_year,
+                            region_dict[region])
+                 for region in missing]
+    engine = _excel_engine()
+    # More processes than files or cores only adds overhead
+    workers = min(workers, len(xls_paths), os.cpu_count() or 1)
+    tic = perf_counter()
+    with (ProcessPoolExecutor(max_workers=workers) if workers > 1
+          else nullcontext()) as pool:
+        # Read the files in this process without a pool
+        pool_map = pool.map if pool is not None else map
+        region_dfs = pool_map(_read_region_pop_xls,
+                              xls_paths,
+                              repeat(pop_year),
+                              repeat(engine))
+        for region, region_df in zip(missing, region_dfs):
+            # Change all column names to str
+            region_df.columns = region_df.columns.astype(str)
+            region_path = _pop_store_region_path(pop_year, region)
+            os.makedirs(os.path.dirname(region_path), exist_ok=True)
+            # Write to a temp file first so a failed write leaves no partition.
+            # Files starting with "_" are skipped when reading the dataset.
+            tmp_path = os.path.join(os.path.dirname(region_path),
+                                    "_part-0.parquet.tmp")
+            region_df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, region_path)
+            _invalidate_file_meta(region_path)
+    toc = perf_counter()
+    print(f"Time taken for building population store is {toc - tic:.2f} "
+          "seconds")
+    return missing
+
+
+def read_pop_store(pop_years: Optional[List[str]] = None,
+                   regions: Optional[List[str]] = None,
+                   columns: Optional[List[str]] = None,
+                   oa_codes: Optional[List[str]] = None) -> pd.DataFrame:
+    """Reads population data from the partitioned population store.
+
+    Only the partitions for the requested years and regions are opened and
+    only the requested columns are read. Filtering on OA codes is pushed
+    down to the parquet reader, so e.g. the age bins of the OAs in a single
+    LA can be loaded without reading the whole nation.
+
+    Args:
+        pop_years (list, optional): Years to read. Defaults to all years.
+        regions (list, optional): Regions to read. Defaults to all regions.
+        columns (list, optional): Columns to read. The pop_year and region
+            partition columns can also be requested. Defaults to all columns.
+        oa_codes (list, optional): OA11CD codes to keep. Defaults to all.
+
+    Returns:
+        pd.DataFrame: Population data for the selected partitions.
+    """
+    partitioning = ds.partitioning(
+        pa.schema([("pop_year", pa.string()), ("region", pa.string())]),
+        flavor="hive")
+    dataset = ds.dataset(PATHS.data("population_store"),
+                         format="parquet",
+                         partitioning=partitioning)
+    filters = []
+    if pop_years is not None:
+        filters.append(ds.field("pop_year").isin([str(y) for y in pop_years]))
+    if regions is not None:
+        filters.append(ds.field("region").isin(regions))
+    if oa_codes is not None:
+        filters.append(ds.field("OA11CD").isin(list(oa_codes)))
+    filter_expr = reduce(operator.and_, filters) if filters else None
+    table = dataset.to_table(columns=columns, filter=filter_expr)
+    return table.to_pandas()
+
+
+def get_whole_nation_pop_df(pop_files, pop_year, columns=None, workers=1):
     """Gets the population data for all regions in the country and
     puts them into one dataframe.
 
+    Any regions of the year that are missing from the partitioned population
+    store are built first, then the year is read from the store.
+
     Args:
         pop_files (list): Population data to be unioned.
         pop_year (str): The year of population estimation data to process.
+        columns (list, optional): Columns to read. Defaults to all columns.
+        workers (int, optional): Number of processes to read any missing
+            regions with, see build_pop_store. Defaults to 1.
 
     Returns:
         pd.DataFrame: Dataframe of population data for all regions
             in the country
     """
-    # Remove gitkeep file from list of pop files
-    pop_files = [f for f in pop_files if f != '.gitkeep']
-    # Dict of region:file_name. Capture the region name from the filename
-    region_dict = {capture_region(file): file for file in pop_files}
-    # make a df of each region then concat
-    national_pop_feather_path = os.path.join(
-        DATA_DIR, f"whole_nation_{pop_year}.feather")
-    if not os.path.exists(national_pop_feather_path):
-        print(f"No national_pop_feather found for {pop_year}")
-        print(f"Rebuilding population file. This will take a while!")
-        region_dfs_dict = {}
-        for region in region_dict:
-            print(f"Reading {region} Excel file")
-            xls_path = os.path.join(
-                DATA_DIR,
-                "population_estimates",
-                str(pop_year),
-                region_dict[region])
-        # Read Excel file as object
-            xlFile = pd.ExcelFile(xls_path)
-        # Access sheets in Excel file
-            total_pop = pd.read_excel(
-                xlFile, f"Mid-{pop_year} Persons", header=4)
-            males_pop = pd.read_excel(
-                xlFile,
-                f"Mid-{pop_year} Males",
-                header=4,
-                usecols=[
-                    "OA11CD",
-                    "LSOA11CD",
-                    "All Ages"])
-            fem_pop = pd.read_excel(
-                xlFile,
-                f"Mid-{pop_year} Females",
-                header=4,
-                usecols=[
-                    "OA11CD",
-                    "LSOA11CD",
-                    "All Ages"])
-        # Rename the "All Ages" columns appropriately before concating
-            total_pop.rename(columns={"All Ages": "pop_count"}, inplace=True)
-            males_pop.rename(columns={"All Ages": "males_pop"}, inplace=True)
-            fem_pop.rename(columns={"All Ages": "fem_pop"}, inplace=True)
-        # Merge the data from different sheets
-            dfs_to_merge = [total_pop, males_pop, fem_pop]
-            df_final = reduce(lambda left, right: pd.merge(
-                left, right, on='OA11CD'), dfs_to_merge)
-        # Store merged df in dict under region name
-            region_dfs_dict[region] = df_final
-    # Concat all regions into national pop df
-        whole_nation_pop_df = pd.concat(region_dfs_dict.values())
-    # Create the pop_year column to show which year the data is from
-        whole_nation_pop_df["pop_year"] = pop_year
-    # Change all column names to str
-        whole_nation_pop_df.columns = whole_nation_pop_df.columns.astype(str)
-    # Write df out to feather for quicker reading
-        print("Writing whole_nation_pop_df.feather")
-        whole_nation_pop_df.reset_index().to_feather(national_pop_feather_path)
-    else:
-        # if it exists, read from a feather for quicker data retreval
-        print(f"Reading whole_nation_pop_df from {national_pop_feather_path}")
-        whole_nation_pop_df = pd.read_feather(national_pop_feather_path)
-    # Temporary TODO: remove this line
-        whole_nation_pop_df.rename(
-            columns={"total_pop": "pop_count"}, inplace=True)
+    build_pop_store(pop_files, pop_year, workers=workers)
+    print(f"Reading {pop_year} population from "
+          f"{PATHS.data('population_store')}")
+    whole_nation_pop_df = read_pop_store(pop_years=[pop_year],
+                                         columns=columns)
+    # The region is only used to partition the store
+    whole_nation_pop_df = whole_nation_pop_df.drop(columns="region",
+                                                   errors="ignore")
     return whole_nation_pop_df
 
 
@@ -500,6 +1491,268 @@ def get_shp_abs_path(dir):
     return absolute_path
 
 
+def _file_sha256(file_path: PathLike, chunk_size=2**20) -> str:
+    """Calculates the sha256 hash of a file, reading it in chunks.
+
+    The hash is kept in the file metadata cache, so it is only
+    recalculated if the size or modified time of the file changes.
+
+    Args:
+        file_path (PathLike): path/to/the/file.
+        chunk_size (int, optional): Bytes read at a time. Defaults to 1MB.
+
+    Returns:
+        str: the hex digest of the file contents.
+    """
+    entry = _file_meta(file_path)
+    if entry is not None and "sha256" in entry:
+        return entry["sha256"]
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    if entry is not None:
+        with _FILE_META_LOCK:
+            entry["sha256"] = digest
+    return digest
+
+
+def _files_fingerprint(file_paths: List[PathLike],
+                       with_hash=False) -> Dict:
+    """Describes files by their size and modified time, and optionally
+    their hashes.
+
+    Args:
+        file_paths (List[PathLike]): paths/to/the/files.
+        with_hash (bool, optional): Whether to hash the files too.
+            Defaults to False.
+
+    Returns:
+        dict: the fingerprint of each file, keyed by file name.
+    """
+    fingerprint = {}
+    for file_path in file_paths:
+        file_meta = _file_meta(file_path)
+        if file_meta is None:
+            raise FileNotFoundError(f"{file_path} does not exist")
+        file_info = {"size": file_meta["size"],
+                     "mtime": file_meta["mtime"]}
+        if with_hash:
+            file_info["sha256"] = _file_sha256(file_path)
+        fingerprint[os.path.basename(file_path)] = file_info
+    return fingerprint
+
+
+def _fingerprint_matches(saved_fingerprint: Dict,
+                         file_paths: List[PathLike]) -> Optional[Dict]:
+    """Checks that files are the same as when their fingerprint was saved.
+
+    The sizes and modified times are compared first. If they have changed
+    the files are hashed, so files that have only been touched or copied
+    still match.
+
+    Args:
+        saved_fingerprint (Dict): fingerprint saved by _files_fingerprint
+            with hashes.
+        file_paths (List[PathLike]): paths/to/the/files.
+
+    Returns:
+        Optional[Dict]: the current fingerprint (with hashes) if the files
+            match, to save in place of the old one, otherwise None.
+    """
+    current_fingerprint = _files_fingerprint(file_paths)
+    if (saved_fingerprint.keys() == current_fingerprint.keys()
+            and all(saved_fingerprint[file_nm].get(key) == info[key]
+                    for file_nm, info in current_fingerprint.items()
+                    for key in ["size", "mtime"])):
+        return saved_fingerprint
+    current_fingerprint = _files_fingerprint(file_paths, with_hash=True)
+    if (saved_fingerprint.keys() == current_fingerprint.keys()
+            and all(saved_fingerprint[file_nm].get("sha256") == info["sha256"]
+                    for file_nm, info in current_fingerprint.items())):
+        return current_fingerprint
+    return None
+
+
+def _shp_files(shp_path: PathLike) -> List[str]:
+    """Lists the geometry (.shp) and attribute (.dbf) files of a shapefile,
+    which are the parts fingerprinted to tell if it has changed.
+
+    Args:
+        shp_path (PathLike): path/to/the/shapefile.shp.
+
+    Returns:
+        List[str]: paths/to/the/shapefile parts.
+    """
+    return [os.path.splitext(shp_path)[0] + ext for ext in [".shp", ".dbf"]]
+
+
+def _shp_fingerprint(shp_path: PathLike, with_hash=False) -> Dict:
+    """Describes a shapefile by the size and modified time of its geometry
+    (.shp) and attribute (.dbf) files, and optionally their hashes.
+
+    Args:
+        shp_path (PathLike): path/to/the/shapefile.shp.
+        with_hash (bool, optional): Whether to hash the files too.
+            Defaults to False.
+
+    Returns:
+        dict: the fingerprint of each file, keyed by file name.
+    """
+    return _files_fingerprint(_shp_files(shp_path), with_hash=with_hash)
+
+
+def _la_store_is_valid(shp_path: PathLike, meta_path: PathLike) -> bool:
+    """Checks that the saved local authority polygons were built from the
+    current version of the shapefile, see _fingerprint_matches.
+
+    Args:
+        shp_path (PathLike): path/to/the/shapefile.shp.
+        meta_path (PathLike): path/to/the/store/metadata.json.
+
+    Returns:
+        bool: True if the saved polygons can be used.
+    """
+    if (_file_meta(meta_path) is None
+            or _file_meta(os.path.splitext(meta_path)[0] + ".parquet") is None):
+        return False
+    with open(meta_path) as meta_file:
+        saved_fingerprint = json.load(meta_file)
+    fingerprint = _fingerprint_matches(saved_fingerprint,
+                                       _shp_files(shp_path))
+    if fingerprint is None:
+        return False
+    if fingerprint is not saved_fingerprint:
+        # Same contents, so just record the new modified times
+        with open(meta_path, 'w') as meta_file:
+            json.dump(fingerprint, meta_file)
+        _invalidate_file_meta(meta_path)
+    return True
+
+
+def get_la_polygon_store(boundary_year: str) -> Tuple[gpd.GeoDataFrame,
+                                                      Dict[str, str]]:
+    """Gets one dissolved polygon per local authority for a boundary year.
+
+    The polygons are built from the shapefile in data/LA_shp/<year> the
+    first time and saved next to it as GeoParquet. Later calls read the
+    saved polygons, unless the shapefile has changed since they were built.
+
+    Along with the polygons a lookup is returned which maps both the LAD
+    code and the LAD name of each local authority to its code, so a local
+    authority can be found by an exact match on either.
+
+    Args:
+        boundary_year (str): year of the local authority boundaries,
+            e.g. "2021".
+
+    Returns:
+        gpd.GeoDataFrame: polygons indexed by LAD code, with the LAD name.
+        dict: lookup from LAD code or LAD name to LAD code.
+    """
+    shp_dir = PATHS.data("LA_shp", str(boundary_year))
+    shp_path = get_shp_abs_path(shp_dir)
+    store_path = os.path.join(shp_dir, "la_polygons.parquet")
+    meta_path = os.path.join(shp_dir, "la_polygons.json")
+
+    code_col = f"LAD{str(boundary_year)[-2:]}CD"
+    name_col = f"LAD{str(boundary_year)[-2:]}NM"
+
+    if _la_store_is_valid(shp_path, meta_path):
+        print(f"Reading local authority polygons from {store_path}")
+        la_store = gpd.read_parquet(store_path)
+    else:
+        print(f"Building local authority polygons from {shp_path}")
+        uk_la_file = geo_df_from_geospatialfile(path_to_file=shp_path)
+        la_store = (uk_la_file[[code_col, name_col, "geometry"]]
+                    .dissolve(by=code_col, aggfunc="first"))
+        la_store.to_parquet(store_path)
+        with open(meta_path, 'w') as meta_file:
+            json.dump(_shp_fingerprint(shp_path, with_hash=True), meta_file)
+        _invalidate_file_meta(store_path)
+        _invalidate_file_meta(meta_path)
+
+    la_lookup = dict(zip(la_store[name_col], la_store.index))
+    la_lookup.update(zip(la_store.index, la_store.index))
+    return la_store, la_lookup
+
+
+def cached_parse(parse_func,
+                 source_paths: List[PathLike],
+                 output_names: List[str],
+                 cache_dir: PathLike,
+                 version: int,
+                 **parse_kwargs) -> List[pd.DataFrame]:
+    """Parses source files into dataframes, or reads the dataframes saved
+    from the last time the same files were parsed.
+
+    The dataframes are saved as feather files in cache_dir along with
+    cache.json, which records the hashes of the source files and the
+    version of the parser. The saved dataframes are only used if the parser
+    version is the same and the source files have the same contents. Their
+    sizes and modified times are checked first so unchanged files are not
+    hashed again.
+
+    Args:
+        parse_func (callable): called with the source paths and
+            parse_kwargs, returning one dataframe per output name.
+        source_paths (List[PathLike]): paths/to/the/source/files.
+        output_names (List[str]): names to save the dataframes as.
+        cache_dir (PathLike): path/to/the/cache/directory.
+        version (int): version of the parser, to be increased whenever
+            its output changes.
+
+    Returns:
+        List[pd.DataFrame]: the dataframes, in the order of output_names.
+    """
+    meta_path = os.path.join(cache_dir, "cache.json")
+    output_paths = [os.path.join(cache_dir, f"{output_nm}.feather")
+                    for output_nm in output_names]
+    if (_file_meta(meta_path) is not None
+            and all(_file_meta(output_path) is not None
+                    for output_path in output_paths)):
+        with open(meta_path) as meta_file:
+            saved_meta = json.load(meta_file)
+        if (saved_meta.get("version") == version
+                and saved_meta.get("outputs") == output_names):
+            fingerprint = _fingerprint_matches(saved_meta["sources"],
+                                               source_paths)
+            if fingerprint is not None:
+                if fingerprint is not saved_meta["sources"]:
+                    # Same contents, so just record the new modified times
+                    saved_meta["sources"] = fingerprint
+                    with open(meta_path, 'w') as meta_file:
+                        json.dump(saved_meta, meta_file, indent=2)
+                    _invalidate_file_meta(meta_path)
+                return [_feath_to_df(output_nm, output_path)
+                        for output_nm, output_path in zip(output_names,
+                                                          output_paths)]
+
+    print(f"Parsing {', '.join(map(str, source_paths))}")
+    outputs = parse_func(*source_paths, **parse_kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Remove the old metadata first, so half written outputs are never used
+    if _file_meta(meta_path) is not None:
+        os.remove(meta_path)
+        _invalidate_file_meta(meta_path)
+    for output_df, output_path in zip(outputs, output_paths):
+        print(f"Writing Pandas dataframe to feather at {output_path}")
+        tmp_path = _tmp_path(output_path)
+        feather.write_feather(output_df.reset_index(drop=True), tmp_path,
+                              compression="uncompressed")
+        os.replace(tmp_path, output_path)
+        _invalidate_file_meta(output_path)
+    with open(meta_path, 'w') as meta_file:
+        json.dump({"version": version,
+                   "outputs": output_names,
+                   "sources": _files_fingerprint(source_paths,
+                                                 with_hash=True)},
+                  meta_file, indent=2)
+    _invalidate_file_meta(meta_path)
+    return list(outputs)
+
+
 def get_oa_la_csv_abspath(dir):
     """Takes a directory as str and returns the absolute path of
     output area csv file.
@@ -519,7 +1772,7 @@ def get_oa_la_csv_abspath(dir):
     return absolute_path
 
 
-def _get_stops_from_api(url, file_name):
+def _get_stops_from_api(url, file_name, headers=None):
     """Gets stops data from the NaPTAN API.
 
     Sub function of `get_stops_file`.
@@ -528,129 +1781,357 @@ def _get_stops_from_api(url, file_name):
         url (str): the URL of the API endpoint.
         file_name (str): Name of the file, including extension
             to be written out containing the stops data.
+        headers (dict, optional): Conditional request headers.
+            Defaults to None.
+
+    Returns:
+        Optional[dict]: the response headers, or None if the stops have
+            not been modified.
+    """
+    # streams the csv to file
+    return _download_file(url, file_name, headers=headers)
+
+
+def _read_stops_meta() -> Dict:
+    """Reads the freshness metadata saved next to Stops.feather.
+
+    Returns:
+        Dict: the "etag" and "last_modified" headers of the last NaPTAN
+            download, when it was "checked_at" and "updated_at", and the
+            size of the last delta. Empty if there is no metadata.
+    """
+    meta_path = PATHS.data("stops", "Stops.json")
+    if _file_meta(meta_path) is None:
+        return {}
+    with open(meta_path) as meta_file:
+        return json.load(meta_file)
+
+
+def _write_stops_meta(meta: Dict):
+    """Writes the freshness metadata next to Stops.feather.
+
+    Args:
+        meta (Dict): the metadata, see _read_stops_meta.
+    """
+    meta_path = PATHS.data("stops", "Stops.json")
+    with open(meta_path, 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    _invalidate_file_meta(meta_path)
+
+
+def _stops_delta(old_df: pd.DataFrame,
+                 new_df: pd.DataFrame) -> pd.DataFrame:
+    """Finds the stops that were added, removed or changed between two
+    versions of the NaPTAN stops, matching them by ATCOCode.
+
+    Args:
+        old_df (pd.DataFrame): the cached stops.
+        new_df (pd.DataFrame): the downloaded stops.
+
+    Returns:
+        pd.DataFrame: the ATCOCode of each stop that differs and its
+            "change": "added", "removed" or "changed".
     """
-    # requests page
-    r = requests.get(url)
+    old = old_df.set_index("ATCOCode")
+    new = new_df.set_index("ATCOCode")
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    common = new.index.intersection(old.index)
+    # Compare as objects so categories that differ between versions and
+    # missing values in both versions do not count as changes
+    old_common = old.loc[common].astype(object)
+    new_common = new.loc[common, old.columns].astype(object)
+    differs = ((old_common != new_common)
+               & ~(old_common.isna() & new_common.isna()))
+    changed = common[differs.any(axis=1).to_numpy()]
+    delta = pd.DataFrame(
+        {"ATCOCode": np.concatenate([added, removed, changed]),
+         "change": (["added"] * len(added)
+                    + ["removed"] * len(removed)
+                    + ["changed"] * len(changed))})
+    delta["change"] = delta["change"].astype("category")
+    return delta
+
+
+def _apply_stops_delta(old_df: pd.DataFrame,
+                       new_df: pd.DataFrame,
+                       delta: pd.DataFrame) -> pd.DataFrame:
+    """Updates the cached stops with the added, removed and changed stops.
+
+    Unchanged stops keep their rows in the cached table; only the stops in
+    the delta are taken from the download.
 
-    # gets content and then writes to csv
-    url_content = r.content
-    csv_file = open(file_name, 'wb')
-    csv_file.write(url_content)
-    csv_file.close()
+    Args:
+        old_df (pd.DataFrame): the cached stops.
+        new_df (pd.DataFrame): the downloaded stops.
+        delta (pd.DataFrame): the delta from _stops_delta.
 
+    Returns:
+        pd.DataFrame: the updated stops.
+    """
+    old = old_df.set_index("ATCOCode")
+    new = new_df.set_index("ATCOCode")
+    dropped = delta.loc[delta["change"] != "added", "ATCOCode"]
+    taken = delta.loc[delta["change"] != "removed", "ATCOCode"]
+    updated = pd.concat([old.drop(index=dropped),
+                         new.loc[taken, old.columns]])
+    return updated.reset_index().astype(config["naptan_types"])
 
-def _get_latest_stop_file_date(dir):
-    """Gets the date of the latest stop dataset.
+
+def _stops_store_index() -> Dict:
+    """Reads the index of the NaPTAN snapshot store.
+
+    Returns:
+        Dict: the "snapshots" in the store, as sorted YYYYMMDD dates. The
+            first is the base snapshot.
+    """
+    index_path = PATHS.data("stops", "snapshots", "index.json")
+    if _file_meta(index_path) is None:
+        return {"snapshots": []}
+    with open(index_path) as index_file:
+        return json.load(index_file)
+
+
+def _snapshot_date(date) -> str:
+    """Formats a date as YYYYMMDD, the key of a snapshot.
 
     Args:
-        dir (str): directory containing stop files.
+        date (str, datetime or date): e.g. "20220105" or "2022-01-05".
 
     Returns:
-        str: the date (YYYYMMDD) of the latest stop dataset.
+        str: the date as YYYYMMDD.
     """
-    # get's a list of files from the directory
-    file_list = os.listdir(dir)
+    return pd.Timestamp(str(date)).strftime('%Y%m%d')
 
-    # make sure only gets csv's
-    file_list_csv = [file for file in file_list if file.endswith(".csv")]
 
-    # files are in the format stops_YYYYMMDD
-    p = re.compile(r'\d+')
+def add_stops_snapshot(stops_df: pd.DataFrame, snapshot_date):
+    """Adds a version of the NaPTAN stops to the snapshot store.
 
-    # attempts to extracts all the dates
-    dates = [p.findall(i)[0] for i in file_list_csv]
+    The first snapshot is kept whole, as the base. Every later snapshot is
+    kept as a zstd compressed delta against the snapshot before it: the
+    rows of the stops that were added or changed, and the ATCOCode of the
+    stops that were removed. Adding a snapshot for a date that is already
+    stored replaces it.
 
-    # convert to integers and get latest date
-    dates_int = [int(date) for date in dates]
-    dates_int.sort(reverse=True)
-    latest = dates_int[0]
+    Args:
+        stops_df (pd.DataFrame): the stops, with the naptan_types columns.
+        snapshot_date (str, datetime or date): date of this version.
+    """
+    snapshot_date = _snapshot_date(snapshot_date)
+    store_dir = PATHS.data("stops", "snapshots")
+    os.makedirs(store_dir, exist_ok=True)
+    snapshots = [date for date in _stops_store_index()["snapshots"]
+                 if date != snapshot_date]
+    earlier = [date for date in snapshots if date < snapshot_date]
+    later = [date for date in snapshots if date > snapshot_date]
+    if later:
+        raise ValueError(f"Snapshots after {snapshot_date} are already "
+                         "stored, snapshots can only be added in order")
+    print(f"Adding NaPTAN snapshot {snapshot_date} to {store_dir}")
+    if not earlier:
+        snapshot_path = os.path.join(store_dir, "base.feather")
+        feather.write_feather(stops_df, snapshot_path, compression="zstd")
+    else:
+        previous = read_stops_snapshot(earlier[-1])
+        delta = _stops_delta(previous, stops_df)
+        removed = delta.loc[delta["change"] == "removed", "ATCOCode"]
+        rows = (stops_df[stops_df["ATCOCode"].isin(delta["ATCOCode"])]
+                .merge(delta, on="ATCOCode"))
+        rows = pd.concat([rows, delta[delta["ATCOCode"].isin(removed)]],
+                         ignore_index=True)
+        snapshot_path = os.path.join(store_dir,
+                                     f"delta_{snapshot_date}.feather")
+        feather.write_feather(rows, snapshot_path, compression="zstd")
+    _invalidate_file_meta(snapshot_path)
+    index_path = os.path.join(store_dir, "index.json")
+    with open(index_path, 'w') as index_file:
+        json.dump({"snapshots": earlier + [snapshot_date]}, index_file,
+                  indent=2)
+    _invalidate_file_meta(index_path)
+
+
+def read_stops_snapshot(as_of) -> pd.DataFrame:
+    """Gets the NaPTAN stops as they were on a date, from the latest
+    snapshot on or before that date.
 
-    return latest
+    Args:
+        as_of (str, datetime or date): e.g. "20220105" or "2022-01-05".
 
+    Raises:
+        ValueError: If there is no snapshot on or before the date.
 
-def save_latest_stops_as_feather(file_name):
+    Returns:
+        pd.DataFrame: the stops, with the naptan_types columns.
+    """
+    as_of = _snapshot_date(as_of)
+    store_dir = PATHS.data("stops", "snapshots")
+    snapshots = [date for date in _stops_store_index()["snapshots"]
+                 if date <= as_of]
+    if not snapshots:
+        raise ValueError(f"No NaPTAN snapshot on or before {as_of}")
+    stops_df = feather.read_feather(os.path.join(store_dir, "base.feather"))
+    stops = stops_df.set_index("ATCOCode")
+    for date in snapshots[1:]:
+        delta = feather.read_feather(
+            os.path.join(store_dir, f"delta_{date}.feather"))
+        stops = pd.concat(
+            [stops.drop(index=delta["ATCOCode"], errors="ignore"),
+             delta[delta["change"] != "removed"]
+             .set_index("ATCOCode")[stops.columns]])
+    return stops.reset_index().astype(config["naptan_types"])
+
+
+def save_latest_stops_as_feather(file_name, snapshot_date=None):
     """Saves the latest stop file as a feather file into
     the data folder.
 
+    If there is already a Stops.feather, only the stops that were added,
+    removed or changed are updated in it, and those stops are written to
+    Stops_delta.feather so that anything built from the stops can be
+    updated rather than rebuilt. The stops are also added to the snapshot
+    store, and the csv is deleted once it is in the store.
+
     Args:
         file_name (str): file path for latest stop file.
+        snapshot_date (str, optional): date of the stops, as YYYYMMDD.
+            Defaults to today.
+
+    Returns:
+        str: path of Stops.feather.
     """
+    snapshot_date = snapshot_date or datetime.now().strftime('%Y%m%d')
     # read in csv
-    file = pd.read_csv(file_name,
-                       usecols=config["naptan_types"].keys(),
-                       dtype=config["naptan_types"])
+    file = _read_csv(file_name, "Stops", config["naptan_types"])
+    # ATCOCode is the key of the stops
+    file = file.drop_duplicates(subset="ATCOCode")
 
     # get output path
-    output_path = os.path.join(os.getcwd(),
-                               "data",
-                               "stops",
-                               "Stops.feather")
-    # output to feather
-    file.to_feather(output_path)
+    output_path = PATHS.data("stops", "Stops.feather")
+    delta_path = PATHS.data("stops", "Stops_delta.feather")
+    if (_persistent_exists(output_path)
+            and not _stops_store_index()["snapshots"]):
+        # Keep the stops from before the store existed as its base
+        feather_date = datetime.fromtimestamp(
+            _file_meta(output_path)["mtime"] / 1e9)
+        if _snapshot_date(feather_date) < snapshot_date:
+            add_stops_snapshot(_feath_to_df("Stops", output_path),
+                               feather_date)
+    add_stops_snapshot(file, snapshot_date)
+    if _persistent_exists(output_path):
+        cached = _feath_to_df("Stops", output_path)
+        delta = _stops_delta(cached, file)
+        print("NaPTAN stops changed: "
+              f"{delta['change'].value_counts().to_dict()}")
+        file = _apply_stops_delta(cached, file, delta)
+        # output the delta for incremental updates downstream
+        _write_feather(delta, delta_path)
+    # output to feather, uncompressed so that it can be memory mapped
+    _write_feather(file, output_path, compression="uncompressed")
+    # The stops are in the snapshot store now, so the csv is not needed
+    os.remove(file_name)
+    _invalidate_file_meta(file_name)
 
     return output_path
 
 
-def _dl_stops_make_df(today, url):
-    """Downloads the latest data from api, saves as csv & feather, returns df
-
-    Args:
-        today (str): todays date
-        url (str): API URL
+def read_stops_delta() -> Optional[pd.DataFrame]:
+    """Reads the stops that changed in the last NaPTAN refresh, so that
+    anything built from the stops (e.g. a spatial index) can be updated
+    for just those stops.
 
     Returns:
-        pd.DataFrame: df of latest stops data
+        Optional[pd.DataFrame]: the ATCOCode and "change" ("added",
+            "removed" or "changed") of each stop, or None if there has not
+            been a refresh yet.
     """
-    csv_path = os.path.join(os.getcwd(),
-                            "data",
-                            "stops",
-                            f"stops_{today}.csv")
-    # Save latest data as csv
-    _get_stops_from_api(url, csv_path)
-    # Save as feather
-    feather_path = save_latest_stops_as_feather(csv_path)
-    # Load feather as pd df
-    stops_df = pd.read_feather(feather_path)
-    return stops_df
+    delta_path = PATHS.data("stops", "Stops_delta.feather")
+    if _file_meta(delta_path) is None:
+        return None
+    return _feath_to_df("Stops_delta", delta_path)
 
 
-def get_stops_file(url, dir):
-    """Gets the latest stop dataset.
+def _remove_stops_csvs(dir: PathLike, keep: Optional[PathLike] = None):
+    """Deletes stop csvs (stops_<date>.csv) left in the stops directory by
+    downloads that were never saved to Stops.feather.
 
-    If the latest stop df from the api is older then 28 days
-    then function grabs a new version of file from API and
-    saves this as a feather file.
+    Sub function of `get_stops_file`.
 
-    If the latest stop df from the api is less then 28 days old
-    then just grabs the feather file.
+    Args:
+        dir (PathLike): directory where the stop data is stored.
+        keep (PathLike, optional): a csv not to delete. Defaults to None.
+    """
+    if not os.path.isdir(dir):
+        return
+    for file_nm in os.listdir(dir):
+        csv_path = os.path.join(dir, file_nm)
+        if (re.fullmatch(r"stops_\d{8}\.csv", file_nm)
+                and (keep is None
+                     or os.path.abspath(csv_path) != os.path.abspath(keep))):
+            print(f"Deleting unused stops file {csv_path}")
+            os.remove(csv_path)
+            _invalidate_file_meta(csv_path)
+
+
+def get_stops_file(url, dir, as_of=None):
+    """Gets the latest stop dataset, or the stops as they were on the date
+    as_of from the snapshot store.
+
+    If the stops were last checked against the API naptan_refresh_days or
+    more ago, the API is asked for the stops with a conditional request
+    using the ETag and Last-Modified of the previous download (saved in
+    Stops.json next to Stops.feather). If they have changed, the cached
+    Stops.feather is updated with the added, removed and changed stops.
+
+    Otherwise just grabs the feather file.
 
     Args:
         url (str): NAPTAN API url.
         dir (str): directory where the stop data is stored.
+        as_of (str, optional): date of the stops to get, e.g. "20220105".
+            Defaults to None, which gets the latest stops.
 
     Returns:
         pd.DataFrame
     """
-
-    # gets todays date and latest date of stops df
-    today = int(datetime.now().strftime('%Y%m%d'))
-
+    if as_of is not None:
+        return read_stops_snapshot(as_of)
+    now = datetime.now()
     # gets feather stop path
-    feather_path = os.path.join(os.getcwd(),
-                                "data",
-                                "stops",
-                                "Stops.feather")
-    # Check that the feather exists
-    if not _persistent_exists(feather_path):
-        stops_df = _dl_stops_make_df(today, url)
-    else:  # does exist
-        latest_date = _get_latest_stop_file_date(dir)
-        if today - latest_date < 28:
-            stops_df = pd.read_feather(feather_path)
-        else:
-            stops_df = _dl_stops_make_df(today, url)
+    feather_path = PATHS.data("stops", "Stops.feather")
+    meta = _read_stops_meta() if _persistent_exists(feather_path) else {}
+    if meta.get("checked_at"):
+        days_since_check = (now
+                            - datetime.fromisoformat(meta["checked_at"])).days
+        if days_since_check < NAPTAN_REFRESH_DAYS:
+            _remove_stops_csvs(dir)
+            return _feath_to_df("Stops", feather_path, memory_map=True)
+
+    csv_path = os.path.join(dir, f"stops_{now.strftime('%Y%m%d')}.csv")
+    _remove_stops_csvs(dir, keep=csv_path)
+    if _persistent_exists(csv_path):
+        # Already downloaded today by a run that stopped before saving it
+        response_headers = {}
+    else:
+        conditional_headers = {}
+        if meta.get("etag"):
+            conditional_headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            conditional_headers["If-Modified-Since"] = meta["last_modified"]
+        response_headers = _get_stops_from_api(url, csv_path,
+                                               headers=conditional_headers)
+    if response_headers is None:
+        print("NaPTAN stops have not changed since the last download")
+    else:
+        save_latest_stops_as_feather(csv_path)
+        # A csv downloaded earlier has no headers, so keep the last ones
+        meta["etag"] = response_headers.get("ETag", meta.get("etag"))
+        meta["last_modified"] = response_headers.get(
+            "Last-Modified", meta.get("last_modified"))
+        meta["updated_at"] = now.isoformat(timespec="seconds")
+    meta["checked_at"] = now.isoformat(timespec="seconds")
+    _write_stops_meta(meta)
 
-    return stops_df
+    return _feath_to_df("Stops", feather_path, memory_map=True)
 
 
 def read_usual_pop_scotland(path: str):
@@ -730,6 +2211,27 @@ def read_urb_rur_ni(urb_rur_path):
 
     return urb_rur
 
+def bus_timetable_is_due(bus_dir: PathLike,
+                         number_of_days: int = BUS_TIMETABLE_MAX_AGE_DAYS
+                         ) -> bool:
+    """Checks whether the bus timetable needs downloading again, because
+    some of its extracted files are missing or they are older than
+    number_of_days, see best_before.
+
+    Args:
+        bus_dir (PathLike): path/to/the/bus/timetable/directory.
+        number_of_days (int, optional): days before the timetable is
+            downloaded again. Defaults to BUS_TIMETABLE_MAX_AGE_DAYS.
+
+    Returns:
+        bool: True if the timetable should be downloaded.
+    """
+    if not all(_file_meta(os.path.join(bus_dir, f"{file_nm}.txt"))
+               for file_nm in BUS_TIMETABLE_FILES):
+        return True
+    return best_before(path=bus_dir, number_of_days=number_of_days)
+
+
 def best_before(path, number_of_days):
     """
     Checks whether a path has been modified within a period of days.
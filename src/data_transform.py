@@ -1,24 +1,11 @@
-from typing import List
+from typing import Dict, List
 import pandas as pd
 from convertbng.util import convert_bng
 import logging
-import os
 
 # Our modules
 import data_output as do
 
-# Get CWD
-CWD = os.getcwd()
-
-
-# Create logger
-logger = logging.getLogger(__name__)
-
-
-# Get CWD
-CWD = os.getcwd()
-
-
 # Create logger
 logger = logging.getLogger(__name__)
 
@@ -144,14 +131,72 @@ def served_proportions_disagg(pop_df: pd.DataFrame,
         iii) the proportion who are served by public transport
         iv) the proportion who are not served by public transport
     """
-    # First list the age bin columns
+    # Sum each column for the whole population and the served population
+    total_sums = pop_df[cols_lst].sum()
+    servd_sums = pop_in_poly_df[cols_lst].sum()
+
+    return _served_proportions_from_sums(total_sums, servd_sums, cols_lst)
+
+
+def served_proportions_by_group(pop_df: pd.DataFrame,
+                                served: pd.Series,
+                                group_col: str,
+                                cols_lst: List[str],
+                                groups=None) -> Dict[str, pd.DataFrame]:
+    """Runs served_proportions_disagg for every group (e.g. local authority)
+    in the population dataframe using a single groupby.
+
+    Args:
+        pop_df (pd.DataFrame): population dataframe for all groups.
+        served (pd.Series): boolean mask, aligned to pop_df, which is True
+            for the rows served by public transport.
+        group_col (str): name of the column to group by, e.g. LAD19NM.
+        cols_lst (List[str]): a list of the column names in the population
+            dataframe which contain population figures.
+        groups (list, optional): the groups to return. Groups with no rows
+            in pop_df get a population of zero. Defaults to None, which
+            returns every group in pop_df.
+
+    Returns:
+        Dict[str, pd.DataFrame]: a dataframe per group, in the same format
+            as returned by served_proportions_disagg.
+    """
+    total_sums = pop_df.groupby(group_col)[cols_lst].sum()
+    if groups is not None:
+        total_sums = total_sums.reindex(groups, fill_value=0)
+    servd_sums = (pop_df[served]
+                  .groupby(group_col)[cols_lst].sum()
+                  .reindex(total_sums.index, fill_value=0))
+
+    return {group: _served_proportions_from_sums(total_sums.loc[group],
+                                                 servd_sums.loc[group],
+                                                 cols_lst)
+            for group in total_sums.index}
 
+
+def _served_proportions_from_sums(total_sums: pd.Series,
+                                  servd_sums: pd.Series,
+                                  cols_lst: List[str]) -> pd.DataFrame:
+    """Builds the served/unserved summary dataframe from the population sums
+    of each column.
+
+    Sub function of served_proportions_disagg and
+    served_proportions_by_group.
+
+    Args:
+        total_sums (pd.Series): total population for each column.
+        servd_sums (pd.Series): served population for each column.
+        cols_lst (List[str]): the columns to summarise.
+
+    Returns:
+        pd.DataFrame: see served_proportions_disagg.
+    """
     pop_sums = {}
     for col in cols_lst:
         # Total pop
-        total_pop = int(pop_df[col].sum())
+        total_pop = int(total_sums[col])
         # Served pop
-        servd_pop = int(pop_in_poly_df[col].sum())
+        servd_pop = int(servd_sums[col])
         # Unserved pop
         unsrvd_pop = int(total_pop - servd_pop)
         if total_pop == 0:
@@ -295,11 +340,43 @@ def disab_dict(la_pop_df, pop_in_poly_df, disability_dict, local_auth):
                             local authorities.
     """
     # Calculating those served and not served by disability
-    disab_cols = ["number_disabled"]
-
     disab_servd_df = served_proportions_disagg(la_pop_df,
                                                pop_in_poly_df,
-                                               disab_cols)
+                                               ["number_disabled"])
+
+    # Calculating non-disabled people served and not served
+    non_disab_servd_df = served_proportions_disagg(
+        pop_df=la_pop_df,
+        pop_in_poly_df=pop_in_poly_df,
+        cols_lst=["number_non-disabled"])
+
+    non_disab_disab_servd_df_out = _disab_output(disab_servd_df,
+                                                 non_disab_servd_df,
+                                                 local_auth)
+
+    # Output this local auth's disab df to the dict
+    disability_dict[local_auth] = non_disab_disab_servd_df_out
+
+    return disability_dict
+
+
+def _disab_output(disab_servd_df, non_disab_servd_df, local_auth):
+    """Reshapes the disabled and non-disabled served proportions for output
+    and combines them.
+
+    Sub function of disab_dict and national_served_disaggs.
+
+    Args:
+        disab_servd_df (pd.DataFrame): served proportions of the
+            number_disabled column.
+        non_disab_servd_df (pd.DataFrame): served proportions of the
+            number_non-disabled column.
+        local_auth (str): The local authority of interest.
+
+    Returns:
+        pd.DataFrame: disability results for the local authority.
+    """
+    disab_cols = ["number_disabled"]
 
     # Feeding the results to the reshaper
     disab_servd_df_out = do.reshape_for_output(disab_servd_df,
@@ -313,14 +390,6 @@ def disab_dict(la_pop_df, pop_in_poly_df, disability_dict, local_auth):
                                value="Disabled",
                                inplace=True)
 
-    # Calculating non-disabled people served and not served
-    non_disab_cols = ["number_non-disabled"]
-
-    non_disab_servd_df = served_proportions_disagg(
-        pop_df=la_pop_df,
-        pop_in_poly_df=pop_in_poly_df,
-        cols_lst=non_disab_cols)
-
     # Feeding the results to the reshaper
     non_disab_servd_df_out = do.reshape_for_output(
         non_disab_servd_df,
@@ -335,13 +404,7 @@ def disab_dict(la_pop_df, pop_in_poly_df, disability_dict, local_auth):
                                    inplace=True)
 
     # Concatting non-disabled and disabled dataframes
-    non_disab_disab_servd_df_out = pd.concat(
-        [non_disab_servd_df_out, disab_servd_df_out])
-
-    # Output this local auth's disab df to the dict
-    disability_dict[local_auth] = non_disab_disab_servd_df_out
-
-    return disability_dict
+    return pd.concat([non_disab_servd_df_out, disab_servd_df_out])
 
 
 def urban_rural_results(la_pop_df, pop_in_poly_df, urb_rur_dict, local_auth):
@@ -381,9 +444,35 @@ def urban_rural_results(la_pop_df, pop_in_poly_df, urb_rur_dict, local_auth):
                                              pop_in_poly_df=rur_df_poly,
                                              cols_lst=['pop_count'])
 
+    urb_rur_servd_df_out = _urb_rur_output(urb_servd_df,
+                                           rur_servd_df,
+                                           local_auth)
+
+    # Output this iteration's urb and rur df to the dict
+    urb_rur_dict[local_auth] = urb_rur_servd_df_out
+
+    return urb_rur_dict
+
+
+def _urb_rur_output(urb_servd_df, rur_servd_df, local_auth):
+    """Reshapes the urban and rural served proportions for output and
+    combines them.
+
+    Sub function of urban_rural_results and national_served_disaggs.
+
+    Args:
+        urb_servd_df (pd.DataFrame): served proportions of the urban
+            pop_count.
+        rur_servd_df (pd.DataFrame): served proportions of the rural
+            pop_count.
+        local_auth (str): The local authority of interest.
+
+    Returns:
+        pd.DataFrame: urban/rural results for the local authority.
+    """
     # Renaming pop_count to either urban or rural
-    urb_servd_df.rename(columns={"pop_count": "Urban"}, inplace=True)
-    rur_servd_df.rename(columns={"pop_count": "Rural"}, inplace=True)
+    urb_servd_df = urb_servd_df.rename(columns={"pop_count": "Urban"})
+    rur_servd_df = rur_servd_df.rename(columns={"pop_count": "Rural"})
 
     # Sending each to reshaper
     urb_servd_df_out = do.reshape_for_output(urb_servd_df,
@@ -399,12 +488,127 @@ def urban_rural_results(la_pop_df, pop_in_poly_df, urb_rur_dict, local_auth):
     rur_servd_df_out.rename(columns={"Rural": "Urban/Rural"}, inplace=True)
 
     # Combining urban and rural dfs
-    urb_rur_servd_df_out = pd.concat([urb_servd_df_out, rur_servd_df_out])
+    return pd.concat([urb_servd_df_out, rur_servd_df_out])
 
-    # Output this iteration's urb and rur df to the dict
-    urb_rur_dict[local_auth] = urb_rur_servd_df_out
 
-    return urb_rur_dict
+def national_served_disaggs(pop_df: pd.DataFrame,
+                            served: pd.Series,
+                            group_col: str,
+                            age_cols: List[str],
+                            sex_cols: List[str]) -> Dict[str, Dict]:
+    """Calculates the total, age, sex, disability and urban/rural results
+    for every local authority at once.
+
+    This is the national counterpart of the per local authority loop. The
+    served flag is worked out for the whole country beforehand, so each
+    disaggregation is a groupby over the local authority column rather than
+    a spatial join per local authority. The results are reshaped exactly as
+    in the loop.
+
+    Args:
+        pop_df (pd.DataFrame): population dataframe for the whole nation,
+            including the disability and urb_rur_class columns.
+        served (pd.Series): boolean mask, aligned to pop_df, which is True
+            for the output areas served by public transport.
+        group_col (str): local authority name column, e.g. LAD19NM.
+        age_cols (List[str]): the age bin columns.
+        sex_cols (List[str]): the sex columns.
+
+    Returns:
+        Dict[str, Dict]: dictionaries of output dataframes keyed by local
+            authority, for each of "total", "age", "sex", "disability" and
+            "urban_rural".
+    """
+    results = {"total": {},
+               "age": {},
+               "sex": {},
+               "disability": {},
+               "urban_rural": {}}
+
+    # Total population and served population of each local authority
+    full_pops = pop_df.groupby(group_col)["pop_count"].sum()
+    served_pops = (pop_df[served]
+                   .groupby(group_col)["pop_count"].sum()
+                   .reindex(full_pops.index, fill_value=0))
+    local_auths = full_pops.index
+
+    # One groupby for all the columns that are disaggregated directly
+    disab_cols = ["number_disabled", "number_non-disabled"]
+    la_servd_dfs = served_proportions_by_group(
+        pop_df, served, group_col, age_cols + sex_cols + disab_cols)
+
+    # Urban and rural are a split of the rows rather than extra columns
+    urb_rows = pop_df.urb_rur_class == "urban"
+    rur_rows = pop_df.urb_rur_class == "rural"
+    urb_servd_dfs = served_proportions_by_group(pop_df[urb_rows],
+                                                served[urb_rows],
+                                                group_col,
+                                                ['pop_count'],
+                                                groups=local_auths)
+    rur_servd_dfs = served_proportions_by_group(pop_df[rur_rows],
+                                                served[rur_rows],
+                                                group_col,
+                                                ['pop_count'],
+                                                groups=local_auths)
+
+    for local_auth in local_auths:
+        la_servd_df = la_servd_dfs[local_auth]
+
+        results["total"][local_auth] = _la_total_output(
+            full_pops[local_auth], served_pops[local_auth], local_auth)
+
+        results["age"][local_auth] = do.reshape_for_output(
+            la_servd_df[age_cols], id_col="Age", local_auth=local_auth)
+
+        results["sex"][local_auth] = do.reshape_for_output(
+            la_servd_df[sex_cols], id_col="Sex", local_auth=local_auth)
+
+        results["disability"][local_auth] = _disab_output(
+            la_servd_df[["number_disabled"]],
+            la_servd_df[["number_non-disabled"]],
+            local_auth)
+
+        results["urban_rural"][local_auth] = _urb_rur_output(
+            urb_servd_dfs[local_auth], rur_servd_dfs[local_auth], local_auth)
+
+    return results
+
+
+def _la_total_output(full_pop, served, local_auth):
+    """Reshapes the total and served population of a local authority for
+    output.
+
+    Sub function of national_served_disaggs.
+
+    Args:
+        full_pop (int): the population of the local authority.
+        served (int): the population served by public transport.
+        local_auth (str): The local authority of interest.
+
+    Returns:
+        pd.DataFrame: total results for the local authority.
+    """
+    not_served = full_pop - served
+    pct_not_served = "{:.2f}".format(not_served / full_pop * 100)
+    pct_served = "{:.2f}".format(served / full_pop * 100)
+
+    la_results_df = pd.DataFrame({"All_pop": [full_pop],
+                                  "Served": [served],
+                                  "Unserved": [not_served],
+                                  "Percentage served": [pct_served],
+                                  "Percentage unserved": [pct_not_served]})
+
+    # Re-orienting the df to what's accepted by the reshaper and renaming col
+    la_results_df = la_results_df.T.rename(columns={0: "Total"})
+
+    la_results_df_out = do.reshape_for_output(la_results_df,
+                                              id_col="Total",
+                                              local_auth=local_auth)
+
+    # "Total" is not a disaggregation so doesn't have a column
+    la_results_df_out.drop("Total", axis=1, inplace=True)
+
+    return la_results_df_out
 
 
 def create_tiploc_col(naptan_df):
@@ -1,11 +1,12 @@
 # Third party imports for this module
 import geopandas as gpd
 import numpy as np
+import pandas as pd
 import os
 import yaml
 
-# get current working directory
-CWD = os.getcwd()
+# get the project root, as in data_ingest
+CWD = os.path.abspath(os.environ.get("SDG_PROJECT_ROOT", os.getcwd()))
 
 # Load config for buffers
 with open(os.path.join(CWD, "config.yaml")) as yamlfile:
@@ -16,6 +17,15 @@ with open(os.path.join(CWD, "config.yaml")) as yamlfile:
 # Add in capacity buffers from config
 LOWERBUFFER = config["low_cap_buffer"]
 UPPERBUFFER = config["high_cap_buffer"]
+CAPACITY_BUFFERS = {"low": LOWERBUFFER, "high": UPPERBUFFER}
+
+# Number of segments used to approximate a quarter circle in the buffers
+BUFFER_RESOLUTION = config["buffer_resolution"]
+
+# sindex.query takes an array of geometries from geopandas 0.12, which
+# deprecates the older sindex.query_bulk
+SINDEX_BULK_QUERY = tuple(
+    int(part) for part in gpd.__version__.split(".")[:2]) >= (0, 12)
 
 
 def get_polygons_of_loccode(geo_df: gpd.GeoDataFrame,
@@ -45,34 +55,69 @@ def get_polygons_of_loccode(geo_df: gpd.GeoDataFrame,
     return polygon_df
 
 
+def get_la_polygon(la_store: gpd.GeoDataFrame,
+                   la_lookup: dict,
+                   search: str) -> gpd.GeoDataFrame:
+    """Gets the polygon of a local authority from the polygon store made by
+    data_ingest.get_la_polygon_store.
+
+    The local authority is found by an exact match on its LAD code or name.
+
+    Args:
+        la_store (gpd.GeoDataFrame): dissolved polygons indexed by LAD code.
+        la_lookup (dict): lookup from LAD code or LAD name to LAD code.
+        search (str): the LAD code or name of the local authority.
+
+    Returns:
+        gpd.GeoDataFrame: GeoDataFrame with the local authority's polygon,
+            in the same form as returned by get_polygons_of_loccode.
+    """
+    try:
+        la_code = la_lookup[search]
+    except KeyError:
+        raise KeyError(f"{search} is not a local authority code or name "
+                       "in the boundary data") from None
+    polygon_df = gpd.GeoDataFrame(la_store.loc[[la_code], ['geometry']])
+    return polygon_df
+
+
+def _check_capacity_types(capacity_type: pd.Series):
+    """Raises an error if any capacity type is not high or low.
+
+    Args:
+        capacity_type (pd.Series): the capacity_type of each point.
+
+    Raises:
+        ValueError: if there are capacity types without a buffer.
+    """
+    valid_types = list(CAPACITY_BUFFERS)
+    invalid_types = capacity_type[~capacity_type.isin(valid_types)].unique()
+    if len(invalid_types) > 0:
+        raise ValueError(f"""{list(invalid_types)} not valid capacity types,
+                         should be either high or low""")
+
+
 def buffer_points(geo_df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """Creates a 500m or 1000m buffer around points.
     Draws 500m if the capacity_type is low
     Draws 1000m if the capacity_type is high
     Puts the results into a new column called "geometry"
     As 'epsg:27700' projections units of km, 500m is 0.5km.
+    The number of segments per quarter circle is set by buffer_resolution
+    in the config, lower values are coarser but quicker.
     Args:
         geo_df (gpd.DataFrame): Data frame of points to be buffered
             including a column with the capacity_type for each point.
     Returns:
         gpd.DataFrame: A dataframe of polygons create from the buffer.
     """
-    # raise an error if high or low not correct capacity type
-    for value in geo_df["capacity_type"]:
-        if value not in ["high", "low"]:
-            raise ValueError(f"""{value} is not a valid capacity type,
-                             should be either high or low""")
-    # conditions
-    conditions = [geo_df['capacity_type'] == "low",
-                  geo_df['capacity_type'] == "high"]
-
-    # values
-    values = [geo_df.geometry.buffer(LOWERBUFFER),
-              geo_df.geometry.buffer(UPPERBUFFER)]
-
-    # apply conditions
-    geo_df['geometry'] = np.select(condlist=conditions,
-                                   choicelist=values)
+    capacity_type = geo_df["capacity_type"]
+    _check_capacity_types(capacity_type)
+
+    # Buffer every stop once, with the radius for its capacity type
+    buffer_dists = capacity_type.map(CAPACITY_BUFFERS).astype(float)
+    geo_df['geometry'] = geo_df.geometry.buffer(buffer_dists.to_numpy(),
+                                                resolution=BUFFER_RESOLUTION)
 
     return geo_df
 
@@ -106,3 +151,72 @@ def find_points_in_poly(geo_df: gpd.GeoDataFrame, polygon_obj):
                     ['index_right'].notna()])
     filtered_df = filtered_df[wanted_cols]
     return filtered_df
+
+
+def find_served_points(geo_df: gpd.GeoDataFrame,
+                       stops_geo_df: gpd.GeoDataFrame,
+                       match_col=None) -> pd.Series:
+    """Flags the points which are within 500m of a low capacity stop or
+    1000m of a high capacity stop.
+
+    Rather than buffering every stop into a circle polygon, the stops of
+    each capacity_type are put in a spatial index once as squares of the
+    capacity's radius. All the points are queried against the index in
+    bulk, and the candidate pairs are then filtered by their exact distance.
+
+    This gives the same answer as buffer_points plus find_points_in_poly,
+    apart from points within a metre or so of the radius, where the buffer
+    polygons fall slightly inside the true circle.
+
+    If match_col is given, a point only counts as served by a stop that
+    has the same value in that column. Using the local authority name
+    gives the same result as running the stops of each local authority
+    separately.
+
+    Args:
+        geo_df (gpd.GeoDataFrame): points to flag, e.g. population
+            weighted centroids.
+        stops_geo_df (gpd.GeoDataFrame): stop points including a column
+            with the capacity_type for each stop.
+        match_col (str, optional): column in both dataframes that a point
+            and a stop must share. Defaults to None.
+
+    Returns:
+        pd.Series: boolean Series aligned to geo_df, True where served.
+
+    Raises:
+        ValueError: if a stop has a capacity type other than high or low.
+    """
+    _check_capacity_types(stops_geo_df["capacity_type"])
+
+    pnt_x = geo_df.geometry.x.to_numpy()
+    pnt_y = geo_df.geometry.y.to_numpy()
+    served = np.zeros(len(geo_df), dtype=bool)
+
+    for capacity_type, radius in CAPACITY_BUFFERS.items():
+        cap_stops = stops_geo_df[stops_geo_df["capacity_type"]
+                                 == capacity_type]
+        if cap_stops.empty:
+            continue
+
+        # Candidate pairs: the point is inside the square around the stop
+        stop_squares = gpd.GeoSeries(
+            cap_stops.geometry.buffer(radius, cap_style=3).values)
+        if SINDEX_BULK_QUERY:
+            pnt_idx, stop_idx = stop_squares.sindex.query(geo_df.geometry)
+        else:
+            pnt_idx, stop_idx = stop_squares.sindex.query_bulk(
+                geo_df.geometry)
+
+        # Keep the pairs which are within the radius
+        dist_x = pnt_x[pnt_idx] - cap_stops.geometry.x.to_numpy()[stop_idx]
+        dist_y = pnt_y[pnt_idx] - cap_stops.geometry.y.to_numpy()[stop_idx]
+        within = (dist_x ** 2 + dist_y ** 2) <= radius ** 2
+
+        if match_col is not None:
+            within &= (geo_df[match_col].to_numpy()[pnt_idx]
+                       == cap_stops[match_col].to_numpy()[stop_idx])
+
+        served[pnt_idx[within]] = True
+
+    return pd.Series(served, index=geo_df.index)
@@ -1,7 +1,13 @@
 import runpy
 
+import data_ingest as di
+
 countries = ['eng_wales']
 
+if di.config["prefetch_downloads"]:
+    print('Prefetching remote datasets')
+    di.prefetch_downloads()
+
 for country in countries:
     if country == 'eng_wales':
         print(f'Running pipeline for {country}')
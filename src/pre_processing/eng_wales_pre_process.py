@@ -14,8 +14,8 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import data_ingest as di
 import data_transform as dt
 
-# get current working directory
-CWD = os.getcwd()
+# get the project root, as in data_ingest
+CWD = di.PATHS.root
 
 # Load config
 with open(os.path.join(CWD, "config.yaml"), encoding="utf-8") as yamlfile:
@@ -25,12 +25,12 @@ with open(os.path.join(CWD, "config.yaml"), encoding="utf-8") as yamlfile:
 
 # Constants
 DEFAULT_CRS = config["default_crs"]
-DATA_DIR = config["data_dir"]
-BUS_IN_DIR = config['bus_in_dir']
-TRAIN_IN_DIR = config['train_in_dir']
+BUS_IN_DIR = di.PATHS.resolve(config['bus_in_dir'])
+TRAIN_IN_DIR = di.PATHS.resolve(config['train_in_dir'])
 URB_RUR_ZIP_LINK = config["urb_rur_zip_link"]
 URB_RUR_TYPES = config["urb_rur_types"]
-ENG_WALES_PREPROCESSED_OUTPUT = config["eng_wales_preprocessed_output"]
+ENG_WALES_PREPROCESSED_OUTPUT = di.PATHS.resolve(
+    config["eng_wales_preprocessed_output"])
 
 # Years
 CALCULATION_YEAR = str(config["calculation_year"])
@@ -38,6 +38,10 @@ CENTROID_YEAR = str(config["centroid_year"])
 EW_OA_LOOKUP_YEAR = str(config["ew_oa_lookup_year"])
 POP_YEAR = str(config["population_year"])
 
+# This script isn't under a __main__ guard, so keep this to 1 on Windows
+# and macOS, where the worker processes would run the script again
+POP_STORE_WORKERS = config["pop_store_workers"]
+
 
 # ---------
 # Load and process stops data
@@ -56,9 +60,7 @@ highly_serviced_train_stops = di._feath_to_df('train_highly_serviced_stops',
 
 # Get Tram data
 naptan_df = di.get_stops_file(url=config["naptan_api"],
-                              dir=os.path.join(os.getcwd(),
-                                               "data",
-                                               "stops"))
+                              dir=di.PATHS.data("stops"))
 
 # Isolating the tram and metro stops
 tram_metro_stops = naptan_df[naptan_df.StopType.isin(["PLT", "MET", "TMU"])]
@@ -112,9 +114,8 @@ stops_geo_df = (di.geo_df_from_pd_df(pd_df=filtered_stops_df,
                                      geom_y='northing',
                                      crs=DEFAULT_CRS))
 
-# Export dataset to geojson
-path = os.path.join(ENG_WALES_PREPROCESSED_OUTPUT, 'stops_geo_df.geojson')
-stops_geo_df.to_file(path, driver='GeoJSON', index=False)
+# Export dataset to GeoParquet
+di.save_geo_df(stops_geo_df, ENG_WALES_PREPROCESSED_OUTPUT, 'stops_geo_df')
 
 # -------------------------------------
 # Load and process local authority data
@@ -126,10 +127,8 @@ print('Processing local authority data')
 # Note that local authorities in scotland are commonly knows as councils.
 
 # Getting path for LA shapefile
-uk_la_path = di.get_shp_abs_path(dir=os.path.join(os.getcwd(),
-                                                  "data",
-                                                  "LA_shp",
-                                                  CALCULATION_YEAR))
+uk_la_path = di.get_shp_abs_path(dir=di.PATHS.data("LA_shp",
+                                                   CALCULATION_YEAR))
 
 # Create geopandas dataframe from the shapefile
 uk_la_file = di.geo_df_from_geospatialfile(path_to_file=uk_la_path)
@@ -145,9 +144,8 @@ ew_la_df = (
 ew_la_df = (
     ew_la_df[[lad_code_col, f'LAD{CALCULATION_YEAR[-2:]}NM', 'geometry']])
 
-# Export dataset to geojson
-path = os.path.join(ENG_WALES_PREPROCESSED_OUTPUT, 'ew_la_df.geojson')
-ew_la_df.to_file(path, driver='GeoJSON', index=False)
+# Export dataset to GeoParquet
+di.save_geo_df(ew_la_df, ENG_WALES_PREPROCESSED_OUTPUT, 'ew_la_df')
 
 # ------------------------------------------------------
 # Load and process local authority to output area lookup
@@ -157,7 +155,7 @@ print('Processing local authority to output area lookup')
 lad_name_col = f'LAD{EW_OA_LOOKUP_YEAR[-2:]}NM'
 
 ew_oa_la_lookup_path = di.get_oa_la_csv_abspath(
-    os.path.join(os.getcwd(), "data", "oa_la_mapping", EW_OA_LOOKUP_YEAR))
+    di.PATHS.data("oa_la_mapping", EW_OA_LOOKUP_YEAR))
 
 ew_oa_la_lookup_df = pd.read_csv(ew_oa_la_lookup_path,
                                  usecols=["OA11CD", lad_name_col])
@@ -169,8 +167,7 @@ ew_oa_la_lookup_df = pd.read_csv(ew_oa_la_lookup_path,
 print('Processing output area boundaries')
 
 ew_oa_boundaries_df = pd.read_csv(
-        os.path.join("data",
-                     "Output_Areas__December_2011__Boundaries_EW_BGC.csv"))
+    di.PATHS.data("Output_Areas__December_2011__Boundaries_EW_BGC.csv"))
 
 # Restrict to just required columns
 ew_oa_boundaries_df = ew_oa_boundaries_df[['OA11CD', 'LAD11CD']]
@@ -182,16 +179,17 @@ ew_oa_boundaries_df = ew_oa_boundaries_df[['OA11CD', 'LAD11CD']]
 print('Processing population data')
 
 # Get list of all pop_estimate files for target year
-ew_pop_files = os.listdir(os.path.join(os.getcwd(),
-                                       "data",
-                                       "population_estimates",
-                                       POP_YEAR))
+ew_pop_files = os.listdir(di.PATHS.data("population_estimates",
+                                        POP_YEAR))
 
 # Get the population data for the whole nation for the specified year
-ew_pop_df = di.get_whole_nation_pop_df(ew_pop_files, POP_YEAR)
+ew_pop_df = di.get_whole_nation_pop_df(ew_pop_files, POP_YEAR,
+                                       workers=POP_STORE_WORKERS)
 
-# Keep only required columns
-ew_pop_df = ew_pop_df.drop(['LSOA11CD_x', 'LSOA11CD_y', 'LSOA11CD'], axis=1)
+# Keep only required columns. Older population files have the LSOA11CD
+# column from each sheet, suffixed _x and _y.
+ew_pop_df = ew_pop_df.drop(['LSOA11CD_x', 'LSOA11CD_y', 'LSOA11CD'], axis=1,
+                           errors='ignore')
 
 # Group and reformat age data
 # Get a list of ages from config
@@ -219,7 +217,7 @@ ew_pop_df = pd.merge(ew_pop_df, ew_age_df, left_index=True, right_index=True)
 print('Processing population weighted centroids')
 
 ew_pop_wtd_centr_df = (di.geo_df_from_geospatialfile(
-    os.path.join(DATA_DIR, 'pop_weighted_centroids', CENTROID_YEAR)))
+    di.PATHS.data('pop_weighted_centroids', CENTROID_YEAR)))
 
 # Keep required columns
 ew_pop_wtd_centr_df = ew_pop_wtd_centr_df[['OA11CD', 'geometry']]
@@ -231,7 +229,7 @@ ew_pop_wtd_centr_df = ew_pop_wtd_centr_df[['OA11CD', 'geometry']]
 print('Processing disability data')
 
 ew_disability_df = pd.read_csv(
-    os.path.join(CWD, "data", "disability_status", "nomis_QS303.csv"),
+    di.PATHS.data("disability_status", "nomis_QS303.csv"),
     header=5)
 
 # drop the column "mnemonic" as it seems to be a duplicate of the OA code
@@ -262,7 +260,7 @@ print('Processing rural urban classification data')
 
 ew_urb_rur_df = (di.any_to_pd("RUC11_OA11_EW",
                               URB_RUR_ZIP_LINK,
-                              ['csv'],
+                              ['feather', 'csv', 'zip'],
                               URB_RUR_TYPES))
 
 # These are the codes (RUC11CD) mapping to rural and urban descriptions (RUC11)
@@ -312,7 +310,7 @@ ew_df.drop(labels='geometry_la', axis=1, inplace=True)
 
 # Convert to geopandas df and drop uneeded geometry
 ew_df = gpd.GeoDataFrame(ew_df, geometry='geometry_pop', crs=DEFAULT_CRS)
+ew_df = ew_df.rename_geometry('geometry')
 
-# Export dataset to geojson
-path = os.path.join(ENG_WALES_PREPROCESSED_OUTPUT, 'ew_df.geojson')
-ew_df.to_file(path, driver='GeoJSON', index=False)
+# Export dataset to GeoParquet
+di.save_geo_df(ew_df, ENG_WALES_PREPROCESSED_OUTPUT, 'ew_df')
@@ -17,10 +17,10 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Our modules
 import data_ingest as di # noqa E402
-import data_transform as dt # noqa E402
+import time_table_utils as ttu # noqa E402
 
-# Get current working directory
-CWD = os.getcwd()
+# get the project root, as in data_ingest
+CWD = di.PATHS.root
 
 # Load config
 with open(os.path.join(CWD, "config.yaml")) as yamlfile:
@@ -30,36 +30,31 @@ with open(os.path.join(CWD, "config.yaml")) as yamlfile:
 
 # Parameters
 bus_timetable_zip_link = config["eng_bus_timetable_data"]
-bus_dataset_name = 'itm_all_gtfs'
-bus_data_output_dir = os.path.join(CWD, 'data', 'england_bus_timetable')
+bus_dataset_name = di.BUS_TIMETABLE_ZIP
+bus_data_output_dir = di.PATHS.data('england_bus_timetable')
 zip_path = os.path.join(bus_data_output_dir, bus_dataset_name)
-required_files = ['stop_times', 'trips', 'calendar']
+required_files = di.BUS_TIMETABLE_FILES
+# Exceptions to the calendar, used by the exact day filter if available
+optional_files = ['calendar_dates']
 auto_download_bus = config["auto_download_bus"]
 timetable_day = config["timetable_day"]
 day_filter_type = config["day_filter"]
 early_timetable_hour = config["early_timetable_hour"]
 late_timetable_hour = config["late_timetable_hour"]
+# Only the general day filter can be counted without the full timetable
+stream_stop_times = (config["bus_stream_stop_times"]
+                     and day_filter_type == "general")
+stop_times_block_size = config["stop_times_batch_mb"] * 1024 ** 2
+# Count every weekday and hour in one pass and save the counts, so other
+# days and hours can be looked at without reading the timetable again
+frequency_cube = config["frequency_cube"] and day_filter_type == "general"
+bus_cube_path = os.path.join(bus_data_output_dir, 'bus_frequency_cube.feather')
 
 # Calculate if bus timetable needs to be downloaded.
-# If current folder doesnt exist, or hasnt been modified then
+# If the files are missing, or were downloaded more than 7 days ago then
 # flag to be downloaded
-
-files_to_check = [f"{file}.txt" for file in required_files]
-paths_to_check = [os.path.join(bus_data_output_dir, file)
-                  for file in files_to_check]
-each_file_checked = [di._persistent_exists(path) for path in paths_to_check]
-
-if not all(each_file_checked):
-    try:
-        os.makedirs(bus_data_output_dir)
-    except FileExistsError:
-        print(f"Directory {bus_data_output_dir} already exists")
-    download_bus_timetable = True
-else:
-    # Find when the last download occured
-    # If > 7 days ago, download the data again
-    download_bus_timetable = di.best_before(path=bus_data_output_dir,
-                                            number_of_days=7)
+os.makedirs(bus_data_output_dir, exist_ok=True)
+download_bus_timetable = di.bus_timetable_is_due(bus_data_output_dir)
 
 # ---------------------------
 # Download bus timetable data
@@ -69,9 +64,14 @@ else:
 # Using individual data ingest functions (rather than
 # import_extract_delete_zip) as files are .txt not .csv.
 if download_bus_timetable and auto_download_bus:
-    di._grab_zip(file_nm=bus_dataset_name,
-                 zip_link=bus_timetable_zip_link,
-                 zip_path=zip_path)
+    # The zip may already have been fetched by di.prefetch_downloads, but
+    # is only used if it is as fresh as the timetable has to be
+    if (not di._persistent_exists(zip_path)
+            or di.best_before(path=zip_path,
+                              number_of_days=di.BUS_TIMETABLE_MAX_AGE_DAYS)):
+        di._grab_zip(file_nm=bus_dataset_name,
+                     zip_link=bus_timetable_zip_link,
+                     zip_path=zip_path)
 
     # Extract the required files
     for file in required_files:
@@ -82,6 +82,15 @@ if download_bus_timetable and auto_download_bus:
                         zip_path=zip_path,
                         csv_path=bus_data_output_dir)
 
+    for file in optional_files:
+        try:
+            di._extract_zip(file_nm=bus_dataset_name,
+                            csv_nm=f"{file}.txt",
+                            zip_path=zip_path,
+                            csv_path=bus_data_output_dir)
+        except FileNotFoundError:
+            print(f"{file}.txt is not in {zip_path}")
+
     # Remove zip file
     di._delete_junk(file_nm=bus_dataset_name,
                     zip_path=zip_path)
@@ -94,22 +103,38 @@ if download_bus_timetable and auto_download_bus:
 # mixed data types in certain columns.
 # Cannot parse datetime dtypes, and current function doesnt allow parse_dates
 # parameter in read_csv. So reading in as object type for the time being.
-# Dont think they need to be datetime format as we are using every trip
-# regardless of the date, and just want to extract the HH from the date which
-# can be done from a string.
+# Departure times are parsed once into seconds since midnight
+# (departure_secs), which is saved in stop_times.feather along with them.
 
 # Stop times
+stop_times_types = {'trip_id': 'category',
+                    'departure_time': 'object', 'stop_id': 'category'}
+stop_times_txt = os.path.join(bus_data_output_dir, 'stop_times.txt')
 feath_ = os.path.join(bus_data_output_dir, "stop_times.feather")
-if os.path.exists(feath_):
-    stop_times_df = di._feath_to_df("stop_times", feath_)
+# A feather saved before departure_secs was added is rebuilt with it
+save_stop_times = (not os.path.exists(feath_)
+                   or 'departure_secs' not in di._feather_columns(feath_))
+if stream_stop_times:
+    # Counted a batch at a time once trips and calendar are loaded
+    if save_stop_times:
+        stop_times_path = stop_times_txt
+    else:
+        stop_times_path = feath_
+        stop_times_types['departure_secs'] = 'int32'
+elif os.path.exists(feath_):
+    stop_times_df = di._feath_to_df("stop_times",
+                                    feath_,
+                                    memory_map=True)
 else:
-    stop_times_types = {'trip_id': 'category',
-                        'departure_time': 'object', 'stop_id': 'category'}
+    stop_times_df = di._read_csv(stop_times_txt,
+                                 'stop_times',
+                                 dtypes=stop_times_types)
 
-    stop_times_df = di._csv_to_df(file_nm='stop_times',
-                                  csv_path=os.path.join(
-                                      bus_data_output_dir, 'stop_times.txt'),
-                                  dtypes=stop_times_types)
+if not stream_stop_times and save_stop_times:
+    stop_times_df['departure_secs'] = ttu.parse_time_seconds(
+        stop_times_df['departure_time'])
+    # Save for faster retrieval, with the parsed times
+    di._pd_to_feather(stop_times_df, stop_times_txt, overwrite=True)
 
 # trips
 feath_ = os.path.join(bus_data_output_dir, "trips.feather")
@@ -148,26 +173,28 @@ else:
                                     bus_data_output_dir, 'calendar.txt'),
                                 dtypes=calendar_types)
 
+# calendar dates
+# Dates added to or removed from services, only needed to find the
+# services running on an exact date
+calendar_dates_df = None
+calendar_dates_txt = os.path.join(bus_data_output_dir, 'calendar_dates.txt')
+if day_filter_type == "exact" and os.path.exists(calendar_dates_txt):
+    calendar_dates_types = {'service_id': 'category',
+                            'date': 'object',
+                            'exception_type': 'int64'}
+    calendar_dates_df = di._read_csv(calendar_dates_txt,
+                                     'calendar_dates',
+                                     dtypes=calendar_dates_types)
+
 # ----------
 # Clean data
 # ----------
 
-# Some departure times are > 24:00 so need to be removed.
-# This is done automatically by restricting times to hours used
+# Some departure times are > 24:00, which are on the next day.
+# These are removed by restricting times to hours used
 # to define highly serviced stops
 
 hour_range = range(early_timetable_hour, late_timetable_hour)
-valid_hours = [f'0{i}' if i < 10 else f'{i}' for i in hour_range]
-
-# Check departure times for any NA values
-if stop_times_df['departure_time'].isna().any():
-    print("There are NA values in departure_time column")
-    # If there are any, remove them
-    stop_times_df = stop_times_df.dropna(subset=['departure_time'])
-
-# Filter stop times to only include valid hours
-stop_times_df = stop_times_df[
-    stop_times_df['departure_time'].str.startswith(tuple(valid_hours))]
 
 # Convert start and end date to datetime format
 calendar_df['start_date'] = pd.to_datetime(
@@ -175,54 +202,102 @@ calendar_df['start_date'] = pd.to_datetime(
 calendar_df['end_date'] = pd.to_datetime(
     calendar_df['end_date'], format='%Y%m%d')
 
-# ----------------
-# Join data frames
-# ----------------
-
-bus_timetable_df = (
-    (stop_times_df.merge(trips_df, on='trip_id', how='left'))
-    .merge(calendar_df, on='service_id', how='left')
-)
-
-# Remove columns no longer required
-# NOTE: Route_id not used at all so could be removed at load
-bus_timetable_df = bus_timetable_df.drop(
-    columns=['trip_id', 'route_id'])  # 'service_id'
-
-
-# ----------------------------
-# Extract stops for chosen day
-# ----------------------------
-
-# Only interested in stops that are used on a certain day
-
-if day_filter_type == "general":
+if stream_stop_times:
+    # Count the departures from each stop in each hour a batch of stop
+    # times at a time, so the joined timetable is never built
     timetable_day = timetable_day.lower()
-    serviced_bus_stops_df = (
-        bus_timetable_df[bus_timetable_df[timetable_day] == 1]
-    )
-elif day_filter_type == "exact":
-    timetable_day = timetable_day.capitalize()
-    serviced_bus_stops = dt.filter_bus_timetable_by_day(
-        bus_timetable_df, timetable_day.capitalize())
+    stop_times_batches = di.read_in_batches(stop_times_path,
+                                            stop_times_types,
+                                            block_size=stop_times_block_size)
+    if save_stop_times:
+        # Parse the times once and save them as the batches are counted
+        stop_times_batches = di.write_batches_to_feather(
+            (batch.assign(departure_secs=ttu.parse_time_seconds(
+                batch['departure_time']))
+             for batch in stop_times_batches),
+            feath_)
+    if frequency_cube:
+        trip_weights = ttu.trip_week_weights(trips_df, calendar_df,
+                                             ttu.WEEKDAYS)
+        bus_cube, bus_stops = ttu.count_frequency_cube_in_batches(
+            stop_times_batches, trip_weights)
+    else:
+        trip_weights = ttu.trip_day_weights(trips_df, calendar_df,
+                                            timetable_day)
+        bus_frequencies_df = ttu.count_stop_hours_in_batches(
+            stop_times_batches, trip_weights, hour_range)
 else:
-    print("Error: input error on day filter setting.")
-
-# -----------------------
-# Find frequency of stops
-# -----------------------
-
-# Take just HH from departure time
-serviced_bus_stops_df['departure_time'] = (
-    serviced_bus_stops_df['departure_time'].str.slice(0, 2)
-)
+    # Check departure times for any missing or unreadable values
+    if (stop_times_df['departure_secs'] < 0).any():
+        print("There are NA values in departure_time column")
+
+    # Filter stop times to only include valid hours, which also removes
+    # any missing times. The cube keeps every hour of the day.
+    stop_times_df = stop_times_df[ttu.in_hour_window(
+        stop_times_df['departure_secs'],
+        0 if frequency_cube else early_timetable_hour,
+        24 if frequency_cube else late_timetable_hour)]
+
+    # ----------------
+    # Join data frames
+    # ----------------
+
+    bus_timetable_df = (
+        (stop_times_df.merge(trips_df, on='trip_id', how='left'))
+        .merge(calendar_df, on='service_id', how='left')
+    )
 
-bus_frequencies_df = pd.pivot_table(data=serviced_bus_stops_df,
-                                    values=timetable_day,
-                                    index='stop_id',
-                                    columns='departure_time',
-                                    aggfunc=len,
-                                    fill_value=0)
+    # Remove columns no longer required
+    # NOTE: Route_id not used at all so could be removed at load
+    bus_timetable_df = bus_timetable_df.drop(
+        columns=['trip_id', 'route_id'])  # 'service_id'
+
+    # ----------------------------
+    # Extract stops for chosen day
+    # ----------------------------
+
+    # Only interested in stops that are used on a certain day
+
+    if frequency_cube:
+        timetable_day = timetable_day.lower()
+        bus_cube, bus_stops = ttu.build_frequency_cube(
+            bus_timetable_df['stop_id'],
+            bus_timetable_df['departure_secs'],
+            (bus_timetable_df[ttu.WEEKDAYS] == 1).to_numpy())
+    elif day_filter_type == "general":
+        timetable_day = timetable_day.lower()
+        serviced_bus_stops_df = (
+            bus_timetable_df[bus_timetable_df[timetable_day] == 1]
+        )
+    elif day_filter_type == "exact":
+        timetable_day = timetable_day.capitalize()
+        bus_calendar = ttu.gtfs_service_calendar(calendar_df,
+                                                 calendar_dates_df)
+        serviced_bus_stops_df = ttu.filter_timetable_by_day(
+            bus_timetable_df, timetable_day, calendar=bus_calendar)
+    else:
+        print("Error: input error on day filter setting.")
+
+    # -----------------------
+    # Find frequency of stops
+    # -----------------------
+
+    if not frequency_cube:
+        # Count the departures from each stop in each hour (HH)
+        bus_frequency_matrix, bus_stops = ttu.build_frequency_matrix(
+            serviced_bus_stops_df['stop_id'],
+            serviced_bus_stops_df['departure_secs'])
+        bus_frequencies_df = ttu.frequency_matrix_to_df(bus_frequency_matrix,
+                                                        bus_stops,
+                                                        hour_range)
+
+if frequency_cube:
+    # Save the departures for every weekday and hour, see
+    # ttu.highly_serviced_from_cube, then take the chosen day
+    ttu.save_frequency_cube(bus_cube, bus_stops, ttu.WEEKDAYS, bus_cube_path)
+    bus_frequencies_df = ttu.cube_frequencies(bus_cube, bus_stops,
+                                              ttu.WEEKDAYS, timetable_day,
+                                              hour_range)
 
 
 # -----------------------------
@@ -235,7 +310,7 @@ bus_highly_serviced_stops = bus_frequencies_df[(
 
 # Read in naptan data
 stops_df = di.get_stops_file(url=config["naptan_api"],
-                             dir=os.path.join(os.getcwd(), "data", "stops"))
+                             dir=di.PATHS.data("stops"))
 
 # Add easting and northing
 bus_highly_serviced_stops = bus_highly_serviced_stops.merge(
@@ -14,8 +14,8 @@ import time_table_utils as ttu # noqa E402
 import data_transform as dt # noqa E402
 import data_ingest as di # noqa E402
 
-# get current working directory
-CWD = os.getcwd()
+# get the project root, as in data_ingest
+CWD = di.PATHS.root
 
 # Load config
 with open(os.path.join(CWD, "config.yaml")) as yamlfile:
@@ -25,7 +25,7 @@ with open(os.path.join(CWD, "config.yaml")) as yamlfile:
 
 
 # Parameters
-trn_data_output_dir = os.path.join(CWD, 'data', 'england_train_timetable')
+trn_data_output_dir = di.PATHS.data('england_train_timetable')
 station_locations = os.path.join(trn_data_output_dir,
                                  config['station_locations'])
 msn_file = os.path.join(trn_data_output_dir, config["train_msn_filename"])
@@ -34,13 +34,27 @@ day_filter_type = config["day_filter"]
 timetable_day = config["timetable_day"]
 early_timetable_hour = config["early_timetable_hour"]
 late_timetable_hour = config["late_timetable_hour"]
-
-# Extract msn data
-msn_data = ttu.extract_msn_data(msn_file)
-
-# Create dataframe from msn data
-msn_df = pd.DataFrame(
-    msn_data, columns=['station_name', 'tiploc_code', 'crs_code'])
+# This script isn't under a __main__ guard, so keep this to 1 on Windows
+# and macOS, where the worker processes would run the script again
+mca_parse_workers = config["mca_parse_workers"]
+mca_chunk_size = config["mca_chunk_mb"] * 1024 ** 2
+# Count every weekday and hour in one pass and save the counts, so other
+# days and hours can be looked at without reading the timetable again
+frequency_cube = config["frequency_cube"] and day_filter_type == "general"
+train_cube_path = os.path.join(trn_data_output_dir,
+                               'train_frequency_cube.feather')
+
+# Extract msn and mca data
+# The parsed data is saved, and only parsed again if the msn or mca file
+# (or the parser) changes
+msn_df, mca_schedule_df, mca_stop_df = di.cached_parse(
+    ttu.extract_cif,
+    [msn_file, mca_file],
+    ['msn_stations', 'mca_schedules', 'mca_stops'],
+    os.path.join(trn_data_output_dir, 'parsed'),
+    ttu.CIF_PARSER_VERSION,
+    workers=mca_parse_workers,
+    chunk_size=mca_chunk_size)
 
 # Clean msn data
 # --------------
@@ -64,27 +78,6 @@ msn_data_df = msn_data_df[['station_name', 'tiploc_code',
 msn_data_df = msn_data_df.dropna(subset=['latitude', 'longitude'], how='any')
 
 
-schedules, stops = ttu.extract_mca(mca_file)
-
-
-# Add data into dataframes
-mca_schedule_df = pd.DataFrame(schedules,
-                               columns=['schedule_id',
-                                        'start_date',
-                                        'end_date',
-                                        'monday',
-                                        'tuesday',
-                                        'wednesday',
-                                        'thursday',
-                                        'friday'])
-
-mca_stop_df = pd.DataFrame(stops,
-                           columns=['schedule_id',
-                                    'departure_time',
-                                    'tiploc_code',
-                                    'activity_type'])
-
-
 # Clean data
 # ----------
 
@@ -98,14 +91,15 @@ mca_schedule_df = mca_schedule_df.drop_duplicates(subset=['schedule_id'])
 # take up and set down passengers). All other activity types unsuitable.
 mca_stop_df = mca_stop_df[mca_stop_df['activity_type'] == 'T']
 
-# Only keep records with departure time between highly serviced hours
+# Only keep records with departure time between highly serviced hours.
+# The cube keeps every hour of the day.
 hour_range = range(early_timetable_hour, late_timetable_hour)
 valid_hours = [f'0{i}' if i < 10 else f'{i}' for i in hour_range]
 
-mca_stop_df = (
-    mca_stop_df[
-        mca_stop_df['departure_time'].str.startswith(tuple(valid_hours))]
-)
+mca_stop_df = mca_stop_df[
+    ttu.in_hour_window(mca_stop_df['departure_secs'],
+                       0 if frequency_cube else early_timetable_hour,
+                       24 if frequency_cube else late_timetable_hour)]
 
 # Convert start and end date to datetime format
 mca_schedule_df['start_date'] = (
@@ -125,25 +119,27 @@ train_timetable_df = (
 )
 
 # Remove columns no longer required
-train_timetable_df = train_timetable_df.drop(columns=['schedule_id',
-                                                      'activity_type',
+# NB schedule_id is kept to find the schedules running on an exact date
+train_timetable_df = train_timetable_df.drop(columns=['activity_type',
                                                       'station_name'])
 
 # Extract stops for chosen day
 # ----------------------------
 
 # Only interested in stops on a certain day
-if day_filter_type == "general":
+if frequency_cube:
+    timetable_day = timetable_day.lower()
+elif day_filter_type == "general":
     timetable_day = timetable_day.lower()
     serviced_train_stops_df = (
         train_timetable_df[train_timetable_df[timetable_day] == 1]
     )
 elif day_filter_type == "exact":
     timetable_day = timetable_day.capitalize()
-    serviced_train_stops_df = (
-        dt.filter_timetable_by_day(
-            train_timetable_df, timetable_day.capitalize())
-    )
+    train_calendar = ttu.cif_schedule_calendar(mca_schedule_df)
+    serviced_train_stops_df = ttu.filter_timetable_by_day(
+        train_timetable_df, timetable_day, service_col='schedule_id',
+        calendar=train_calendar)
 else:
     print("Error: input error on day filter setting.")
 
@@ -151,17 +147,26 @@ else:
 # Find frequency of stops
 # -----------------------
 
-# Just take HH from departure time
-serviced_train_stops_df['departure_time'] = (
-    serviced_train_stops_df['departure_time'].str.slice(0, 2)
-)
-
-train_frequencies_df = pd.pivot_table(data=serviced_train_stops_df,
-                                      values=timetable_day,
-                                      index='tiploc_code',
-                                      columns='departure_time',
-                                      aggfunc=len,
-                                      fill_value=0)
+if frequency_cube:
+    # Count the departures for every weekday and hour and save them, see
+    # ttu.highly_serviced_from_cube, then take the chosen day
+    train_cube, train_stops = ttu.build_frequency_cube(
+        train_timetable_df['tiploc_code'],
+        train_timetable_df['departure_secs'],
+        (train_timetable_df[ttu.WEEKDAYS] == 1).to_numpy())
+    ttu.save_frequency_cube(train_cube, train_stops, ttu.WEEKDAYS,
+                            train_cube_path)
+    train_frequencies_df = ttu.cube_frequencies(train_cube, train_stops,
+                                                ttu.WEEKDAYS, timetable_day,
+                                                hour_range)
+else:
+    # Count the departures from each station in each hour (HH)
+    train_frequency_matrix, train_stops = ttu.build_frequency_matrix(
+        serviced_train_stops_df['tiploc_code'],
+        serviced_train_stops_df['departure_secs'])
+    train_frequencies_df = ttu.frequency_matrix_to_df(train_frequency_matrix,
+                                                      train_stops,
+                                                      hour_range)
 
 
 # Extract highly serviced stops
@@ -174,9 +179,7 @@ highly_serviced_train_stops_df = (
 
 # Get the naptan data and limit to only the columns we need
 naptan_df = di.get_stops_file(url=config["naptan_api"],
-                              dir=os.path.join(os.getcwd(),
-                                               "data",
-                                               "stops"))
+                              dir=di.PATHS.data("stops"))
 # Create Tiploc column
 naptan_df = dt.create_tiploc_col(naptan_df)
 
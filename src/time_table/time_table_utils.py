@@ -1,12 +1,19 @@
 """All functions realted to the bus and train timetable data."""
 
 import logging
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from typing import List, Tuple
+from typing import Iterable, List, NamedTuple, Optional, Tuple
 
 # Create logger
 logger = logging.getLogger(__name__)
 
+# The days of the week in the timetables' calendars that are analysed
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday']
+
 
 def filter_stops(stops_df: pd.DataFrame) -> pd.DataFrame:
     """Filters the stops dataframe based on two things:
@@ -70,12 +77,178 @@ def add_stop_capacity_type(stops_df: pd.DataFrame) -> pd.DataFrame:
     return stops_df
 
 
+class ServiceCalendar(NamedTuple):
+    """The dates each service (or schedule) runs on, as one bitset per
+    service with a bit for each date.
+
+    Attributes:
+        bitsets (np.ndarray): uint8 bits packed by np.packbits, a row for
+            each service and a bit for each date, set if it runs.
+        services (pd.Index): the service of each row.
+        dates (pd.DatetimeIndex): the date of each bit.
+    """
+    bitsets: np.ndarray
+    services: pd.Index
+    dates: pd.DatetimeIndex
+
+
+def build_service_calendar(service_ids: pd.Series,
+                           start_dates: pd.Series,
+                           end_dates: pd.Series,
+                           day_flags: pd.DataFrame,
+                           exceptions: Optional[pd.DataFrame] = None,
+                           block_size: int = 4096) -> ServiceCalendar:
+    """Expands the date ranges and days of the week of services into the
+    dates they run on.
+
+    Each service runs on the dates from its start date to its end date
+    (inclusive) that fall on a day it is flagged to run on. Exceptions
+    then add (exception_type 1) or remove (exception_type 2) single
+    dates, as in GTFS calendar_dates. Services that only appear in the
+    exceptions are added too.
+
+    The services are expanded a block at a time, so the dates of only
+    block_size services are ever held unpacked.
+
+    Args:
+        service_ids (pd.Series): the id of each service.
+        start_dates (pd.Series): the first date of each service.
+        end_dates (pd.Series): the last date of each service.
+        day_flags (pd.DataFrame): a 0/1 column for each day of the week
+            (monday to sunday) that the services have. Missing days are
+            taken as not running.
+        exceptions (pd.DataFrame, optional): service_id, date and
+            exception_type of dates added to or removed from services.
+            Defaults to None.
+        block_size (int, optional): services expanded at a time. Defaults
+            to 4096.
+
+    Returns:
+        ServiceCalendar: the dates each service runs on.
+    """
+    start_dates = pd.to_datetime(start_dates).to_numpy('datetime64[D]')
+    end_dates = pd.to_datetime(end_dates).to_numpy('datetime64[D]')
+    services = pd.Index(pd.unique(np.asarray(service_ids, dtype=object)))
+    if exceptions is not None:
+        exception_dates = pd.to_datetime(exceptions['date'].astype(str),
+                                         format='%Y%m%d'
+                                         ).to_numpy('datetime64[D]')
+        services = services.append(pd.Index(pd.unique(
+            np.asarray(exceptions['service_id'], dtype=object)))).unique()
+    else:
+        exception_dates = np.array([], dtype='datetime64[D]')
+    all_dates = np.concatenate([start_dates, end_dates, exception_dates])
+    dates = pd.date_range(all_dates.min(), all_dates.max())
+    first_date = dates[0].to_datetime64().astype('datetime64[D]')
+    n_bytes = -(-len(dates) // 8)
+
+    # Days since the first date, and whether each date's day of the week
+    # is flagged for each service (monday is 0)
+    starts = (start_dates - first_date).astype(np.int64)
+    ends = (end_dates - first_date).astype(np.int64)
+    week = np.zeros((len(service_ids), 7), dtype=bool)
+    for day_no, day in enumerate(WEEKDAYS + ['saturday', 'sunday']):
+        if day in day_flags:
+            week[:, day_no] = day_flags[day].to_numpy() == 1
+    date_nos = np.arange(len(dates))
+    weekdays = dates.dayofweek.to_numpy()
+
+    bitsets = np.zeros((len(services), n_bytes), dtype=np.uint8)
+    rows = services.get_indexer(np.asarray(service_ids, dtype=object))
+    for first in range(0, len(rows), block_size):
+        block = np.arange(first, min(first + block_size, len(rows)))
+        block = block[rows[block] >= 0]
+        runs = ((date_nos >= starts[block, None])
+                & (date_nos <= ends[block, None])
+                & week[block][:, weekdays])
+        # A service can have more than one row, e.g. CIF schedules
+        np.bitwise_or.at(bitsets, rows[block],
+                         np.packbits(runs, axis=1))
+
+    if exceptions is not None:
+        exception_rows = services.get_indexer(
+            np.asarray(exceptions['service_id'], dtype=object))
+        exception_nos = (exception_dates - first_date).astype(np.int64)
+        masks = (0x80 >> (exception_nos % 8)).astype(np.uint8)
+        added = exceptions['exception_type'].to_numpy() == 1
+        np.bitwise_or.at(bitsets,
+                         (exception_rows[added], exception_nos[added] // 8),
+                         masks[added])
+        removed = exceptions['exception_type'].to_numpy() == 2
+        np.bitwise_and.at(bitsets,
+                          (exception_rows[removed],
+                           exception_nos[removed] // 8),
+                          ~masks[removed])
+    return ServiceCalendar(bitsets, services, dates)
+
+
+def gtfs_service_calendar(calendar_df: pd.DataFrame,
+                          calendar_dates_df: Optional[pd.DataFrame] = None
+                          ) -> ServiceCalendar:
+    """Expands a GTFS calendar, and its calendar_dates exceptions if
+    there are any, into the dates each service runs on.
+
+    Args:
+        calendar_df (pd.DataFrame): GTFS calendar, with service_id,
+            start_date, end_date and the day of the week columns.
+        calendar_dates_df (pd.DataFrame, optional): GTFS calendar_dates,
+            with service_id, date and exception_type. Defaults to None.
+
+    Returns:
+        ServiceCalendar: the dates each service runs on.
+    """
+    return build_service_calendar(calendar_df['service_id'],
+                                  calendar_df['start_date'],
+                                  calendar_df['end_date'],
+                                  calendar_df,
+                                  exceptions=calendar_dates_df)
+
+
+def cif_schedule_calendar(schedule_df: pd.DataFrame) -> ServiceCalendar:
+    """Expands the date ranges and days of CIF schedules into the dates
+    each schedule runs on.
+
+    Args:
+        schedule_df (pd.DataFrame): schedules from extract_mca, with the
+            start and end dates as datetimes.
+
+    Returns:
+        ServiceCalendar: the dates each schedule_id runs on.
+    """
+    return build_service_calendar(schedule_df['schedule_id'],
+                                  schedule_df['start_date'],
+                                  schedule_df['end_date'],
+                                  schedule_df)
+
+
+def services_running_on(calendar: ServiceCalendar,
+                        date: pd.Timestamp) -> np.ndarray:
+    """Tests the bit for a date in every service's bitset at once.
+
+    Args:
+        calendar (ServiceCalendar): the dates each service runs on.
+        date (pd.Timestamp): the date to test.
+
+    Returns:
+        np.ndarray: True for each service (in calendar.services) that runs
+            on the date. All False if the date is outside the calendar.
+    """
+    if date not in calendar.dates:
+        return np.zeros(len(calendar.services), dtype=bool)
+    date_no = calendar.dates.get_loc(date)
+    mask = np.uint8(0x80 >> (date_no % 8))
+    return (calendar.bitsets[:, date_no // 8] & mask) != 0
+
+
 def filter_timetable_by_day(timetable_df: pd.DataFrame,
-                            day: str) -> pd.DataFrame:
+                            day: str,
+                            service_col: str = 'service_id',
+                            calendar: Optional[ServiceCalendar] = None
+                            ) -> pd.DataFrame:
     """Extract serviced stops based on specific day of the week.
 
     The day is selected from the available days in the date range present in
-      timetable data.
+      the calendar.
 
     1) identifies which days dates in the entire date range
     2) counts days of each type to get the maximum position order
@@ -83,11 +256,18 @@ def filter_timetable_by_day(timetable_df: pd.DataFrame,
     4) creates ord value that is half of maximum position order to ensure
     as many services get included as possible.
     4) selects a date based on the day and ord parameters
-    5) filters the dataframe to that date
+    5) tests which services run on that date in their calendar bitsets,
+    once per service, and keeps the rows of those services
 
     Args:
         timetable_df (pandas dataframe): df to filter
         day (str) : day of the week in title case, e.g. "Wednesday"
+        service_col (str, optional): column with the id of each row's
+            service. Defaults to "service_id".
+        calendar (ServiceCalendar, optional): the dates each service runs
+            on, e.g. from gtfs_service_calendar, which can include
+            exceptions. Defaults to the start_date, end_date and day
+            columns of the services in timetable_df.
 
     Returns:
         pd.DataFrame: filtered pandas dataframe
@@ -96,18 +276,17 @@ def filter_timetable_by_day(timetable_df: pd.DataFrame,
     original_rows = timetable_df.shape[0]
 
     # Count the services
-    orig_service_count = timetable_df.service_id.unique().shape[0]
+    orig_service_count = timetable_df[service_col].unique().shape[0]
 
-    # Get the minimum date range
-    earliest_start_date = timetable_df.start_date.min()
-    latest_end_date = timetable_df.end_date.max()
+    if calendar is None:
+        services_df = timetable_df[~timetable_df[service_col].duplicated()]
+        calendar = build_service_calendar(services_df[service_col],
+                                          services_df['start_date'],
+                                          services_df['end_date'],
+                                          services_df)
 
     # Identify days in the range and count them
-    date_range = pd.date_range(earliest_start_date, latest_end_date)
-    date_day_couplings_df = pd.DataFrame({"date": date_range,
-                                          "day_name": date_range.day_name()})
-    days_counted = date_day_couplings_df.day_name.value_counts()
-    days_counted_dict = days_counted.to_dict()
+    days_counted_dict = calendar.dates.day_name().value_counts().to_dict()
 
     # Validate user choices
     if day not in days_counted_dict.keys():
@@ -118,51 +297,450 @@ def filter_timetable_by_day(timetable_df: pd.DataFrame,
     max_ord = days_counted_dict[day]
     ord = round(max_ord / 2)
 
-    # Filter all the dates down the to the day needed
-    day_filtered_dates = (date_day_couplings_df
-                          [date_day_couplings_df.day_name == day])
-
     # Get date of the nth (ord) day
+    day_filtered_dates = calendar.dates[calendar.dates.day_name() == day]
     nth = ord - 1
-    date_of_day_entered = day_filtered_dates.iloc[nth].date
+    date_of_day_entered = day_filtered_dates[nth]
 
-    # Filter the timetable_df by date range
-    timetable_df = timetable_df[(timetable_df['start_date']
-                                 <= date_of_day_entered) &
-                                (timetable_df['end_date']
-                                 >= date_of_day_entered)]
+    # Filter the timetable_df to the services running on that date
+    running = np.append(services_running_on(calendar, date_of_day_entered),
+                        False)
+    service_rows = calendar.services.get_indexer(
+        np.asarray(timetable_df[service_col], dtype=object))
+    timetable_df = timetable_df[running[service_rows]]
 
-    # Then filter to day of interest
-    timetable_df = timetable_df[timetable_df[day.lower()] == 1]
-
-    # Filter the timetable_df by date range
-    timetable_df = timetable_df[(timetable_df['start_date']
-                                 <= date_of_day_entered) &
-                                (timetable_df['end_date']
-                                 >= date_of_day_entered)]
-
-    # Then filter to day of interest
-    timetable_df = timetable_df[timetable_df[day.lower()] == 1]
-
-    # Print date being used (consider logging instead)
     day_date = date_of_day_entered.date()
-    logger(f"The date of {day} number {ord} is {day_date}")
+    logger.info(f"The date of {day} number {ord} is {day_date}")
 
-    # Print how many rows have been dropped (consider logging instead)
-    logger(
-        f"Selecting only services covering {day_date} reduced records"
+    logger.info(
+        f"Selecting only services covering {day_date} reduced records "
         f"by {original_rows-timetable_df.shape[0]} rows"
     )
 
-    # Print how many services are in the analysis and how many were dropped
-    service_count = timetable_df.service_id.unique().shape[0]
+    # Log how many services are in the analysis and how many were dropped
+    service_count = timetable_df[service_col].unique().shape[0]
     dropped_services = orig_service_count - service_count
-    logger(f"There are {service_count} services in the analysis")
-    logger(f"Filtering by day has reduced services by {dropped_services}")
+    logger.info(f"There are {service_count} services in the analysis")
+    logger.info(
+        f"Filtering by day has reduced services by {dropped_services}")
 
     return timetable_df
 
 
+def trip_week_weights(trips_df: pd.DataFrame,
+                      calendar_df: pd.DataFrame,
+                      days: List[str]) -> pd.DataFrame:
+    """Counts how many times each trip appears in the timetable for each
+    of a list of days.
+
+    This is the number of rows each stop time of the trip would turn into
+    on joining trips and calendar and keeping the rows for the day. It is
+    usually 1 for trips that run on the day and 0 for trips that don't.
+
+    Args:
+        trips_df (pd.DataFrame): trips, with trip_id and service_id.
+        calendar_df (pd.DataFrame): calendar, with service_id and a 0/1
+            column for each day of the week.
+        days (List[str]): the day columns, e.g. ["monday", "tuesday"].
+
+    Returns:
+        pd.DataFrame: the counts for each day, indexed by trip_id, for the
+            trips that run on at least one of the days.
+    """
+    trip_services = trips_df[['trip_id', 'service_id']].astype(object)
+    services = calendar_df[['service_id']].astype(object)
+    services[days] = (calendar_df[days] == 1).astype(np.int64)
+    trip_days = (trip_services.merge(services, on='service_id')
+                 .groupby('trip_id', sort=False)[days].sum())
+    return trip_days[trip_days.any(axis=1)]
+
+
+def trip_day_weights(trips_df: pd.DataFrame,
+                     calendar_df: pd.DataFrame,
+                     day: str) -> pd.Series:
+    """Counts how many times each trip appears in the timetable for a day,
+    see trip_week_weights.
+
+    Args:
+        trips_df (pd.DataFrame): trips, with trip_id and service_id.
+        calendar_df (pd.DataFrame): calendar, with service_id and a 0/1
+            column for each day of the week.
+        day (str): the day column, e.g. "wednesday".
+
+    Returns:
+        pd.Series: the count for each trip that runs, indexed by trip_id.
+    """
+    day_weights = trip_week_weights(trips_df, calendar_df, [day])[day]
+    return day_weights[day_weights > 0]
+
+
+def parse_time_seconds(times: pd.Series) -> np.ndarray:
+    """Turns timetable times into seconds since midnight.
+
+    Takes GTFS times (HH:MM:SS, or H:MM:SS before 10am) and CIF times
+    (hhmm, with an H after a half minute). Each distinct time is only
+    parsed once.
+
+    GTFS times past midnight are kept past 24 hours, e.g. 25:10:00 is
+    90600, as they belong to the service day the trip started on rather
+    than the early hours of that day.
+
+    Args:
+        times (pd.Series): the times, as strings.
+
+    Returns:
+        np.ndarray: int32 seconds since midnight, -1 where the time is
+            missing or can't be read.
+    """
+    time_codes, distinct_times = pd.factorize(times)
+    parts = (pd.Series(np.asarray(distinct_times, dtype=object), dtype=object)
+             .str.strip()
+             .str.extract(r'^(\d{1,2}):?(\d{2})(?::(\d{2}))?(H)?$'))
+    hours = pd.to_numeric(parts[0]).fillna(-1).to_numpy(np.int64)
+    minutes = pd.to_numeric(parts[1]).fillna(0).to_numpy(np.int64)
+    seconds = (pd.to_numeric(parts[2]).fillna(0).to_numpy(np.int64)
+               + 30 * parts[3].notna().to_numpy())
+    secs = np.where((hours >= 0) & (minutes < 60) & (seconds < 60),
+                    hours * 3600 + minutes * 60 + seconds, -1)
+    # Missing values are coded as -1 by factorize, so they get the last
+    return np.append(secs, -1).astype(np.int32)[time_codes]
+
+
+def in_hour_window(departure_secs: np.ndarray,
+                   early_hour: int,
+                   late_hour: int) -> np.ndarray:
+    """Finds the departures from the start of early_hour up to the start
+    of late_hour.
+
+    Args:
+        departure_secs (np.ndarray): seconds since midnight, see
+            parse_time_seconds.
+        early_hour (int): the first hour in the window.
+        late_hour (int): the hour after the window.
+
+    Returns:
+        np.ndarray: True for each departure in the window.
+    """
+    departure_secs = np.asarray(departure_secs)
+    return ((departure_secs >= early_hour * 3600)
+            & (departure_secs < late_hour * 3600))
+
+
+def _stop_order(stops: pd.Index) -> np.ndarray:
+    """Gets the order that sorts stops by their ids.
+
+    Args:
+        stops (pd.Index): the stops, which may be categorical.
+
+    Returns:
+        np.ndarray: the positions of the stops in sorted order.
+    """
+    return np.argsort(np.asarray(stops, dtype=object), kind='stable')
+
+
+def build_frequency_cube(stop_ids: pd.Series,
+                         departure_secs: np.ndarray,
+                         day_weights: np.ndarray,
+                         sort: bool = True) -> Tuple[np.ndarray, pd.Index]:
+    """Counts the departures from each stop in each hour of each day.
+
+    The stops are numbered with pd.factorize and the hour is the departure
+    time in seconds divided by 3600, so each day is a single np.bincount
+    over stop number * 24 + hour, weighted by that day's column. Counting
+    a day at a time keeps the extra memory to a few arrays the length of
+    the rows, however many days there are.
+
+    Departures with a missing stop or time are not counted, and neither
+    are times past 24 hours, as they are in the early hours of the next
+    day.
+
+    Args:
+        stop_ids (pd.Series): the stop of each departure.
+        departure_secs (np.ndarray): the time of each departure in seconds
+            since midnight, see parse_time_seconds.
+        day_weights (np.ndarray): how many departures each row counts as
+            on each day, one column per day, e.g. the 0/1 weekday columns
+            of a timetable.
+        sort (bool, optional): Sort the stops by id, otherwise they are in
+            the order they first appear. Categorical ids are sorted by
+            value too, not by the order of their categories, which differs
+            between the csv engines. Defaults to True.
+
+    Returns:
+        np.ndarray: uint16 cube of departures, indexed by stop, day and
+            hour. Counts above the uint16 maximum are capped.
+        pd.Index: the stop of each row, named like stop_ids.
+    """
+    stop_codes, stops = pd.factorize(stop_ids)
+    if sort:
+        order = _stop_order(stops)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        # Missing stops are coded as -1 by factorize, so they get the last
+        stop_codes = np.append(rank, -1)[stop_codes]
+        stops = stops[order]
+    hours = np.asarray(departure_secs) // 3600
+    day_weights = np.asarray(day_weights).reshape(len(stop_codes), -1)
+    n_days = day_weights.shape[1]
+
+    counted = in_hour_window(departure_secs, 0, 24) & (stop_codes >= 0)
+    stop_hours = stop_codes[counted] * 24 + hours[counted]
+    cube = np.zeros((len(stops), n_days, 24), dtype=np.uint16)
+    for day in range(n_days):
+        counts = np.bincount(stop_hours,
+                             weights=day_weights[counted, day],
+                             minlength=len(stops) * 24)
+        cube[:, day] = np.minimum(counts, np.iinfo(np.uint16).max
+                                  ).reshape(-1, 24)
+    return cube, pd.Index(stops, name=stop_ids.name)
+
+
+def build_frequency_matrix(stop_ids: pd.Series,
+                           departure_secs: np.ndarray,
+                           weights: Optional[np.ndarray] = None,
+                           sort: bool = True) -> Tuple[np.ndarray, pd.Index]:
+    """Counts the departures from each stop in each hour of the day, see
+    build_frequency_cube.
+
+    Args:
+        stop_ids (pd.Series): the stop of each departure.
+        departure_secs (np.ndarray): the time of each departure in seconds
+            since midnight, see parse_time_seconds.
+        weights (np.ndarray, optional): how many departures each row
+            counts as. Defaults to one each.
+        sort (bool, optional): Sort the stops by id, otherwise they are in
+            the order they first appear. Defaults to True.
+
+    Returns:
+        np.ndarray: uint16 matrix of departures, a row for each stop and a
+            column for each hour. Counts above the uint16 maximum are
+            capped.
+        pd.Index: the stop of each row, named like stop_ids.
+    """
+    if weights is None:
+        weights = np.ones(len(stop_ids), dtype=np.int64)
+    cube, stops = build_frequency_cube(stop_ids, departure_secs,
+                                       np.asarray(weights)[:, None],
+                                       sort=sort)
+    return cube[:, 0], stops
+
+
+def frequency_matrix_to_df(matrix: np.ndarray,
+                           stops: pd.Index,
+                           hours: Optional[Iterable[int]] = None
+                           ) -> pd.DataFrame:
+    """Turns a frequency matrix into a dataframe like the pivot table of
+    departures by stop and hour.
+
+    As in the pivot, only the stops and hours with at least one departure
+    are kept.
+
+    Args:
+        matrix (np.ndarray): departures, see build_frequency_matrix.
+        stops (pd.Index): the stop of each row of the matrix.
+        hours (Iterable[int], optional): the hours to keep, e.g.
+            range(6, 20). Defaults to all hours.
+
+    Returns:
+        pd.DataFrame: number of departures, with a row for each stop and a
+            column for each hour (departure_time), labelled with two
+            digits, e.g. "06".
+    """
+    hour_labels = np.array([f'{hour:02d}' for hour in range(24)])
+    if hours is not None:
+        keep_hours = np.isin(np.arange(24), list(hours))
+        matrix, hour_labels = matrix[:, keep_hours], hour_labels[keep_hours]
+    has_stop = matrix.any(axis=1)
+    has_hour = matrix.any(axis=0)
+    return pd.DataFrame(matrix[has_stop][:, has_hour],
+                        index=stops[has_stop],
+                        columns=pd.Index(hour_labels[has_hour],
+                                         name='departure_time'))
+
+
+def count_frequency_cube_in_batches(
+        stop_times_batches: Iterable[pd.DataFrame],
+        trip_weights: pd.DataFrame,
+        sort: bool = True) -> Tuple[np.ndarray, pd.Index]:
+    """Counts the departures from each stop in each hour of each day, a
+    batch of stop times at a time.
+
+    Gives the same counts as joining all the stop times onto their trips
+    and calendar and counting them with build_frequency_cube, but only one
+    batch of stop times is ever in memory. Each batch is looked up in
+    trip_weights, counted with build_frequency_cube and added into a
+    running count for every stop.
+
+    Args:
+        stop_times_batches (Iterable[pd.DataFrame]): batches of stop times,
+            with trip_id, stop_id and departure_secs (or departure_time,
+            which is parsed if departure_secs isn't there).
+        trip_weights (pd.DataFrame): times each trip runs on each day, see
+            trip_week_weights.
+        sort (bool, optional): Sort the stops by id, as
+            build_frequency_cube does, otherwise they are in the order they
+            first appear in the stop times. Defaults to True.
+
+    Returns:
+        np.ndarray: uint16 cube of departures, indexed by stop, day (in the
+            order of the trip_weights columns) and hour.
+        pd.Index: the stop_id of each row.
+    """
+    n_days = trip_weights.shape[1]
+    weight_values = np.vstack([trip_weights.to_numpy(),
+                               np.zeros((1, n_days), dtype=np.int64)])
+    stop_codes = {}
+    counts = np.zeros((0, n_days, 24), dtype=np.uint32)
+    for batch in stop_times_batches:
+        # Trips missing from trip_weights don't run on any of the days
+        batch_trips, trip_ids = pd.factorize(batch['trip_id'])
+        trip_weight = weight_values[trip_weights.index.get_indexer(
+            np.asarray(trip_ids, dtype=object))]
+        weight = np.vstack([trip_weight,
+                            np.zeros((1, n_days), dtype=np.int64)]
+                           )[batch_trips]
+
+        if 'departure_secs' in batch:
+            departure_secs = batch['departure_secs'].to_numpy()
+        else:
+            departure_secs = parse_time_seconds(batch['departure_time'])
+        batch_cube, batch_stops = build_frequency_cube(
+            batch['stop_id'], departure_secs, weight, sort=False)
+        # Give each stop a number, in the order they are first seen
+        stop_numbers = np.array([stop_codes.setdefault(stop_id,
+                                                       len(stop_codes))
+                                 for stop_id in batch_stops], dtype=np.int64)
+        counts = np.concatenate(
+            [counts, np.zeros((len(stop_codes) - len(counts), n_days, 24),
+                              dtype=np.uint32)])
+        counts[stop_numbers] += batch_cube
+
+    cube = np.minimum(counts, np.iinfo(np.uint16).max).astype(np.uint16)
+    stops = pd.Index(np.array(list(stop_codes), dtype=object), name='stop_id')
+    if sort:
+        order = _stop_order(stops)
+        cube, stops = cube[order], stops[order]
+    return cube, stops
+
+
+def count_stop_hours_in_batches(stop_times_batches: Iterable[pd.DataFrame],
+                                trip_weights: pd.Series,
+                                hours: Iterable[int]) -> pd.DataFrame:
+    """Counts the departures from each stop in each hour, a batch of stop
+    times at a time, see count_frequency_cube_in_batches.
+
+    Gives the same counts as joining all the stop times onto their trips
+    and calendar, keeping the day, and pivoting on stop_id and hour. Like
+    the pivot, only stops and hours with at least one departure are kept.
+
+    Args:
+        stop_times_batches (Iterable[pd.DataFrame]): batches of stop times,
+            with trip_id, stop_id and departure_secs (or departure_time).
+        trip_weights (pd.Series): times each trip runs, see
+            trip_day_weights.
+        hours (Iterable[int]): the hours to count, e.g. range(6, 20).
+            Departures in other hours are ignored.
+
+    Returns:
+        pd.DataFrame: number of departures, with a row for each stop_id and
+            a column for each hour (departure_time).
+    """
+    cube, stops = count_frequency_cube_in_batches(stop_times_batches,
+                                                  trip_weights.to_frame())
+    return frequency_matrix_to_df(cube[:, 0], stops, hours)
+
+
+def save_frequency_cube(cube: np.ndarray,
+                        stops: pd.Index,
+                        days: List[str],
+                        cube_path: str):
+    """Saves a cube of departures by stop, day and hour as feather, with a
+    row for each stop and a column for each day and hour, e.g. monday_06.
+
+    Args:
+        cube (np.ndarray): departures, see build_frequency_cube.
+        stops (pd.Index): the stop of each row of the cube.
+        days (List[str]): the day of each column of the cube.
+        cube_path (str): path/to/the/cube.feather.
+    """
+    columns = [f'{day}_{hour:02d}' for day in days for hour in range(24)]
+    cube_df = pd.DataFrame(cube.reshape(len(stops), -1), columns=columns)
+    cube_df.insert(0, stops.name, np.asarray(stops))
+    print(f"Writing departures by stop, day and hour to {cube_path}")
+    cube_df.to_feather(cube_path)
+
+
+def read_frequency_cube(cube_path: str) -> Tuple[np.ndarray, pd.Index,
+                                                 List[str]]:
+    """Reads a cube of departures saved by save_frequency_cube.
+
+    Args:
+        cube_path (str): path/to/the/cube.feather.
+
+    Returns:
+        np.ndarray: uint16 cube of departures, indexed by stop, day and
+            hour.
+        pd.Index: the stop of each row of the cube.
+        List[str]: the day of each column of the cube.
+    """
+    cube_df = pd.read_feather(cube_path)
+    stops = pd.Index(cube_df.iloc[:, 0], name=cube_df.columns[0])
+    days = list(dict.fromkeys(column.rsplit('_', 1)[0]
+                              for column in cube_df.columns[1:]))
+    cube = cube_df.iloc[:, 1:].to_numpy(np.uint16).reshape(len(stops),
+                                                           len(days), 24)
+    return cube, stops, days
+
+
+def cube_frequencies(cube: np.ndarray,
+                     stops: pd.Index,
+                     days: List[str],
+                     day: str,
+                     hours: Optional[Iterable[int]] = None) -> pd.DataFrame:
+    """Takes the departures on one day out of a cube of departures by stop,
+    day and hour, as a dataframe like frequency_matrix_to_df.
+
+    Args:
+        cube (np.ndarray): departures, see build_frequency_cube.
+        stops (pd.Index): the stop of each row of the cube.
+        days (List[str]): the day of each column of the cube.
+        day (str): the day to take, e.g. "wednesday".
+        hours (Iterable[int], optional): the hours to keep, e.g.
+            range(6, 20). Defaults to all hours.
+
+    Returns:
+        pd.DataFrame: number of departures, with a row for each stop and a
+            column for each hour (departure_time).
+    """
+    return frequency_matrix_to_df(cube[:, days.index(day)], stops, hours)
+
+
+def highly_serviced_from_cube(cube_path: str,
+                              day: str,
+                              early_hour: int,
+                              late_hour: int) -> pd.Index:
+    """Finds the highly serviced stops for any day and hour window from a
+    saved cube of departures, without reading the timetable again.
+
+    As in the timetable scripts, a stop is highly serviced if it has at
+    least one departure in every hour of the window that has departures
+    from any stop.
+
+    Args:
+        cube_path (str): path/to/the/cube.feather.
+        day (str): the day, e.g. "wednesday".
+        early_hour (int): the first hour in the window.
+        late_hour (int): the hour after the window.
+
+    Returns:
+        pd.Index: the highly serviced stops.
+    """
+    cube, stops, days = read_frequency_cube(cube_path)
+    frequencies_df = cube_frequencies(cube, stops, days, day,
+                                      range(early_hour, late_hour))
+    return frequencies_df.index[(frequencies_df > 0).all(axis=1)]
+
+
 def extract_msn_data(msn_file: str) -> List[List]:
     """Extract data from the msn file.
 
@@ -200,8 +778,335 @@ def extract_msn_data(msn_file: str) -> List[List]:
     return msn_data_lst
 
 
-# add type hints
-def extract_mca(mca_file: str) -> Tuple[List[List], List[List]]:
+# Version of the msn and mca parsers, increase this whenever their output
+# changes so that cached outputs are parsed again
+CIF_PARSER_VERSION = 2
+MSN_COLS = ['station_name', 'tiploc_code', 'crs_code']
+# Schedule (BS) columns and the character positions they are taken from
+MCA_SCHEDULE_COLS = ['schedule_id', 'start_date', 'end_date'] + WEEKDAYS
+MCA_STOP_COLS = ['schedule_id', 'departure_time', 'tiploc_code',
+                 'activity_type', 'departure_secs']
+# Positions of departure_time, tiploc_code and activity_type in each
+# type of stop record: origin (LO), intermediate (LI) and terminus (LT)
+MCA_STOP_FIELDS = {b'LO': [(10, 14), (2, 10), (29, 41)],
+                   b'LI': [(15, 19), (2, 10), (42, 54)],
+                   b'LT': [(15, 19), (2, 10), (25, 37)]}
+# Position of the H that marks a half minute after the departure time. The
+# public arrival time of a terminus (LT) is always a whole minute.
+MCA_HALF_MINUTE = {b'LO': 14, b'LI': 19}
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def _record_code(record_type: bytes) -> int:
+    """Gives the number that a two character record type is compared as.
+
+    Args:
+        record_type (bytes): e.g. b'LO'.
+
+    Returns:
+        int: the record type as a big endian number.
+    """
+    return int.from_bytes(record_type, 'big')
+
+
+def _line_bounds(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds where each line of a memory mapped text file starts and ends.
+
+    Args:
+        data (np.ndarray): the bytes of the file, as uint8.
+
+    Returns:
+        np.ndarray: the offset of the first byte of each line.
+        np.ndarray: the offset just past the last byte of each line,
+            excluding the newline.
+    """
+    newlines = np.flatnonzero(data == ord('\n'))
+    starts = np.concatenate([[0], newlines + 1])
+    ends = np.concatenate([newlines, [len(data)]])
+    # Drop the empty "line" after a final newline
+    if starts[-1] == len(data):
+        starts, ends = starts[:-1], ends[:-1]
+    return starts, ends
+
+
+def _fixed_width_field(data: np.ndarray,
+                       starts: np.ndarray,
+                       ends: np.ndarray,
+                       first: int,
+                       last: int) -> np.ndarray:
+    """Slices the same characters out of many lines at once, like
+    line[first:last] for each line.
+
+    Characters beyond the end of a line are returned as spaces, so short
+    lines give the same (stripped) values as slicing the line.
+
+    Args:
+        data (np.ndarray): the bytes of the file, as uint8.
+        starts (np.ndarray): the offset of the start of each line.
+        ends (np.ndarray): the offset of the end of each line.
+        first (int): the first character of the field.
+        last (int): the character after the field.
+
+    Returns:
+        np.ndarray: the field of each line, as fixed width bytes.
+    """
+    width = last - first
+    # Each row of windows is the width bytes starting at that offset, so
+    # the field of every line is just a row lookup
+    windows = np.lib.stride_tricks.sliding_window_view(data, width)
+    chars = windows[np.minimum(starts + first, len(data) - width)]
+    # Lines that end before the field does are padded with spaces
+    short = ends - starts < last
+    if short.any():
+        positions = starts[short, None] + np.arange(first, last)
+        chars[short] = np.where(positions < ends[short, None],
+                                data[np.minimum(positions, len(data) - 1)],
+                                ord(' '))
+    return chars.view(f'S{width}').ravel()
+
+
+def _cif_seconds(times: np.ndarray,
+                 half_minute: np.ndarray,
+                 schedules: np.ndarray) -> np.ndarray:
+    """Turns the hhmm times of the stops of CIF schedules into seconds
+    since midnight.
+
+    CIF times are always on a 24 hour clock, so a journey that runs past
+    midnight has later stops with earlier times. Each time a schedule's
+    times go back by more than half a day, a day is added to the rest of
+    its stops, so those stops are given times past 24 hours as they would
+    be in GTFS. Smaller steps back, such as a public arrival time rounded
+    down from the working departure before it, are left as they are.
+
+    Args:
+        times (np.ndarray): uint8 characters of each time, one row of 4
+            per stop.
+        half_minute (np.ndarray): whether each time is followed by an H,
+            which adds 30 seconds.
+        schedules (np.ndarray): the schedule of each stop, with the stops
+            of each schedule next to each other in journey order.
+
+    Returns:
+        np.ndarray: int32 seconds since midnight of the start of the
+            journey, -1 where a stop has no time (e.g. trains that pass
+            without stopping).
+    """
+    digits = times.astype(np.int32) - ord('0')
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 2] * 10 + digits[:, 3]
+    has_time = (((digits >= 0) & (digits <= 9)).all(axis=1)
+                & (hours < 24) & (minutes < 60))
+    secs = np.where(has_time, hours * 3600 + minutes * 60 + 30 * half_minute,
+                    -1).astype(np.int32)
+
+    # Count the times each schedule goes back past midnight, comparing each
+    # time with the one before it in the same schedule
+    timed = np.flatnonzero(has_time)
+    timed_secs, timed_schedules = secs[timed], schedules[timed]
+    same_schedule = timed_schedules[1:] == timed_schedules[:-1]
+    past_midnight = (timed_secs[:-1] - timed_secs[1:]) > SECONDS_PER_DAY // 2
+    days = np.cumsum(np.concatenate([[0], same_schedule & past_midnight]))
+    first_of_schedule = np.concatenate([[True], ~same_schedule])
+    schedule_start = np.maximum.accumulate(
+        np.where(first_of_schedule, np.arange(len(timed)), 0))
+    secs[timed] += (SECONDS_PER_DAY
+                    * (days - days[schedule_start])).astype(np.int32)
+    return secs
+
+
+def _decode(field: np.ndarray,
+            strip: bool = True,
+            repeats: bool = True) -> pd.Series:
+    """Turns a fixed width bytes field into a series of str.
+
+    Fields such as tiploc codes repeat a lot, so each distinct value is
+    only decoded once. The values are grouped by factorizing the bytes of
+    the field 8 at a time as integers.
+
+    Args:
+        field (np.ndarray): fixed width bytes.
+        strip (bool, optional): Strip surrounding whitespace.
+            Defaults to True.
+        repeats (bool, optional): Whether values repeat enough to be worth
+            grouping, False decodes every value. Defaults to True.
+
+    Returns:
+        pd.Series: the values as str.
+    """
+    if not repeats:
+        values = [value.decode('latin-1') for value in field.tolist()]
+        if strip:
+            values = [value.strip() for value in values]
+        return pd.Series(values, dtype=object)
+    width = field.dtype.itemsize
+    n_words = -(-width // 8)
+    padded = np.zeros((len(field), n_words * 8), dtype=np.uint8)
+    padded[:, :width] = field.view(np.uint8).reshape(-1, width)
+    words = padded.view(np.uint64)
+    codes = np.zeros(len(field), dtype=np.int64)
+    for word in range(n_words):
+        word_codes, uniques = pd.factorize(words[:, word])
+        codes, _ = pd.factorize(codes * len(uniques) + word_codes)
+    # A line with each distinct value (the last one, as it happens)
+    example = np.empty(codes.max() + 1 if len(codes) else 0, dtype=np.int64)
+    example[codes] = np.arange(len(codes))
+    values = [value.decode('latin-1') for value in field[example].tolist()]
+    if strip:
+        values = [value.strip() for value in values]
+    return pd.Series(np.array(values + [''], dtype=object)[:-1][codes],
+                     dtype=object)
+
+
+def _mca_chunk_bounds(mca_file: str, chunk_size: int) -> List[Tuple[int, int]]:
+    """Splits the mca file into byte ranges that each start at a schedule.
+
+    Every range after the first starts at a BSN or BSR record, so no
+    journey is split between two ranges.
+
+    Args:
+        mca_file (str): path/to/the/mca/file.
+        chunk_size (int): roughly how many bytes to put in each range.
+
+    Returns:
+        List[Tuple[int, int]]: the first byte and the byte after the last
+            of each range, in file order.
+    """
+    file_size = os.path.getsize(mca_file)
+    offsets = [0]
+    with open(mca_file, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        target = chunk_size
+        while target < file_size:
+            offset = mm.find(b'\nBS', target)
+            # Deleted schedules (BSD) can't start a range, as any stops
+            # after them belong to the schedule before
+            while offset != -1 and mm[offset + 3:offset + 4] not in (b'N',
+                                                                     b'R'):
+                offset = mm.find(b'\nBS', offset + 1)
+            if offset == -1:
+                break
+            offsets.append(offset + 1)
+            target = offset + 1 + chunk_size
+    return list(zip(offsets, offsets[1:] + [file_size]))
+
+
+def _extract_mca_chunk(mca_file: str,
+                       first: int,
+                       last: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Extract the schedules and stops from one byte range of the mca file.
+
+    Args:
+        mca_file (str): path/to/the/mca/file.
+        first (int): the first byte of the range, either the start of the
+            file or the start of a schedule record.
+        last (int): the byte after the end of the range.
+
+    Returns:
+        schedules (pd.DataFrame): schedule information, with the
+            MCA_SCHEDULE_COLS columns.
+        stops (pd.DataFrame): stop information, with the MCA_STOP_COLS
+            columns.
+    """
+    data = np.asarray(np.memmap(mca_file, dtype=np.uint8, mode='r',
+                                offset=first, shape=(last - first,)))
+    starts, ends = _line_bounds(data)
+    # Skip the header
+    if first == 0:
+        starts, ends = starts[1:], ends[1:]
+    # Record types as numbers, e.g. b'LO' as ord('L') * 256 + ord('O'),
+    # which are much quicker to compare than bytes
+    record_type = (_fixed_width_field(data, starts, ends, 0, 3)
+                   .view(np.uint8).reshape(-1, 3).astype(np.int32))
+    prefix = record_type[:, 0] * 256 + record_type[:, 1]
+
+    # A schedule is started by a record beginning with BS.
+    # Schedules are then further broken down by transaction type
+    # (N - new, R - revised, D - delete)
+    # Ignore any that are transaction type delete.
+    is_schedule = ((prefix == _record_code(b'BS'))
+                   & np.isin(record_type[:, 2], [ord('N'), ord('R')]))
+    is_stop = np.isin(prefix, [_record_code(stop_type)
+                               for stop_type in MCA_STOP_FIELDS])
+    is_end = prefix == _record_code(b'LT')
+
+    # For each line, the last schedule started on or before it and the last
+    # LT before it. Stops are part of a journey if the schedule started
+    # after the last journey ended.
+    line_no = np.arange(len(starts))
+    last_schedule = np.maximum.accumulate(np.where(is_schedule, line_no, -1))
+    last_end = np.maximum.accumulate(np.where(is_end, line_no, -1))
+    last_end_before = np.concatenate([[-1], last_end[:-1]])
+    in_journey = is_stop & (last_schedule > last_end_before)
+
+    # Get unique ID for schedule
+    # ID in dataset is not actually unique as same train has several
+    # schedules with different dates and calendars. Create ID from
+    # these variables.
+    sched_starts, sched_ends = starts[is_schedule], ends[is_schedule]
+    schedule_ids = _decode(
+        _fixed_width_field(data, sched_starts, sched_ends, 3, 28),
+        strip=False,
+        repeats=False)
+    # Extract the calender information for this journey
+    # i.e. what days of the week it runs
+    # Only interested in weekdays for the timebeing.
+    days = (_fixed_width_field(data, sched_starts, sched_ends, 21, 26)
+            .view(np.uint8).reshape(-1, 5).astype(np.int64) - ord('0'))
+    if ((days < 0) | (days > 9)).any():
+        raise ValueError("Found a schedule without a valid calendar")
+    schedules = pd.DataFrame({
+        'schedule_id': schedule_ids,
+        # Extract start and end date of service (yymmdd)
+        'start_date': _decode(
+            _fixed_width_field(data, sched_starts, sched_ends, 9, 15)),
+        'end_date': _decode(
+            _fixed_width_field(data, sched_starts, sched_ends, 15, 21))})
+    for day_no, day in enumerate(MCA_SCHEDULE_COLS[3:]):
+        schedules[day] = days[:, day_no]
+
+    # If station has a departure time extract time, tiploc_code and
+    # activity type. Each type of stop record has them in different places.
+    # NB times can end on a H sometimes which indicates a half minute.
+    # departure_time is just the first four characters (hhmm), the half
+    # minute is included in departure_secs.
+    stop_lines = np.flatnonzero(in_journey)
+    stop_prefix = prefix[stop_lines]
+    # Take the start of each stop record once, then the fields out of that
+    record_len = max(last for positions in MCA_STOP_FIELDS.values()
+                     for _, last in positions)
+    stop_chars = (_fixed_width_field(data, starts[stop_lines],
+                                     ends[stop_lines], 0, record_len)
+                  .view(np.uint8).reshape(-1, record_len))
+    # The fields are the same width in every type of stop record
+    stop_fields = [np.empty((len(stop_lines), last - first), dtype=np.uint8)
+                   for first, last in MCA_STOP_FIELDS[b'LI']]
+    for stop_type, positions in MCA_STOP_FIELDS.items():
+        of_type = stop_prefix == _record_code(stop_type)
+        for field, (first, last) in zip(stop_fields, positions):
+            field[of_type] = stop_chars[of_type, first:last]
+    half_minute = np.zeros(len(stop_lines), dtype=bool)
+    for stop_type, position in MCA_HALF_MINUTE.items():
+        of_type = stop_prefix == _record_code(stop_type)
+        half_minute[of_type] = stop_chars[of_type, position] == ord('H')
+    # Give each stop the id of the schedule it belongs to
+    stop_schedule = np.searchsorted(np.flatnonzero(is_schedule),
+                                    last_schedule[stop_lines])
+    departure_secs = _cif_seconds(stop_fields[0], half_minute, stop_schedule)
+    stop_fields = [field.view(f'S{field.shape[1]}').ravel()
+                   for field in stop_fields]
+    stops = pd.DataFrame({
+        'schedule_id': schedule_ids.to_numpy()[stop_schedule],
+        'departure_time': _decode(stop_fields[0]),
+        'tiploc_code': _decode(stop_fields[1]),
+        'activity_type': _decode(stop_fields[2]),
+        'departure_secs': departure_secs})
+    return schedules, stops
+
+
+def extract_mca(mca_file: str,
+                workers: int = 1,
+                chunk_size: int = 64 * 1024 ** 2
+                ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """Extract data from the mca file.
 
     The logic for this extraction is as follows:
@@ -216,119 +1121,76 @@ def extract_mca(mca_file: str) -> Tuple[List[List], List[List]]:
         * CR = changes en route. Doesnt contain any arrival / departure times.
 
     Process:
-    * Starts by finding all the schedules within the file.
-    * Extract relevant information into the journey dataframe, and then copy
-    unique_id
-    * onto all trips within that journey.
+    * The file is memory mapped and every line is classified by its
+    record type at once, rather than reading it line by line.
+    * Schedules are started by BSN (new) or BSR (revised) records, BSD
+    (delete) records are ignored. A stop record belongs to the last
+    schedule started before it, as long as that schedule has not already
+    been ended by an LT record.
+    * The fixed width fields are then sliced out of all the schedule and
+    stop records together.
+    * With more than one worker the file is split into chunks that each
+    start at a schedule record, as schedules are independent of each
+    other. The chunks are parsed in separate processes and joined back
+    together in file order.
+    * Where processes are spawned rather than forked (Windows and macOS),
+    each one imports the calling script again, so with more than one
+    worker the call must be under `if __name__ == "__main__":`.
 
     Args:
-        mca_file (_type_): _description_
-
+        mca_file (str): path/to/the/mca/file.
+        workers (int, optional): Number of processes to parse with, at
+            most one per CPU. Defaults to 1.
+        chunk_size (int, optional): Roughly how many bytes of the file to
+            parse in each chunk when using more than one worker.
+            Defaults to 64 MiB.
 
     Returns:
-        schedules (list): list of lists containing schedule information
-            ready for dataframe
-        stops (list): list of lists containing stop information
-            ready for dataframe
-    """
-    # Create a flag that specifies when we have found a new journey
-    journey = False
-
-    # Store schedule information
-    schedules = []
-    # Store stop information
-    stops = []
-
-    with open(mca_file, 'r') as mca_data:
-        # Skip the header
-        next(mca_data)
-        for line in mca_data:
-            # A schedule is started by a record beginning with BS.
-            # Other entries exist but are not needed for our purpose.
-            # Schedules are then further broken down by transaction type
-            # (N - new, R - revised, D - delete)
-            # Ignore any that are transaction type delete.
-            if line[0:3] == 'BSN' or line[0:3] == 'BSR':
-                # Switch flag on as we have found a journey
-                journey = True
-
-            # Get unique ID for schedule
-            # ID in dataset is not actually unique as same train has several
-            # schedules with different dates and calendars. Create ID from
-            # these variables.
-                schedule_id = (line[3:9]
-                               + line[9:15]
-                               + line[15:21]
-                               + line[21:28])
-
-            # Extract start and end date of service (yymmdd)
-                start_date = line[9:15].strip()
-                end_date = line[15:21].strip()
-
-            # Extract the calender information for this journey
-            # i.e. what days of the week it runs
-            # Only interested in weekdays for the timebeing.
-                monday = int(line[21].strip())
-                tuesday = int(line[22].strip())
-                wednesday = int(line[23].strip())
-                thursday = int(line[24].strip())
-                friday = int(line[25].strip())
-
-            # Store data to be added to the dataframe
-                schedules.append([schedule_id,
-                                  start_date,
-                                  end_date,
-                                  monday,
-                                  tuesday,
-                                  wednesday,
-                                  thursday,
-                                  friday])
-
-            # Skip as this is all we need to do for an entry starting
-            # with BS
-                continue
-
-        # If we have found a new journey, go through the lines that are
-        # part of this jounrey and give them the schedule id.
-
-        # Journeys split into origin (LO), stops (LI) and terminus (LT)
-        # CR (changes en route) and BX (extra schedule details) can be
-        # ignored as not relevant to our purpose.
-
-        # If station has a departure time extract time, tiploc_code and
-        # activity type.
-
-        # NB times can end on a H sometimes which indicates a half minute
-        # Rather than rounding up and down, just ignoring this for the moment
-        # and taking only first four characters (hh:mm)
-
-            if journey:
-                if line[0:2] == 'LO':
-                    departure_time = line[10:14].strip()
-                    tiploc_code = line[2:10].strip()
-                    activity_type = line[29:41].strip()
-
-                elif line[0:2] == 'LI':
-                    departure_time = line[15:19].strip()
-                    tiploc_code = line[2:10].strip()
-                    activity_type = line[42:54].strip()
-
-                elif line[0:2] == 'LT':
-                    departure_time = line[15:19].strip()
-                    tiploc_code = line[2:10].strip()
-                    activity_type = line[25:37].strip()
-
-                # As we know that LT signifies the last stop in a journey
-                # and we have extracted everything we need we now switch the
-                # flag off
-                    journey = False
-                else:
-                    # Skipping BR and CX
-                    continue
-
-                # Store data to be added to dataframe
-                stops.append([schedule_id,
-                              departure_time,
-                              tiploc_code,
-                              activity_type])
+        schedules (pd.DataFrame): schedule information, with the
+            MCA_SCHEDULE_COLS columns.
+        stops (pd.DataFrame): stop information, with the MCA_STOP_COLS
+            columns.
+    """
+    # More processes than cores only adds overhead
+    workers = min(workers, os.cpu_count() or 1)
+    if workers <= 1:
+        return _extract_mca_chunk(mca_file, 0, os.path.getsize(mca_file))
+
+    bounds = _mca_chunk_bounds(mca_file, chunk_size)
+    with ProcessPoolExecutor(max_workers=min(workers, len(bounds))) as pool:
+        chunks = list(pool.map(_extract_mca_chunk,
+                               [mca_file] * len(bounds),
+                               *zip(*bounds)))
+    schedules = pd.concat([chunk[0] for chunk in chunks], ignore_index=True)
+    stops = pd.concat([chunk[1] for chunk in chunks], ignore_index=True)
     return schedules, stops
+
+
+def extract_cif(msn_file: str,
+                mca_file: str,
+                workers: int = 1,
+                chunk_size: int = 64 * 1024 ** 2
+                ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Extract the stations from the msn file and the schedules and stops
+    from the mca file.
+
+    Args:
+        msn_file (str): path/to/the/msn/file.
+        mca_file (str): path/to/the/mca/file.
+        workers (int, optional): Number of processes to parse the mca file
+            with. Defaults to 1.
+        chunk_size (int, optional): Roughly how many bytes of the mca file
+            to parse in each chunk. Defaults to 64 MiB.
+
+    Returns:
+        stations (pd.DataFrame): station information, with the MSN_COLS
+            columns.
+        schedules (pd.DataFrame): schedule information, with the
+            MCA_SCHEDULE_COLS columns.
+        stops (pd.DataFrame): stop information, with the MCA_STOP_COLS
+            columns.
+    """
+    stations = pd.DataFrame(extract_msn_data(msn_file), columns=MSN_COLS)
+    schedules, stops = extract_mca(mca_file, workers=workers,
+                                   chunk_size=chunk_size)
+    return stations, schedules, stops
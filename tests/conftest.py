@@ -0,0 +1,97 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The modules are imported from src, with the config of this project
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "src", "time_table"))
+os.environ.setdefault("SDG_PROJECT_ROOT", ROOT)
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    """Serves the files of a LocalServer, answering Range (and If-Range)
+    requests like a real file server."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append({"path": self.path,
+                                    "headers": dict(self.headers)})
+            failures = server.failures.get(self.path, [])
+            status = failures.pop(0) if failures else None
+        if status is not None:
+            self.send_error(status)
+            return
+        body = server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = server.etags.get(self.path)
+
+        start = 0
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == etag):
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+
+        # Drop the connection part way through if asked to
+        cut = server.cuts.get(self.path, [])
+        stop = cut.pop(0) if cut else len(body)
+        self.wfile.write(body[start:max(start, stop)])
+        if stop < len(body):
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(ThreadingHTTPServer):
+    """An HTTP server in a thread, serving files from memory.
+
+    files maps each path to its bytes, etags an optional ETag for it.
+    failures maps a path to the status codes to answer its next requests
+    with, and cuts to the byte offsets to drop the next responses at.
+    Every request is recorded in requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FileHandler)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.etags = {}
+        self.failures = {}
+        self.cuts = {}
+        self.requests = []
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+@pytest.fixture
+def local_server():
+    server = LocalServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
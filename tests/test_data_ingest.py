@@ -0,0 +1,444 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.parse import urlparse
+from zipfile import ZipFile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+import data_ingest as di
+
+SAMPLE_DF = pd.DataFrame({"code": [f"E{i:08d}" for i in range(2000)],
+                          "value": range(2000)})
+
+
+def _write_zip(zip_path, file_nm="sample"):
+    with ZipFile(zip_path, "w") as zip:
+        zip.writestr(f"{file_nm}.csv", SAMPLE_DF.to_csv(index=False))
+
+
+def _load_concurrently(data_dir, zip_link=None, calls=8):
+    with ThreadPoolExecutor(max_workers=calls) as pool:
+        futures = [pool.submit(di.any_to_pd, "sample", zip_link,
+                               ["feather", "csv", "zip"], None,
+                               str(data_dir))
+                   for _ in range(calls)]
+        return [future.result() for future in futures]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(di, "sleep", lambda seconds: None)
+
+
+def test_any_to_pd_concurrent_from_zip(tmp_path):
+    _write_zip(tmp_path / "sample.zip")
+
+    pd_dfs = _load_concurrently(tmp_path)
+
+    for pd_df in pd_dfs:
+        pd.testing.assert_frame_equal(pd_df, SAMPLE_DF)
+    assert sorted(os.listdir(tmp_path)) == ["sample.feather"]
+    pd.testing.assert_frame_equal(
+        pd.read_feather(tmp_path / "sample.feather"), SAMPLE_DF)
+
+
+def test_any_to_pd_concurrent_download(tmp_path, local_server):
+    _write_zip(tmp_path / "served.zip")
+    local_server.files["/sample.zip"] = (tmp_path / "served.zip").read_bytes()
+    os.remove(tmp_path / "served.zip")
+
+    pd_dfs = _load_concurrently(tmp_path, local_server.url("/sample.zip"))
+
+    for pd_df in pd_dfs:
+        pd.testing.assert_frame_equal(pd_df, SAMPLE_DF)
+    # No zips, .part or temporary files are left behind
+    assert sorted(os.listdir(tmp_path)) == ["sample.feather"]
+
+
+def test_pd_to_feather_leaves_no_partial_file(tmp_path, monkeypatch):
+    def failing_write(pd_df, path, **kwargs):
+        with open(path, "wb") as half_written:
+            half_written.write(b"ARROW1")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(di.feather, "write_feather", failing_write)
+    with pytest.raises(OSError):
+        di._pd_to_feather(SAMPLE_DF, tmp_path / "sample.csv")
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.fixture
+def project_paths(tmp_path):
+    paths = di.PATHS
+    yield di.configure_paths(tmp_path, "data")
+    di.PATHS = paths
+
+
+def test_config_downloads_follow_the_pipelines(project_paths):
+    bus_dir = project_paths.data("england_bus_timetable")
+    os.makedirs(bus_dir)
+    names = [download["name"] for download in di._config_downloads()]
+    assert "eng_bus_timetable" in names
+    # NaPTAN is checked for changes by get_stops_file itself
+    assert "naptan" not in names
+
+    # A fresh timetable is not downloaded again, even without its zip
+    for file_nm in di.BUS_TIMETABLE_FILES:
+        with open(os.path.join(bus_dir, f"{file_nm}.txt"), "w") as txt:
+            txt.write("header\n")
+    names = [download["name"] for download in di._config_downloads()]
+    assert "eng_bus_timetable" not in names
+
+    # Nor is a timetable whose fresh zip is waiting to be extracted
+    os.remove(os.path.join(bus_dir, "trips.txt"))
+    with open(os.path.join(bus_dir, di.BUS_TIMETABLE_ZIP), "wb") as zip:
+        zip.write(b"PK")
+    names = [download["name"] for download in di._config_downloads()]
+    assert "eng_bus_timetable" not in names
+
+    # But a stale zip is
+    old = datetime.datetime.now().timestamp() - 30 * 24 * 3600
+    os.utime(os.path.join(bus_dir, di.BUS_TIMETABLE_ZIP), (old, old))
+    names = [download["name"] for download in di._config_downloads()]
+    assert "eng_bus_timetable" in names
+
+
+STOPS_CSV = ("ATCOCode,NaptanCode,CommonName,Easting,Northing,StopType,"
+             "Status\n"
+             "0100BRP90310,bstgwpa,Temple Meads,359296,172250,BCT,active\n"
+             "0100BRP90311,bstgwpd,Temple Meads,359261,172250,BCT,active\n")
+
+
+def test_relative_paths_are_from_the_project_root(project_paths, tmp_path,
+                                                  monkeypatch):
+    geo_df = gpd.GeoDataFrame({"code": ["a", "b"]},
+                              geometry=[Point(0, 0), Point(1, 1)],
+                              crs="EPSG:27700")
+    os.makedirs(tmp_path / "out")
+    monkeypatch.chdir(tmp_path / "out")
+
+    di.save_geo_df(geo_df, "out", "points")
+    di._pd_to_feather(SAMPLE_DF, tmp_path / "out" / "sample.csv")
+
+    assert sorted(os.listdir(tmp_path / "out")) == ["points.parquet",
+                                                    "sample.feather"]
+    pd.testing.assert_frame_equal(di.read_geo_df("out", "points"), geo_df)
+    pd.testing.assert_frame_equal(di._feath_to_df("sample", "out"),
+                                  SAMPLE_DF)
+    assert di._file_meta("out/points.parquet") is di._file_meta(
+        tmp_path / "out" / "points.parquet")
+
+
+def test_build_pop_store_without_a_pool_by_default(project_paths,
+                                                   monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("Started a process pool")
+
+    monkeypatch.setattr(di, "ProcessPoolExecutor", no_pool)
+    monkeypatch.setattr(di, "_read_region_pop_xls",
+                        lambda xls_path, pop_year, engine: pd.DataFrame(
+                            {"OA11CD": [os.path.basename(xls_path)],
+                             "pop_count": [1]}))
+    pop_files = ["ukmidyearestimates-london.xlsx",
+                 "ukmidyearestimates-wales.xlsx",
+                 ".gitkeep"]
+
+    assert di.build_pop_store(pop_files, 2019) == ["London", "Wales"]
+    assert di.build_pop_store(pop_files, 2019) == []
+    pop_df = di.read_pop_store(pop_years=["2019"])
+    assert sorted(pop_df["OA11CD"]) == pop_files[:2]
+
+
+def test_get_stops_file_keeps_headers_and_tidies_csvs(project_paths,
+                                                      local_server):
+    stops_dir = project_paths.data("stops")
+    os.makedirs(stops_dir)
+    local_server.files["/stops"] = STOPS_CSV.encode()
+    local_server.etags["/stops"] = '"v1"'
+    url = local_server.url("/stops")
+
+    stops_df = di.get_stops_file(url, stops_dir)
+    assert list(stops_df["ATCOCode"]) == ["0100BRP90310", "0100BRP90311"]
+    assert di._read_stops_meta()["etag"] == '"v1"'
+
+    # A csv left from an earlier run is used without losing the ETag
+    meta = di._read_stops_meta()
+    meta["checked_at"] = "2000-01-01T00:00:00"
+    di._write_stops_meta(meta)
+    today = datetime.datetime.now().strftime("%Y%m%d")
+    with open(os.path.join(stops_dir, f"stops_{today}.csv"), "w") as csv:
+        csv.write(STOPS_CSV)
+    di.get_stops_file(url, stops_dir)
+    assert di._read_stops_meta()["etag"] == '"v1"'
+    assert len(local_server.requests) == 1
+
+    # Csvs are not left behind when the stops are not due a refresh
+    with open(os.path.join(stops_dir, "stops_20000101.csv"), "w") as csv:
+        csv.write(STOPS_CSV)
+    di.get_stops_file(url, stops_dir)
+    assert not [file_nm for file_nm in os.listdir(stops_dir)
+                if file_nm.endswith(".csv")]
+
+
+def test_save_latest_stops_survives_failed_write(project_paths,
+                                                 monkeypatch):
+    stops_dir = project_paths.data("stops")
+    os.makedirs(stops_dir)
+    old_csv = os.path.join(stops_dir, "stops_20220101.csv")
+    with open(old_csv, "w") as csv:
+        csv.write(STOPS_CSV)
+    stops_path = di.save_latest_stops_as_feather(old_csv, "20220101")
+    old_stops = pd.read_feather(stops_path)
+
+    new_csv = os.path.join(stops_dir, "stops_20220201.csv")
+    with open(new_csv, "w") as csv:
+        csv.write(STOPS_CSV.replace("bstgwpd", "bstgwpx"))
+    write_feather = di.feather.write_feather
+
+    def failing_write(pd_df, dest, **kwargs):
+        # pd.DataFrame.to_feather passes an open file rather than a path
+        file_nm = os.path.basename(str(getattr(dest, "name", dest)))
+        if not file_nm.startswith("Stops.feather"):
+            return write_feather(pd_df, dest, **kwargs)
+        if hasattr(dest, "write"):
+            dest.write(b"ARROW1")
+        else:
+            with open(dest, "wb") as half_written:
+                half_written.write(b"ARROW1")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(di.feather, "write_feather", failing_write)
+    with pytest.raises(OSError):
+        di.save_latest_stops_as_feather(new_csv, "20220201")
+    pd.testing.assert_frame_equal(pd.read_feather(stops_path), old_stops)
+    # The csv is kept to try again, and nothing is left half written
+    assert os.path.exists(new_csv)
+    assert not [file_nm for file_nm in os.listdir(stops_dir)
+                if file_nm.endswith(".tmp")]
+
+    monkeypatch.setattr(di.feather, "write_feather", write_feather)
+    di.save_latest_stops_as_feather(new_csv, "20220201")
+    new_stops = pd.read_feather(stops_path)
+    assert list(new_stops["NaptanCode"]) == ["bstgwpa", "bstgwpx"]
+    assert list(di.read_stops_delta()["change"]) == ["changed"]
+
+
+def test_write_batches_to_feather_round_trip(tmp_path):
+    feather_path = tmp_path / "stop_times.feather"
+    # Each batch has categories of its own, like batches read from a csv
+    batches = [pd.DataFrame({"stop_id": pd.Categorical(stop_ids),
+                             "departure_secs": pd.array(secs, dtype="int32")})
+               for stop_ids, secs in [(["A", "B"], [1, 2]),
+                                      (["C", "A"], [3, 4]),
+                                      ([None, "B"], [5, 6])]]
+
+    passed_on = list(di.write_batches_to_feather(batches, feather_path))
+
+    assert all(batch is batches[i] for i, batch in enumerate(passed_on))
+    saved = di._feath_to_df("stop_times", feather_path)
+    assert saved["stop_id"].dtype == "category"
+    assert list(saved["stop_id"].astype(str)) == ["A", "B", "C", "A",
+                                                  "nan", "B"]
+    assert list(saved["departure_secs"]) == [1, 2, 3, 4, 5, 6]
+    assert os.listdir(tmp_path) == ["stop_times.feather"]
+
+
+FILE_BODY = bytes(range(256)) * 4096
+
+
+def test_download_file_resumes_with_if_range(tmp_path, local_server):
+    local_server.files["/file"] = FILE_BODY
+    local_server.etags["/file"] = '"v1"'
+    local_server.cuts["/file"] = [len(FILE_BODY) // 3]
+    file_path = tmp_path / "file.bin"
+
+    di._download_file(local_server.url("/file"), file_path,
+                      chunk_size=4096)
+
+    assert file_path.read_bytes() == FILE_BODY
+    first, resumed = local_server.requests
+    assert "Range" not in first["headers"]
+    assert resumed["headers"]["Range"].startswith("bytes=")
+    assert resumed["headers"]["If-Range"] == '"v1"'
+    # Only the finished file is left
+    assert os.listdir(tmp_path) == ["file.bin"]
+
+
+def test_download_file_restarts_when_the_file_changed(tmp_path,
+                                                      local_server):
+    local_server.files["/file"] = FILE_BODY
+    local_server.etags["/file"] = '"v2"'
+    file_path = tmp_path / "file.bin"
+    # Left by an earlier run, of the previous version of the file
+    (tmp_path / "file.bin.part").write_bytes(b"old version" * 100)
+    (tmp_path / "file.bin.part.etag").write_text('"v1"')
+
+    di._download_file(local_server.url("/file"), file_path)
+
+    assert file_path.read_bytes() == FILE_BODY
+    assert local_server.requests[0]["headers"]["If-Range"] == '"v1"'
+    assert os.listdir(tmp_path) == ["file.bin"]
+
+
+def test_download_file_restarts_part_without_etag(tmp_path, local_server):
+    local_server.files["/file"] = FILE_BODY
+    file_path = tmp_path / "file.bin"
+    (tmp_path / "file.bin.part").write_bytes(b"unknown version" * 100)
+
+    di._download_file(local_server.url("/file"), file_path)
+
+    assert file_path.read_bytes() == FILE_BODY
+    assert "Range" not in local_server.requests[0]["headers"]
+
+
+def _manifest_download(local_server, tmp_path, name="file"):
+    return {"name": name,
+            "url": local_server.url(f"/{name}"),
+            "path": str(tmp_path / name / f"{name}.bin")}
+
+
+def _host_limits(download):
+    return {urlparse(download["url"]).netloc: threading.Semaphore(1)}
+
+
+def test_scheduled_download_retries_server_errors(tmp_path, local_server,
+                                                  monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(di, "sleep", sleeps.append)
+    local_server.files["/file"] = FILE_BODY
+    local_server.failures["/file"] = [503, 500]
+    download = _manifest_download(local_server, tmp_path)
+
+    entry = di._scheduled_download(download, _host_limits(download))
+
+    assert "error" not in entry
+    assert entry["size"] == len(FILE_BODY)
+    assert entry["sha256"] == hashlib.sha256(FILE_BODY).hexdigest()
+    # Backs off exponentially between the attempts
+    assert sleeps == [2, 4]
+    assert len(local_server.requests) == 3
+
+
+def test_scheduled_download_resumes_dropped_connection(tmp_path,
+                                                       local_server):
+    # Big enough for whole 1 MiB chunks to be written before each drop
+    body = FILE_BODY * 3
+    local_server.files["/file"] = body
+    local_server.etags["/file"] = '"v1"'
+    local_server.cuts["/file"] = [len(body) // 2, len(body) * 5 // 6]
+    download = _manifest_download(local_server, tmp_path)
+
+    entry = di._scheduled_download(download, _host_limits(download))
+
+    assert entry["sha256"] == hashlib.sha256(body).hexdigest()
+    assert [request["headers"].get("If-Range")
+            for request in local_server.requests] == [None, '"v1"', '"v1"']
+
+
+def test_scheduled_download_gives_up_on_client_errors(tmp_path,
+                                                      local_server,
+                                                      monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(di, "sleep", sleeps.append)
+    download = _manifest_download(local_server, tmp_path, "missing")
+
+    entry = di._scheduled_download(download, _host_limits(download))
+
+    assert "404" in entry["error"]
+    assert len(local_server.requests) == 1
+    assert sleeps == []
+
+
+def test_download_file_rejects_bad_checksum(tmp_path, local_server):
+    local_server.files["/file"] = FILE_BODY
+    file_path = tmp_path / "file.bin"
+
+    with pytest.raises(ValueError, match="Checksum"):
+        di._download_file(local_server.url("/file"), file_path,
+                          sha256=hashlib.sha256(b"other").hexdigest())
+
+    # Neither the bad file nor its .part file is kept
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_all_records_every_download(tmp_path, local_server):
+    local_server.files["/file"] = FILE_BODY
+    local_server.failures["/broken"] = [400]
+    manifest_path = tmp_path / "manifest.json"
+    downloads = [_manifest_download(local_server, tmp_path),
+                 _manifest_download(local_server, tmp_path, "broken")]
+
+    manifest = di.download_all(downloads, manifest_path, max_workers=2,
+                               per_host=2)
+
+    assert manifest["file"]["size"] == len(FILE_BODY)
+    assert "error" in manifest["broken"]
+    assert json.loads(manifest_path.read_text()) == manifest
+
+
+# About the number of stops in NaPTAN, for the benchmark
+NAPTAN_ROWS = 435_000
+
+
+def _stops_df(rows):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "ATCOCode": [f"{i:012d}" for i in range(rows)],
+        "Easting": rng.integers(100_000, 650_000, rows),
+        "Northing": rng.integers(10_000, 1_200_000, rows),
+        "Longitude": rng.uniform(-6, 1.7, rows),
+        "Latitude": rng.uniform(50, 58.6, rows)})
+
+
+def _geo_df_from_pd_df_by_row(pd_df, geom_x, geom_y, crs):
+    """geo_df_from_pd_df as it was, building a Point for each row."""
+    geometry = [Point(xy) for xy in zip(pd_df[geom_x], pd_df[geom_y])]
+    geo_df = gpd.GeoDataFrame(pd_df, geometry=geometry)
+    geo_df.crs = crs
+    geo_df.to_crs("EPSG:27700", inplace=True)
+    return geo_df
+
+
+GEOM_COLS = pytest.mark.parametrize("geom_x, geom_y, crs", [
+    ("Easting", "Northing", "EPSG:27700"),
+    ("Longitude", "Latitude", "EPSG:4326")])
+
+
+@GEOM_COLS
+def test_geo_df_from_pd_df_matches_points_by_row(geom_x, geom_y, crs):
+    stops_df = _stops_df(300)
+
+    by_row = _geo_df_from_pd_df_by_row(stops_df.copy(), geom_x, geom_y, crs)
+    in_bulk = di.geo_df_from_pd_df(stops_df.copy(), geom_x, geom_y, crs)
+
+    assert in_bulk.crs == by_row.crs
+    pd.testing.assert_frame_equal(in_bulk.drop(columns="geometry"),
+                                  by_row.drop(columns="geometry"))
+    np.testing.assert_allclose(in_bulk.geometry.x, by_row.geometry.x)
+    np.testing.assert_allclose(in_bulk.geometry.y, by_row.geometry.y)
+
+
+# Run with SDG_BENCHMARK=1 pytest -s -k benchmark
+@pytest.mark.skipif(not os.environ.get("SDG_BENCHMARK"),
+                    reason="benchmark, set SDG_BENCHMARK=1 to run")
+@GEOM_COLS
+def test_benchmark_geo_df_from_pd_df(geom_x, geom_y, crs):
+    stops_df = _stops_df(NAPTAN_ROWS)
+
+    tic = perf_counter()
+    _geo_df_from_pd_df_by_row(stops_df.copy(), geom_x, geom_y, crs)
+    by_row_time = perf_counter() - tic
+    tic = perf_counter()
+    di.geo_df_from_pd_df(stops_df.copy(), geom_x, geom_y, crs)
+    in_bulk_time = perf_counter() - tic
+    print(f"{NAPTAN_ROWS} stops from {crs}: {by_row_time:.2f}s by row, "
+          f"{in_bulk_time:.2f}s in bulk")
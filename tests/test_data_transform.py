@@ -0,0 +1,147 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, box
+
+# data_transform needs convertbng, from requirements.txt
+pytest.importorskip("convertbng")
+import data_output as do  # noqa: E402
+import data_transform as dt  # noqa: E402
+import geospatial_mods as gs  # noqa: E402
+
+CRS = "EPSG:27700"
+LAD_COL = "LAD19NM"
+AGE_COLS = ["0-4", "5-9", "10+"]
+SEX_COLS = ["male", "female"]
+# Two local authorities side by side
+LA_POLYS = {"Ayton": box(0, 0, 5000, 5000),
+            "Beeton": box(5000, 0, 10000, 5000)}
+
+
+@pytest.fixture
+def nation():
+    rng = np.random.default_rng(0)
+    stops_geo_df = gpd.GeoDataFrame(
+        {"capacity_type": rng.choice(["low", "high"], 12).tolist()
+         + ["high"]},
+        # The last stop is on the boundary, so is in both
+        geometry=[Point(x, y) for x, y in rng.uniform(0, [10000, 5000],
+                                                      (12, 2))]
+        + [Point(5000, 2500)],
+        crs=CRS)
+
+    points = rng.uniform(1, [9999, 4999], (400, 2))
+    # Leave out points near the edge of a stop's radius, where buffer
+    # polygons fall inside the true circle
+    radii = stops_geo_df["capacity_type"].map(gs.CAPACITY_BUFFERS).to_numpy()
+    stop_xy = np.column_stack([stops_geo_df.geometry.x,
+                               stops_geo_df.geometry.y])
+    dists = np.hypot(*(points[:, None] - stop_xy[None]).transpose(2, 0, 1))
+    points = points[(np.abs(dists - radii) > 5).all(axis=1)]
+
+    ages = rng.integers(0, 60, (len(points), len(AGE_COLS)))
+    pop_count = ages.sum(axis=1) + 1
+    ages[:, -1] += 1
+    male = rng.integers(0, pop_count + 1)
+    ew_df = gpd.GeoDataFrame(
+        {"OA11CD": [f"E{i:08d}" for i in range(len(points))],
+         LAD_COL: np.where(points[:, 0] < 5000, "Ayton", "Beeton"),
+         "pop_count": pop_count,
+         "male": male,
+         "female": pop_count - male,
+         "urb_rur_class": rng.choice(["urban", "rural"], len(points))},
+        geometry=[Point(xy) for xy in points],
+        crs=CRS)
+    ew_df[AGE_COLS] = ages
+
+    disabled = rng.integers(0, 10, (len(points), 2))
+    disability_df = pd.DataFrame({"OA11CD": ew_df["OA11CD"],
+                                  "disab_ltd_lot": disabled[:, 0],
+                                  "disab_ltd_little": disabled[:, 1]})
+    return ew_df, stops_geo_df, disability_df
+
+
+def _per_la_results(ew_df, stops_geo_df, disability_df):
+    """The per_la loop of SDG_eng_wales, one local authority at a time."""
+    results = {"total": {}, "age": {}, "sex": {}, "disability": {},
+               "urban_rural": {}}
+    for local_auth, la_poly in LA_POLYS.items():
+        la_poly = gpd.GeoDataFrame(geometry=[la_poly], crs=CRS)
+        stops_in_la_poly = gs.find_points_in_poly(stops_geo_df, la_poly)
+        stops_in_la_poly_buffer = gs.buffer_points(stops_in_la_poly)
+
+        la_df = ew_df.loc[ew_df[LAD_COL] == local_auth]
+        la_df = dt.disab_disagg(disability_df.copy(), la_df)
+        pwc_in_stops_buffer_df = (
+            gs.find_points_in_poly(la_df, stops_in_la_poly_buffer)
+            .drop_duplicates(subset="OA11CD"))
+
+        served = pwc_in_stops_buffer_df.pop_count.sum()
+        full_pop = la_df.pop_count.sum()
+        not_served = full_pop - served
+        la_results_df = pd.DataFrame({
+            "All_pop": [full_pop],
+            "Served": [served],
+            "Unserved": [not_served],
+            "Percentage served": ["{:.2f}".format(served / full_pop * 100)],
+            "Percentage unserved": [
+                "{:.2f}".format(not_served / full_pop * 100)]})
+        la_results_df = la_results_df.T.rename(columns={0: "Total"})
+        results["total"][local_auth] = do.reshape_for_output(
+            la_results_df, id_col="Total", local_auth=local_auth
+        ).drop("Total", axis=1)
+
+        for key, cols, id_col in [("age", AGE_COLS, "Age"),
+                                  ("sex", SEX_COLS, "Sex")]:
+            results[key][local_auth] = do.reshape_for_output(
+                dt.served_proportions_disagg(la_df, pwc_in_stops_buffer_df,
+                                             cols),
+                id_col=id_col,
+                local_auth=local_auth)
+
+        dt.disab_dict(la_df, pwc_in_stops_buffer_df, results["disability"],
+                      local_auth)
+
+        urb_rur_dfs = []
+        for urb_rur, label in [("urban", "Urban"), ("rural", "Rural")]:
+            class_df = la_df[la_df.urb_rur_class == urb_rur]
+            class_in_poly_df = (class_df.merge(pwc_in_stops_buffer_df,
+                                               on="OA11CD", how="left")
+                                .loc[:, ["OA11CD", "pop_count_y"]]
+                                .rename(columns={"pop_count_y": "pop_count"}))
+            servd_df = dt.served_proportions_disagg(
+                class_df, class_in_poly_df, ["pop_count"]
+            ).rename(columns={"pop_count": label})
+            urb_rur_dfs.append(do.reshape_for_output(
+                servd_df, id_col=label, local_auth=local_auth
+            ).rename(columns={label: "Urban/Rural"}))
+        results["urban_rural"][local_auth] = pd.concat(urb_rur_dfs)
+    return results
+
+
+def test_national_served_disaggs_matches_per_la_loop(nation):
+    ew_df, stops_geo_df, disability_df = nation
+    expected = _per_la_results(ew_df, stops_geo_df.copy(), disability_df)
+
+    # The national path of SDG_eng_wales
+    la_df = gpd.GeoDataFrame({LAD_COL: list(LA_POLYS)},
+                             geometry=list(LA_POLYS.values()), crs=CRS)
+    stops_in_la_df = gpd.sjoin(stops_geo_df, la_df, how="inner",
+                               predicate="intersects"
+                               ).drop(columns="index_right")
+    pop_df = dt.disab_disagg(disability_df.copy(), ew_df)
+    served = gs.find_served_points(pop_df, stops_in_la_df, match_col=LAD_COL)
+    results = dt.national_served_disaggs(pop_df=pop_df,
+                                         served=served,
+                                         group_col=LAD_COL,
+                                         age_cols=AGE_COLS,
+                                         sex_cols=SEX_COLS)
+
+    assert served.any() and not served.all()
+    assert list(results) == list(expected)
+    for key, la_dfs in expected.items():
+        assert list(results[key]) == list(la_dfs)
+        for local_auth, la_output_df in la_dfs.items():
+            pd.testing.assert_frame_equal(results[key][local_auth],
+                                          la_output_df, check_dtype=False)
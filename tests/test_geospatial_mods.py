@@ -0,0 +1,76 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+import geospatial_mods as gs
+
+CRS = "EPSG:27700"
+
+
+@pytest.fixture
+def points_and_stops():
+    rng = np.random.default_rng(0)
+    stops_geo_df = gpd.GeoDataFrame(
+        {"capacity_type": rng.choice(["low", "high"], 40),
+         "area": rng.choice(["north", "south"], 40)},
+        geometry=[Point(xy) for xy in rng.uniform(0, 20000, (40, 2))],
+        crs=CRS)
+    points = rng.uniform(0, 20000, (3000, 2))
+    # Leave out points within a metre of a stop's radius, where the buffer
+    # polygons fall slightly inside the true circle
+    radii = stops_geo_df["capacity_type"].map(gs.CAPACITY_BUFFERS).to_numpy()
+    stop_xy = np.column_stack([stops_geo_df.geometry.x,
+                               stops_geo_df.geometry.y])
+    dists = np.hypot(*(points[:, None] - stop_xy[None]).transpose(2, 0, 1))
+    points = points[(np.abs(dists - radii) > 1).all(axis=1)]
+    geo_df = gpd.GeoDataFrame(
+        {"code": [f"P{i}" for i in range(len(points))],
+         "area": rng.choice(["north", "south"], len(points))},
+        geometry=[Point(xy) for xy in points],
+        crs=CRS,
+        # An index that isn't a range, as after filtering
+        index=np.arange(len(points)) * 3)
+    return geo_df, stops_geo_df
+
+
+def _served_by_buffers(geo_df, stops_geo_df):
+    """Served flags from buffering the stops, as the per_la loop does."""
+    stops_buffer = gs.buffer_points(stops_geo_df[["capacity_type",
+                                                  "geometry"]].copy())
+    served_df = gs.find_points_in_poly(geo_df, stops_buffer)
+    return geo_df.index.isin(served_df.index)
+
+
+def test_find_served_points_matches_buffers(points_and_stops):
+    geo_df, stops_geo_df = points_and_stops
+
+    served = gs.find_served_points(geo_df, stops_geo_df)
+
+    assert served.index.equals(geo_df.index)
+    assert served.any() and not served.all()
+    np.testing.assert_array_equal(served.to_numpy(),
+                                  _served_by_buffers(geo_df, stops_geo_df))
+
+
+def test_find_served_points_match_col(points_and_stops):
+    geo_df, stops_geo_df = points_and_stops
+
+    served = gs.find_served_points(geo_df, stops_geo_df, match_col="area")
+
+    # The same as flagging the points of each area with its own stops
+    expected = pd.Series(False, index=geo_df.index)
+    for area in ["north", "south"]:
+        area_df = geo_df[geo_df["area"] == area]
+        expected[area_df.index] = _served_by_buffers(
+            area_df, stops_geo_df[stops_geo_df["area"] == area])
+    pd.testing.assert_series_equal(served, expected)
+
+
+def test_find_served_points_rejects_unknown_capacity(points_and_stops):
+    geo_df, stops_geo_df = points_and_stops
+    stops_geo_df.loc[0, "capacity_type"] = "medium"
+
+    with pytest.raises(ValueError):
+        gs.find_served_points(geo_df, stops_geo_df)
@@ -0,0 +1,326 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import time_table_utils as ttu
+
+
+def _record(code, fields, width=80):
+    """A fixed width CIF record, with each text put at its position."""
+    line = list(code.ljust(width))
+    for position, text in fields.items():
+        line[position:position + len(text)] = text
+    return "".join(line).rstrip()
+
+
+MCA_LINES = [
+    _record("HDTPS.UDFROC1.PD220101", {}),
+    # Monday to Wednesday, with half minutes and a passing point
+    _record("BSNA00001220101221231", {21: "1110000"}),
+    _record("BX", {}),
+    _record("LOSTNA   ", {10: "0600H", 15: "0600", 29: "TB"}),
+    _record("LISTNB   ", {10: "0614H", 15: "0615H", 25: "0615", 42: "T"}),
+    _record("LIPASSX  ", {20: "0620H"}),
+    _record("CRSTNB   ", {}),
+    _record("LTSTNC   ", {10: "0630", 15: "0630", 25: "TF"}),
+    # Deleted schedules are ignored
+    _record("BSDA00002220101221231", {21: "1111100"}),
+    # Friday night, running past midnight
+    _record("BSNB00001220101221231", {21: "0000100"}),
+    _record("LOSTNC   ", {10: "2350", 15: "2350", 29: "TB"}),
+    _record("LISTNB   ", {10: "2359", 15: "2359H", 42: "T"}),
+    _record("LTSTNA   ", {10: "0010", 15: "0010", 25: "TF"}),
+    # A revised schedule whose LT is missing
+    _record("BSRC00001220601220630", {21: "1111100"}),
+    _record("LOSTNA   ", {10: "1000", 15: "1000", 29: "TB"}),
+    _record("LISTNB   ", {10: "1009", 15: "1010", 42: "T"}),
+    _record("BSND00001220101221231", {21: "0100000"}),
+    _record("LOSTNB   ", {10: "1200", 15: "1200", 29: "TB"}),
+    _record("LTSTNC   ", {10: "1230", 15: "1230", 25: "TF"}),
+    _record("ZZ", {}),
+]
+
+
+@pytest.fixture
+def mca_file(tmp_path):
+    mca_path = tmp_path / "sample.mca"
+    mca_path.write_text("\n".join(MCA_LINES) + "\n")
+    return str(mca_path)
+
+
+def test_extract_mca_sample(mca_file):
+    schedules, stops = ttu.extract_mca(mca_file)
+
+    assert list(schedules.columns) == ttu.MCA_SCHEDULE_COLS
+    assert [schedule_id[:6] for schedule_id in schedules["schedule_id"]] == [
+        "A00001", "B00001", "C00001", "D00001"]
+    assert schedules["start_date"].tolist() == [
+        "220101", "220101", "220601", "220101"]
+    assert schedules["end_date"].tolist() == [
+        "221231", "221231", "220630", "221231"]
+    assert schedules[ttu.MCA_SCHEDULE_COLS[3:]].to_numpy().tolist() == [
+        [1, 1, 1, 0, 0],
+        [0, 0, 0, 0, 1],
+        [1, 1, 1, 1, 1],
+        [0, 1, 0, 0, 0]]
+
+    assert list(stops.columns) == ttu.MCA_STOP_COLS
+    assert [schedule_id[:6] for schedule_id in stops["schedule_id"]] == (
+        ["A00001"] * 4 + ["B00001"] * 3 + ["C00001"] * 2 + ["D00001"] * 2)
+    assert stops["tiploc_code"].tolist() == [
+        "STNA", "STNB", "PASSX", "STNC",
+        "STNC", "STNB", "STNA",
+        "STNA", "STNB",
+        "STNB", "STNC"]
+    assert stops["departure_time"].tolist() == [
+        "0600", "0615", "", "0630",
+        "2350", "2359", "0010",
+        "1000", "1010",
+        "1200", "1230"]
+    # Half minutes count, passing points have no departure and a journey
+    # past midnight carries on counting from its first day
+    assert stops["departure_secs"].tolist() == [
+        21630, 22530, -1, 23400,
+        85800, 86370, 87000,
+        36000, 36600,
+        43200, 45000]
+    assert stops["activity_type"].tolist() == [
+        "TB", "T", "", "TF",
+        "TB", "T", "TF",
+        "TB", "T",
+        "TB", "TF"]
+
+
+def test_extract_mca_chunked_matches_serial(mca_file, monkeypatch):
+    # Use the process pool even on a machine with a single CPU
+    monkeypatch.setattr(ttu.os, "cpu_count", lambda: 4)
+    assert len(ttu._mca_chunk_bounds(mca_file, 64)) > 2
+
+    schedules, stops = ttu.extract_mca(mca_file)
+    chunked_schedules, chunked_stops = ttu.extract_mca(mca_file, workers=4,
+                                                       chunk_size=64)
+
+    pd.testing.assert_frame_equal(chunked_schedules, schedules)
+    pd.testing.assert_frame_equal(chunked_stops, stops)
+
+
+SPAWN_SCRIPT = """
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, {time_table_dir!r})
+import time_table_utils as ttu
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("spawn")
+    # Use the process pool even on a machine with a single CPU
+    os.cpu_count = lambda: 2
+    schedules, stops = ttu.extract_mca(sys.argv[1], workers=2,
+                                       chunk_size=64)
+    schedules.to_pickle(sys.argv[2])
+    stops.to_pickle(sys.argv[3])
+"""
+
+
+def test_extract_mca_chunked_under_spawn(mca_file, tmp_path):
+    script = tmp_path / "parse.py"
+    script.write_text(SPAWN_SCRIPT.format(
+        time_table_dir=os.path.dirname(os.path.abspath(ttu.__file__))))
+
+    subprocess.run([sys.executable, str(script), mca_file,
+                    str(tmp_path / "schedules.pkl"),
+                    str(tmp_path / "stops.pkl")],
+                   check=True, timeout=120)
+
+    schedules, stops = ttu.extract_mca(mca_file)
+    pd.testing.assert_frame_equal(
+        pd.read_pickle(tmp_path / "schedules.pkl"), schedules)
+    pd.testing.assert_frame_equal(pd.read_pickle(tmp_path / "stops.pkl"),
+                                  stops)
+
+
+@pytest.fixture
+def gtfs():
+    """A small GTFS timetable, with trips on different days, a stop time
+    past midnight, a missing time and a trip with no service."""
+    rng = np.random.default_rng(0)
+    calendar_df = pd.DataFrame({
+        "service_id": ["weekdays", "wednesday", "weekend"],
+        "monday": [1, 0, 0],
+        "tuesday": [1, 0, 0],
+        "wednesday": [1, 1, 0],
+        "thursday": [1, 0, 0],
+        "friday": [1, 0, 0],
+        "saturday": [0, 0, 1],
+        "sunday": [0, 0, 1]})
+    trips_df = pd.DataFrame({
+        "trip_id": [f"T{trip}" for trip in range(40)],
+        "service_id": ["weekdays", "wednesday", "weekend", "none"] * 10,
+        "route_id": "R1"})
+    rows = 2000
+    times = [f"{hour}:{minute:02d}:00" for hour, minute in
+             zip(rng.integers(4, 26, rows), rng.integers(0, 60, rows))]
+    times[7] = ""
+    stop_times_df = pd.DataFrame({
+        "trip_id": rng.choice(trips_df["trip_id"], rows),
+        "departure_time": times,
+        # Categories in the order they are first seen, as pyarrow reads
+        # them, rather than sorted
+        "stop_id": pd.Categorical(
+            [f"S{stop:03d}" for stop in rng.integers(0, 150, rows)][::-1])})
+    return stop_times_df, trips_df, calendar_df
+
+
+def test_count_stop_hours_in_batches_matches_full_join(gtfs):
+    stop_times_df, trips_df, calendar_df = gtfs
+    hours = range(6, 20)
+    # The non-streaming path of the bus timetable script
+    departure_secs = ttu.parse_time_seconds(stop_times_df["departure_time"])
+    timetable_df = (stop_times_df.assign(departure_secs=departure_secs)
+                    .merge(trips_df, on="trip_id", how="left")
+                    .merge(calendar_df, on="service_id", how="left"))
+    day_df = timetable_df[timetable_df["wednesday"] == 1]
+    matrix, stops = ttu.build_frequency_matrix(day_df["stop_id"],
+                                               day_df["departure_secs"])
+    expected = ttu.frequency_matrix_to_df(matrix, stops, hours)
+
+    # Batches each with their own categories, as read_in_batches gives
+    batches = [stop_times_df.iloc[first:first + 300].astype(
+                   {"stop_id": str}).astype({"stop_id": "category"})
+               for first in range(0, len(stop_times_df), 300)]
+    counted = ttu.count_stop_hours_in_batches(
+        batches,
+        ttu.trip_day_weights(trips_df, calendar_df, "wednesday"),
+        hours)
+
+    # The stops come back as strings rather than categories
+    expected.index = expected.index.astype(object)
+    pd.testing.assert_frame_equal(counted, expected, check_dtype=False)
+    assert counted.index.is_monotonic_increasing
+
+
+def test_frequency_matrix_matches_pivot_table():
+    rng = np.random.default_rng(1)
+    rows = 3000
+    timetable_df = pd.DataFrame({
+        "stop_id": [f"S{stop:03d}" for stop in rng.integers(0, 200, rows)],
+        "departure_time": [f"{hour:02d}:{minute:02d}:00" for hour, minute
+                           in zip(rng.integers(5, 23, rows),
+                                  rng.integers(0, 60, rows))],
+        "wednesday": 1})
+
+    matrix, stops = ttu.build_frequency_matrix(
+        timetable_df["stop_id"],
+        ttu.parse_time_seconds(timetable_df["departure_time"]))
+    frequencies_df = ttu.frequency_matrix_to_df(matrix, stops)
+
+    # As the timetable scripts counted them before
+    timetable_df["departure_time"] = (
+        timetable_df["departure_time"].str.slice(0, 2))
+    pivot_df = pd.pivot_table(data=timetable_df,
+                              values="wednesday",
+                              index="stop_id",
+                              columns="departure_time",
+                              aggfunc=len,
+                              fill_value=0)
+    pd.testing.assert_frame_equal(frequencies_df, pivot_df,
+                                  check_dtype=False)
+
+
+def test_parse_time_seconds():
+    times = pd.Series(["06:15:30", "6:15:30", "25:10:00", "0615",
+                       "0615H", " 07:00:00 ", "", None, "garbage",
+                       "06:75:00", "06:15:30"])
+
+    assert ttu.parse_time_seconds(times).tolist() == [
+        22530, 22530, 90600, 22500,
+        22530, 25200, -1, -1, -1,
+        -1, 22530]
+    assert ttu.parse_time_seconds(times).dtype == np.int32
+
+
+def test_frequency_cube_round_trip(gtfs, tmp_path):
+    stop_times_df, trips_df, calendar_df = gtfs
+    trip_weights = ttu.trip_week_weights(trips_df, calendar_df, ttu.WEEKDAYS)
+    cube, stops = ttu.count_frequency_cube_in_batches([stop_times_df],
+                                                      trip_weights)
+    cube_path = str(tmp_path / "cube.feather")
+
+    ttu.save_frequency_cube(cube, stops, ttu.WEEKDAYS, cube_path)
+    read_cube, read_stops, days = ttu.read_frequency_cube(cube_path)
+
+    np.testing.assert_array_equal(read_cube, cube)
+    assert read_cube.dtype == np.uint16
+    pd.testing.assert_index_equal(read_stops, stops)
+    assert days == ttu.WEEKDAYS
+    # A day taken out of the cube is counted as for that day alone
+    hours = range(8, 10)
+    day_df = ttu.count_stop_hours_in_batches(
+        [stop_times_df],
+        ttu.trip_day_weights(trips_df, calendar_df, "wednesday"),
+        hours)
+    pd.testing.assert_frame_equal(
+        ttu.cube_frequencies(read_cube, read_stops, days, "wednesday",
+                             hours),
+        day_df, check_dtype=False)
+    highly_serviced = ttu.highly_serviced_from_cube(cube_path, "wednesday",
+                                                    8, 10)
+    assert len(highly_serviced) > 0
+    pd.testing.assert_index_equal(highly_serviced,
+                                  day_df.index[(day_df > 0).all(axis=1)])
+
+
+def _running_dates(calendar):
+    bits = np.unpackbits(calendar.bitsets, axis=1)[:, :len(calendar.dates)]
+    return {service: [date.day for date in calendar.dates[row == 1]]
+            for service, row in zip(calendar.services, bits)}
+
+
+def test_build_service_calendar_with_exceptions():
+    calendar_df = pd.DataFrame({
+        "service_id": ["weekdays", "weekend"],
+        "start_date": ["20220601", "20220601"],
+        "end_date": ["20220614", "20220614"],
+        "monday": [1, 0], "tuesday": [1, 0], "wednesday": [1, 0],
+        "thursday": [1, 0], "friday": [1, 0],
+        "saturday": [0, 1], "sunday": [0, 1]})
+    calendar_dates_df = pd.DataFrame({
+        "service_id": ["weekdays", "weekend", "extra", "weekdays"],
+        "date": [20220603, 20220606, 20220610, 20220604],
+        # Removing a date a service doesn't run on changes nothing
+        "exception_type": [2, 1, 1, 2]})
+
+    calendar = ttu.gtfs_service_calendar(
+        calendar_df.assign(start_date=pd.to_datetime(calendar_df["start_date"]),
+                           end_date=pd.to_datetime(calendar_df["end_date"])),
+        calendar_dates_df)
+
+    assert _running_dates(calendar) == {
+        "weekdays": [1, 2, 6, 7, 8, 9, 10, 13, 14],
+        "weekend": [4, 5, 6, 11, 12],
+        "extra": [10]}
+    assert ttu.services_running_on(
+        calendar, pd.Timestamp("2022-06-06")).tolist() == [True, True, False]
+    assert not ttu.services_running_on(
+        calendar, pd.Timestamp("2022-07-01")).any()
+
+
+def test_build_service_calendar_joins_rows_of_a_service():
+    # CIF schedules can have several rows with different dates and days
+    schedule_df = pd.DataFrame({
+        "schedule_id": ["A", "A", "B"],
+        "start_date": pd.to_datetime(["2022-06-01", "2022-06-08",
+                                      "2022-06-01"]),
+        "end_date": pd.to_datetime(["2022-06-03", "2022-06-10",
+                                    "2022-06-10"]),
+        "monday": [0, 0, 1], "tuesday": [0, 0, 0], "wednesday": [1, 0, 0],
+        "thursday": [0, 0, 0], "friday": [0, 1, 0]})
+
+    calendar = ttu.cif_schedule_calendar(schedule_df)
+
+    assert _running_dates(calendar) == {"A": [1, 10], "B": [6]}